@@ -0,0 +1,25 @@
+import os
+from tempfile import NamedTemporaryFile
+
+
+def atomic_write(file_path, data):
+    """
+    Replaces file_path with data in one step: the data is written and synced
+    to a temporary file next to it, which is then renamed over it. Readers,
+    and the file left behind by a killed process, see either the old or the
+    new contents, never a partial write.
+    :param file_path: string, path of the file to replace
+    :param data: string or bytes, the new contents
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with NamedTemporaryFile(mode, dir=directory, prefix='.tmp-', delete=False) as file:
+        try:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        except BaseException:
+            file.close()
+            os.remove(file.name)
+            raise
+    os.replace(file.name, file_path)
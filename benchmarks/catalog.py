@@ -0,0 +1,76 @@
+"""
+Feed URL generation for a synthetic catalog of saved searches: cli.py's
+build_url once per search (in process, so without interpreter start-up)
+against validating the whole catalog with Catalog's lookup tables.
+
+    python -m benchmarks.catalog --searches 100000
+"""
+from argparse import ArgumentParser as Ag
+from contextlib import redirect_stdout
+from io import StringIO
+import random
+from timeit import repeat
+
+from catalog import Catalog
+import cli
+
+
+def searches(count, seed=0):
+    rng = random.Random(seed)
+    cities = [f'city{num}' for num in range(200)]
+    terms = [None, 'GTI', 'civic si', 'WRX', 'miata']
+    rows = []
+    for _ in range(count):
+        options = {'max_price': rng.randrange(5000, 40000, 1000)}
+        if rng.random() < 0.5:
+            options['has_images'] = True
+        if rng.random() < 0.3:
+            options['transmission'] = rng.choice(['manual', 'automatic'])
+        if rng.random() < 0.3:
+            options['min_auto_year'] = rng.randrange(2000, 2018)
+        rows.append({'city': rng.choice(cities), 'vehicle_type': 'cage',
+                     'seller_type': rng.choice(['all', 'owner', 'dealer']),
+                     'search': rng.choice(terms), 'options': options})
+    return rows
+
+
+def argv(row):
+    args = [row['city'], row['vehicle_type'], row['seller_type']]
+    if row['search']:
+        args += ['--search', row['search']]
+    for option, value in row['options'].items():
+        args += [f'--{option}'] if value is True else [f'--{option}', str(value)]
+    return args
+
+
+def per_search_cli(rows):
+    with redirect_stdout(StringIO()) as out:
+        for row in rows:
+            cli.build_url(argv(row))
+    return set(out.getvalue().split())
+
+
+def bulk(rows):
+    catalog = Catalog()
+    for row in rows:
+        catalog.add(row)
+    return catalog
+
+
+def main():
+    parser = Ag()
+    parser.add_argument('--searches', type=int, default=100000)
+    args = parser.parse_args()
+
+    rows = searches(args.searches)
+    sample = rows[:2000]
+    before = min(repeat(lambda: per_search_cli(sample), number=1, repeat=3)) / len(sample)
+    after = min(repeat(lambda: bulk(rows), number=1, repeat=3)) / len(rows)
+    catalog = bulk(rows)
+    print(f'{"searches":>10} {"urls":>10} {"before/s":>12} {"after/s":>12} {"speedup":>8}')
+    print(f'{len(rows):>10} {len(catalog.urls):>10} {1 / before:>12.0f} '
+          f'{1 / after:>12.0f} {before / after:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
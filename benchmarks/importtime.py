@@ -0,0 +1,59 @@
+"""
+Start-up cost of cli.py, tracked against a budget: the cumulative import
+time python -X importtime reports for a module, best of several fresh
+interpreters, and whether any of the modules kept off the URL building
+path were loaded anyway. Exits 1 when over budget, e.g. in CI.
+
+    python -m benchmarks.importtime --budget_ms 50
+"""
+from argparse import ArgumentParser as Ag
+from os import path
+import subprocess
+import sys
+
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+# Only the fetch, store and notify paths may load these
+HEAVY = ('classes', 'config', 'feedparser', 'jinja2', 'smtplib', 'sqlite3', 'aiohttp',
+         'email.mime.multipart')
+
+
+def import_time(module):
+    """
+    :return: 2-tuple, (cumulative microseconds importing module, set of
+             modules imported), from one fresh interpreter
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    total = None
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        loaded.add(name.strip())
+        if name.strip() == module:
+            total = int(cumulative)
+    return total, loaded
+
+
+def main():
+    parser = Ag()
+    parser.add_argument('--modules', nargs='+', default=['cli'])
+    parser.add_argument('--budget_ms', type=float, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    print(f'{"module":>10} {"import (ms)":>12} {"budget (ms)":>12}  heavy modules loaded')
+    for module in args.modules:
+        runs = [import_time(module) for _ in range(args.repeat)]
+        best = min(total for total, _ in runs) / 1000
+        heavy = sorted(set(HEAVY) & set.union(*(loaded for _, loaded in runs)))
+        failed = failed or best > args.budget_ms or bool(heavy)
+        print(f'{module:>10} {best:>12.1f} {args.budget_ms:>12.1f}  {", ".join(heavy) or "-"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Fan-out from refreshed feeds to subscribers with a registry of 100k
+subscriptions: scanning every subscription for each refreshed feed against
+one lookup in the inverted index load_subscriptions builds.
+
+    python -m benchmarks.registry --subscriptions 100000 --refreshed 500
+"""
+from argparse import ArgumentParser as Ag
+import json
+from os import path
+import random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from catalog import Catalog
+from classes import Database, Listing
+from poller import dispatch, load_subscriptions
+
+
+class Collect:
+    """Dispatcher stand-in that only counts what it is handed"""
+
+    def __init__(self):
+        self.added = 0
+
+    def add(self, user, email_address, listings, search=None):
+        self.added += len(listings)
+
+
+def subscriptions(count, seed=0):
+    rng = random.Random(seed)
+    catalog = Catalog()
+    cities = [f'city{num}' for num in range(100)]
+    terms = [None, 'GTI', 'civic si', 'WRX', 'miata']
+    rows = {}
+    for _ in range(count):
+        search = {'city': rng.choice(cities), 'vehicle_type': 'cage', 'seller_type': 'all',
+                  'search': rng.choice(terms),
+                  'options': {'max_price': rng.randrange(5000, 15000, 1000)}}
+        url = catalog.add(search)
+        email = f'user{rng.randrange(count // 3)}@example.com'
+        name = Catalog.label(catalog.searches[url])
+        rows[(email, url, name)] = (None, email, url, name, json.dumps(catalog.searches[url]))
+    return list(rows.values())
+
+
+def scan(rows, results):
+    collect = Collect()
+    for url, items in results.items():
+        for user, email, search_url, name, _ in rows:
+            if search_url == url:
+                collect.add(user or email, email, items, name)
+    return collect.added
+
+
+def lookup(routes, results):
+    collect = Collect()
+    dispatch(collect, routes, results)
+    return collect.added
+
+
+def main():
+    parser = Ag()
+    parser.add_argument('--subscriptions', type=int, default=100000)
+    parser.add_argument('--refreshed', type=int, default=500)
+    args = parser.parse_args()
+
+    rows = subscriptions(args.subscriptions)
+    with TemporaryDirectory() as directory:
+        database = path.join(directory, 'registry.db')
+        Database.init_database(database)
+        start = perf_counter()
+        with Database(database) as db:
+            db.add_subscriptions(rows)
+        register = perf_counter() - start
+        start = perf_counter()
+        routes = load_subscriptions(database)
+        load = perf_counter() - start
+
+    urls = random.Random(1).sample(sorted(routes), min(args.refreshed, len(routes)))
+    results = {url: [Listing(f'{url}#{num}') for num in range(5)] for url in urls}
+    start = perf_counter()
+    before = scan(rows, results)
+    scanned = perf_counter() - start
+    start = perf_counter()
+    after = lookup(routes, results)
+    looked_up = perf_counter() - start
+    assert before == after
+    print(f'{"subscriptions":>13} {"feeds":>6} {"register (s)":>12} {"load (s)":>9} '
+          f'{"refreshed":>9} {"scan (ms)":>10} {"index (ms)":>10}')
+    print(f'{len(rows):>13} {len(routes):>6} {register:>12.2f} {load:>9.2f} '
+          f'{len(urls):>9} {scanned * 1000:>10.1f} {looked_up * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
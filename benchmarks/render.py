@@ -0,0 +1,76 @@
+"""
+Render cost of the email digests.
+
+Per message: rebuilding the Jinja environment for every message (the old
+Message behaviour) against the shared Renderer.
+
+Fan-out: digests for many recipients sharing the same listings, with every
+listing rendered into each digest against assembling them from the shared
+Renderer's fragment cache.
+
+    python -m benchmarks.render
+"""
+from argparse import ArgumentParser as Ag
+from timeit import repeat
+
+from classes import Listing, Renderer
+
+
+def listings(count):
+    return [Listing(f'https://denver.craigslist.org/cto/d/gti/{num}.html',
+                    f'2015 Volkswagen Golf GTI hatchback ${18000 + num}',
+                    'Clean title, manual, one owner. ' * 8,
+                    f'https://denver.craigslist.org/cto/d/gti/{num}.html',
+                    f'https://images.craigslist.org/{num}.jpg', 18000 + num)
+            for num in range(count)]
+
+
+def per_message_env(user, items):
+    renderer = Renderer(max_fragments=0)
+    return renderer.render_html(user, items), renderer.render_text(user, items)
+
+
+def shared_renderer(user, items):
+    renderer = Renderer.shared()
+    return renderer.render_html(user, items), renderer.render_text(user, items)
+
+
+def fan_out(renderer, recipients, items):
+    for num in range(recipients):
+        matched = {listing.id: [f'search {num % 10}'] for listing in items}
+        renderer.render_html(f'user{num}', items, matched)
+        renderer.render_text(f'user{num}', items, matched)
+
+
+def best_of(func, items, number):
+    return min(repeat(lambda: func('Tester', items), number=number, repeat=5)) / number
+
+
+def main():
+    parser = Ag()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 50, 500])
+    parser.add_argument('--recipients', type=int, default=200)
+    args = parser.parse_args()
+
+    shared_renderer('Tester', listings(1))
+    print(f'{"listings":>8} {"before (ms)":>12} {"after (ms)":>12} {"speedup":>8}')
+    for size in args.sizes:
+        items = listings(size)
+        number = max(1, 2000 // (size + 20))
+        before = best_of(per_message_env, items, number) * 1000
+        after = best_of(shared_renderer, items, number) * 1000
+        print(f'{size:>8} {before:>12.3f} {after:>12.3f} {before / after:>7.1f}x')
+
+    items = listings(50)
+    uncached = Renderer(max_fragments=0)
+    cached = Renderer()
+    before = min(repeat(lambda: fan_out(uncached, args.recipients, items), number=1, repeat=3))
+    after = min(repeat(lambda: fan_out(cached, args.recipients, items), number=1, repeat=3))
+    print(f'\n{"recipients":>10} {"listings":>8} {"uncached (ms)":>14} {"fragments (ms)":>15} '
+          f'{"speedup":>8}')
+    print(f'{args.recipients:>10} {len(items):>8} {before * 1000:>14.1f} {after * 1000:>15.1f} '
+          f'{before / after:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+End-to-end poll cycle benchmark: Poller fetching from a local FakeCraigslist
+running in a separate process, storage in a fresh database, and digest
+rendering with Message.
+
+    python -m benchmarks.throughput --searches 10 100 1000
+
+For each search count one cold cycle (every listing new) is followed by
+warm cycles where the feeds churn slowly and most answers are 304s.
+Peak RSS is the high-water mark of this process so far, so later rows
+include earlier ones; with --shards it leaves out the worker processes.
+"""
+from argparse import ArgumentParser as Ag
+from os import path
+import resource
+import socket
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+from classes import Database, Message, Vehicle
+from poller import Poller, ShardedPoller
+
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+class TimedPoller(Poller):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    async def poll(self, *args):
+        start = perf_counter()
+        try:
+            return await super().poll(*args)
+        finally:
+            self.latencies.append(perf_counter() - start)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, size, churn, latency):
+    server = subprocess.Popen([sys.executable, path.join(ROOT, 'fake_craigslist.py'),
+                               '--port', str(port), '--size', str(size),
+                               '--churn', str(churn), '--latency', str(latency)])
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return server
+        except OSError:
+            sleep(0.05)
+    server.kill()
+    raise RuntimeError('fake Craigslist server did not start')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def cycle(poller, urls):
+    start = perf_counter()
+    results = poller.run(urls)
+    polled = perf_counter() - start
+    new_items = [items for items in results.values() if items]
+    start = perf_counter()
+    for items in new_items:
+        Message('Tester', 'tester@example.com', items, send=False)
+    rendered = perf_counter() - start
+    return polled, rendered, sum(len(items) for items in new_items)
+
+
+def run(count, port, cycles, concurrency, streaming, shards):
+    urls = [f'http://127.0.0.1:{port}/city{num}/search/cta?'
+            + Vehicle(f'city{num}', 'cta', ['max_price=20000'], 'GTI').get_url.split('?')[1]
+            for num in range(count)]
+    with TemporaryDirectory() as tmp:
+        database = path.join(tmp, 'bench.db')
+        if shards > 1:
+            poller = ShardedPoller(database, shards, TimedPoller, concurrency=concurrency,
+                                   streaming=streaming)
+        else:
+            Database.init_database(database)
+            poller = TimedPoller(database, concurrency, streaming=streaming)
+        with poller:
+            rows = [cycle(poller, urls) for _ in range(cycles)]
+    cold, warm = rows[0], rows[1:]
+    polled = sum(row[0] for row in rows)
+    items = sum(row[2] for row in rows)
+    return {
+        'searches': count,
+        'cold_s': cold[0],
+        'warm_s': sum(row[0] for row in warm) / len(warm) if warm else 0.0,
+        'items_per_s': items / polled if polled else 0.0,
+        'p50_ms': percentile(poller.latencies, 0.5) * 1000,
+        'p99_ms': percentile(poller.latencies, 0.99) * 1000,
+        'render_ms': sum(row[1] for row in rows) * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = Ag()
+    parser.add_argument('--searches', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--size', type=int, default=25)
+    parser.add_argument('--churn', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--shards', type=int, default=1)
+    args = parser.parse_args()
+
+    port = free_port()
+    server = start_server(port, args.size, args.churn, args.latency)
+    try:
+        columns = ['searches', 'cold_s', 'warm_s', 'items_per_s', 'p50_ms', 'p99_ms',
+                   'render_ms', 'peak_rss_mb']
+        print(' '.join(f'{column:>12}' for column in columns))
+        for count in args.searches:
+            row = run(count, port, args.cycles, args.concurrency, args.streaming,
+                      args.shards)
+            print(' '.join(f'{row[column]:>12.2f}' if isinstance(row[column], float)
+                           else f'{row[column]:>12}' for column in columns))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
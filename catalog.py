@@ -0,0 +1,229 @@
+import csv
+import json
+from os import path
+
+from vehicles import VehicleOptions
+
+
+# Lookup tables built once from VehicleOptions, so a row costs a few dict
+# hits instead of an argparse parser and three objects
+CATEGORIES = {(vehicle, seller): category
+              for vehicle, sellers in VehicleOptions.categories.items()
+              for seller, category in sellers.items()}
+FLAT = VehicleOptions.flat_static
+NESTED = VehicleOptions.nested_static
+VAR = VehicleOptions.var_opt
+TRUE = {'1', 'true', 'yes', 'y', 'on'}
+FALSE = {'', '0', 'false', 'no', 'n', 'off'}
+# Columns that are not search options in a CSV catalog; user and email
+# name the subscriber in a catalog of subscriptions
+FIELDS = ('name', 'city', 'vehicle_type', 'seller_type', 'search', 'user', 'email')
+# Accepted static option values, as they appear in JSON or CSV, to their
+# canonical value and URL fragment; None marks an unset flat option
+STATIC_VALUES = {
+    **{option: {**{value: (True, fragment) for value in (True, 1, *TRUE)},
+                **{value: None for value in (False, 0, None, *FALSE)}}
+       for option, fragment in FLAT.items()},
+    **{option: {**{value: (value, fragment) for value, fragment in values.items()},
+                **{int(value): (value, fragment) for value, fragment in values.items()
+                   if value.isdigit()}}
+       for option, values in NESTED.items()},
+}
+
+
+def read_catalog(catalog_file):
+    """
+    :param catalog_file: string, path to a .csv or .jsonl catalog. CSV rows
+                         have one column per option, named as in cli.py;
+                         JSONL rows are saved searches as read by
+                         poller.load_searches
+    :return: generator of (line number, dict or ValueError)
+    """
+    if path.splitext(catalog_file)[1].lower() == '.csv':
+        with open(catalog_file, newline='') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                search = {field: row.pop(field, None) for field in FIELDS}
+                search['options'] = {option: value for option, value in row.items()
+                                     if value not in (None, '')}
+                yield reader.line_num, search
+    else:
+        with open(catalog_file) as file:
+            for line, text in enumerate(file, 1):
+                if not text.strip():
+                    continue
+                try:
+                    yield line, json.loads(text)
+                except ValueError as exc:
+                    yield line, ValueError(f'Invalid JSON: {exc}')
+
+
+class Catalog:
+
+    def __init__(self):
+        """
+        Validates saved searches in bulk and keeps one canonical search per
+        distinct feed URL. Invalid rows are collected in errors.
+        """
+        self.searches = {}
+        # Catalogs repeat a few cities and terms many times over
+        self.bases = {}
+        self.terms = {}
+        self.errors = []
+        self.rows = 0
+        self.duplicates = 0
+
+    def __repr__(self):
+        return f'Catalog({len(self.searches)}, {len(self.errors)})'
+
+    @property
+    def urls(self):
+        return list(self.searches)
+
+    @staticmethod
+    def option_value(option, value):
+        """
+        :return: 2-tuple, (canonical value, URL fragment), or None if unset
+        :raises ValueError: on an unknown option or a value it does not take
+        """
+        values = STATIC_VALUES.get(option)
+        if values is not None:
+            try:
+                return values[value]
+            except (KeyError, TypeError):
+                pass
+            if isinstance(value, str) and value.strip().lower() in values:
+                return values[value.strip().lower()]
+        elif option in VAR:
+            if type(value) is int and value >= 0 and option != 'postal_code':
+                return value, f'{option}={value}'
+            if value is None or value == '':
+                return None
+            text = str(value).strip()
+            if text.isdigit():
+                # Postal codes keep their leading zeros
+                value = text if option == 'postal_code' else int(text)
+                return value, f'{option}={value}'
+        else:
+            raise ValueError(f'Unknown option "{option}"')
+        raise ValueError(f'Invalid value "{value}" for option "{option}"')
+
+    def base(self, city, vehicle_type, seller_type):
+        """
+        :return: 2-tuple, (canonical city, URL before the options)
+        :raises ValueError: on a missing city or an unknown vehicle or seller type
+        """
+        key = (city, vehicle_type, seller_type)
+        found = self.bases.get(key)
+        if found is None:
+            city = ''.join(str(city or '').split()).lower()
+            if not city:
+                raise ValueError('Missing city')
+            category = CATEGORIES.get((vehicle_type, seller_type))
+            if category is None:
+                raise ValueError(f'Invalid vehicle or seller type "{vehicle_type}", '
+                                 f'"{seller_type}"')
+            found = self.bases[key] = (
+                city, f'https://{city}.craigslist.org/search/{category}?format=rss&searchNearby=1')
+        return found
+
+    def term(self, term):
+        """
+        :return: 2-tuple, (canonical term, URL fragment), both None without a term
+        """
+        found = self.terms.get(term)
+        if found is None:
+            words = str(term or '').lower().split()
+            found = self.terms[term] = ((' '.join(words), f'auto_make_model={"+".join(words)}')
+                                        if words else (None, None))
+        return found
+
+    def canonical(self, search):
+        """
+        Normalizes a search the way SearchPlanner.canonical does and builds
+        its URL, which matches Vehicle.from_search on the canonical search:
+        static options then variable ones, each in alphabetical order.
+        :param search: dict, saved search
+        :return: 2-tuple, (URL, canonical search)
+        :raises ValueError: describing every problem found with the search
+        """
+        if not isinstance(search, dict):
+            raise ValueError('Not a saved search object')
+        vehicle_type = search.get('vehicle_type')
+        seller_type = search.get('seller_type')
+        city, base = self.base(search.get('city'), vehicle_type, seller_type)
+        parts = [base]
+        variable = []
+        options = {}
+        problems = []
+        raw = search.get('options') or {}
+        for option in sorted(raw):
+            try:
+                found = self.option_value(option, raw[option])
+            except ValueError as exc:
+                problems.append(str(exc))
+                continue
+            if found is not None:
+                options[option] = found[0]
+                (variable if option in VAR else parts).append(found[1])
+        if problems:
+            raise ValueError('; '.join(problems))
+        parts += variable
+        term, fragment = self.term(search.get('search'))
+        if fragment is not None:
+            parts.append(fragment)
+        canonical = {
+            'city': city,
+            'vehicle_type': vehicle_type,
+            'seller_type': seller_type,
+            'search': term,
+            'options': options,
+        }
+        if search.get('name'):
+            canonical = {'name': search['name'], **canonical}
+        return '&'.join(parts), canonical
+
+    @staticmethod
+    def label(search):
+        """
+        :param search: dict, canonical search
+        :return: string, Vehicle.label of the search
+        """
+        category = CATEGORIES[(search['vehicle_type'], search['seller_type'])]
+        return ' '.join(part for part in (search['city'], category, search['search']) if part)
+
+    def add(self, search, line=None):
+        """
+        :param search: dict, saved search, or the ValueError read_catalog gave for its row
+        :param line: int, row number reported with an error
+        :return: string, the search's URL, or None if it is invalid
+        """
+        self.rows += 1
+        try:
+            if isinstance(search, ValueError):
+                raise search
+            url, canonical = self.canonical(search)
+        except ValueError as exc:
+            self.errors.append((line if line is not None else self.rows, str(exc)))
+            return None
+        if url in self.searches:
+            self.duplicates += 1
+        else:
+            self.searches[url] = canonical
+        return url
+
+    def load(self, catalog_file):
+        for line, search in read_catalog(catalog_file):
+            self.add(search, line)
+        return self
+
+    def report(self):
+        """
+        :return: dict, row, URL, duplicate and invalid counts
+        """
+        return {
+            'rows': self.rows,
+            'urls': len(self.searches),
+            'duplicates': self.duplicates,
+            'invalid': len(self.errors),
+        }
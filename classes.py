@@ -1,30 +1,207 @@
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from os import listdir, path
+from calendar import timegm
+from collections import OrderedDict
+from contextlib import nullcontext
+from datetime import datetime
+from hashlib import sha1
+from os import path, rename, stat
 import pickle
-import smtplib
+import re
 import sqlite3
+from threading import Lock
+from time import time
+from xml.etree.ElementTree import ParseError, XMLPullParser
 
-import feedparser as fp
-from jinja2 import Environment, PackageLoader, select_autoescape
+from metrics import METRICS
+# Re-exported from here; they live apart so cli.py can build URLs without
+# importing storage, feed parsing or mail
+from vehicles import Url, Vehicle, VehicleOptions
 
-from config import Config
+# feedparser, urllib.request, jinja2, smtplib, the MIME classes and
+# config.py are imported where they are first needed, so storage and the
+# CLI's queries do not pay for them
+
+
+def config():
+    """
+    :return: the Config class from config.py, imported on first use
+    """
+    from config import Config
+    return Config
+
+
+class Listing:
+    __slots__ = ('id', 'title', 'summary', 'link', 'image', 'price', 'posted',
+                 'status', 'previous_price')
+    # Values of status, in the order their digest sections come in
+    statuses = ('new', 'price_drop', 'changed')
+    price_pattern = re.compile(r'\$\s?([\d,]+)')
+    year_pattern = re.compile(r'\b(19[0-9]{2}|20[0-9]{2})\b')
+    miles_pattern = re.compile(r'(?:odometer|mileage)\s*:?\s*([\d,.]+)\s*(k)?|'
+                               r'\b([\d,.]+)\s*(k)?\s*(?:miles|mi)\b', re.IGNORECASE)
+
+    def __init__(self, id, title='', summary='', link=None, image=None,
+                 price=None, posted=None, status='new', previous_price=None):
+        """
+        :param id: string, CL post id (the post URL)
+        :param title: string
+        :param summary: string
+        :param link: string, post URL
+        :param image: string, URL of the first image
+        :param price: int, asking price in dollars
+        :param posted: int, unix time the post was published
+        :param status: string, one of statuses; how the post differs from
+                       what was last delivered
+        :param previous_price: int, asking price before a change
+        """
+        self.id = id
+        self.title = title
+        self.summary = summary
+        self.link = link
+        self.image = image
+        self.price = price
+        self.posted = posted
+        self.status = status
+        self.previous_price = previous_price
+
+    def __repr__(self):
+        return f'Listing({self.id}, {self.title}, {self.price})'
+
+    def __eq__(self, other):
+        return isinstance(other, Listing) and self.as_tuple() == other.as_tuple()
+
+    def __getstate__(self):
+        return self.as_tuple()
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def as_tuple(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    @property
+    def year(self):
+        """
+        :return: int, model year from the title, or None
+        """
+        match = self.year_pattern.search(self.title)
+        return int(match.group(1)) if match else None
+
+    @property
+    def miles(self):
+        """
+        :return: int, odometer reading from the title or summary, or None
+        """
+        for text in (self.title, self.summary):
+            match = self.miles_pattern.search(text)
+            if match is None:
+                continue
+            number = (match.group(1) or match.group(3)).replace(',', '')
+            try:
+                miles = float(number)
+            except ValueError:
+                continue
+            if match.group(2) or match.group(4):
+                miles *= 1000
+            if 0 <= miles < 2000000:
+                return int(miles)
+        return None
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies the same car across reposts: the title without its price
+        and punctuation, plus the price. None without a price, as bare titles
+        like "2012 Honda Civic" are shared by different cars.
+        """
+        if self.price is None:
+            return None
+        words = self.price_pattern.sub(' ', self.title).lower()
+        words = ' '.join(re.findall(r'[a-z0-9]+', words))
+        return sha1(f'{words}|{self.price}'.encode()).hexdigest()[:16]
+
+    @property
+    def content_hash(self):
+        """
+        Changes when the post is edited: its title, summary and price, with
+        case, punctuation and spacing ignored.
+        """
+        title, summary = (' '.join(re.findall(r'[a-z0-9]+', (text or '').lower()))
+                          for text in (self.title, self.summary))
+        return sha1(f'{title}|{summary}|{self.price}'.encode()).hexdigest()[:16]
+
+    @classmethod
+    def from_entry(cls, entry):
+        """
+        Normalizes a feedparser entry, or a dict from Feed.stream.
+        :param entry: dict of a CL posting
+        :return: Listing
+        """
+        title = entry.get('title', '').replace('&#x0024;', '$')
+        summary = entry.get('summary', '').replace('&#x0024;', '$')
+        enclosure = entry.get('enc_enclosure')
+        return cls(entry['id'], title, summary, entry.get('link'),
+                   enclosure.get('resource') if enclosure else None,
+                   cls.parse_price(title), cls.parse_posted(entry))
+
+    @classmethod
+    def parse_price(cls, title):
+        matches = cls.price_pattern.findall(title)
+        digits = matches[-1].replace(',', '') if matches else ''
+        return int(digits) if digits else None
+
+    @staticmethod
+    def parse_posted(entry):
+        parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+        if parsed:
+            return timegm(parsed)
+        published = entry.get('published') or entry.get('updated')
+        if published:
+            try:
+                return int(datetime.fromisoformat(published).timestamp())
+            except ValueError:
+                return None
+        return None
 
 
 class Database:
-    def __init__(self, database):
+    # Stay under SQLITE_MAX_VARIABLE_NUMBER on older sqlite builds
+    max_params = 900
+    # Columns added to listings after its first release, for upgrading old files
+    listing_columns = (('year', 'INTEGER'), ('miles', 'INTEGER'), ('content_hash', 'text'),
+                       ('previous_price', 'INTEGER'), ('updated', 'REAL'))
+    # Likewise for feeds
+    feed_columns = (('polled', 'REAL'),)
+    # query_listings filters, named as in VehicleOptions.var_opt
+    listing_filters = {
+        'min_price': 'price >= ?',
+        'max_price': 'price <= ?',
+        'min_auto_year': 'year >= ?',
+        'max_auto_year': 'year <= ?',
+        'min_miles': 'miles >= ?',
+        'max_miles': 'miles <= ?',
+    }
+
+    def __init__(self, database, timeout=5.0):
         """
         :param database: string, path to sqlite db file
+        :param timeout: float, seconds to wait for another connection's write lock
         """
         self.database = database
-        self.conn = sqlite3.connect(self.database)
+        self.conn = sqlite3.connect(self.database, timeout=timeout)
+        # With WAL a killed process can only lose uncommitted work, so
+        # syncing at checkpoints rather than on every commit is enough
+        self.conn.execute('PRAGMA synchronous=NORMAL')
         self.c = self.conn.cursor()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.commit()
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
         self.conn.close()
         del self
 
@@ -38,30 +215,613 @@ class Database:
     def cursor(self):
         return self.c
 
+    def lock(self):
+        """
+        Takes the write lock up front, waiting out the busy timeout for a poll
+        cycle's transaction. A transaction that reads before it writes is
+        refused at once instead, as sqlite will not wait on a stale snapshot.
+        """
+        self.c.execute('BEGIN IMMEDIATE')
+
     @staticmethod
     def init_database(database):
-        if database not in listdir(path.dirname(database)):
-            with Database(database) as db:
-                c = db.cursor
-                c.execute('CREATE TABLE IF NOT EXISTS posts '
-                          '(id INTEGER,'
-                          'notification_status BOOLEAN,'
-                          'url text)')
+        with Database(database) as db:
+            c = db.cursor
+            # Persists in the file; readers no longer wait on a poll cycle's writes
+            c.execute('PRAGMA journal_mode=WAL')
+            c.execute('CREATE TABLE IF NOT EXISTS posts '
+                      '(id INTEGER,'
+                      'notification_status BOOLEAN,'
+                      'url text,'
+                      'search text)')
+            columns = [row[1] for row in c.execute('PRAGMA table_info(posts)')]
+            if 'search' not in columns:
+                c.execute('ALTER TABLE posts ADD COLUMN search text')
+            c.execute('CREATE UNIQUE INDEX IF NOT EXISTS posts_search_id '
+                      'ON posts (search, id)')
+            # For pruning a listing from every search at once
+            c.execute('CREATE INDEX IF NOT EXISTS posts_id ON posts (id)')
+            c.execute('CREATE TABLE IF NOT EXISTS listings '
+                      '(id text PRIMARY KEY,'
+                      'fingerprint text,'
+                      'title text,'
+                      'summary text,'
+                      'link text,'
+                      'image text,'
+                      'price INTEGER,'
+                      'posted INTEGER,'
+                      'first_seen REAL,'
+                      'year INTEGER,'
+                      'miles INTEGER,'
+                      'content_hash text,'
+                      'previous_price INTEGER,'
+                      'updated REAL)')
+            columns = [row[1] for row in c.execute('PRAGMA table_info(listings)')]
+            for column, kind in Database.listing_columns:
+                if column not in columns:
+                    c.execute(f'ALTER TABLE listings ADD COLUMN {column} {kind}')
+            for column in ('fingerprint', 'price', 'year', 'miles', 'first_seen'):
+                c.execute(f'CREATE INDEX IF NOT EXISTS listings_{column} '
+                          f'ON listings ({column})')
+            Database.init_fts(c)
+            c.execute('CREATE TABLE IF NOT EXISTS feeds '
+                      '(search text PRIMARY KEY,'
+                      'etag text,'
+                      'modified text,'
+                      'polls INTEGER DEFAULT 0,'
+                      'unchanged INTEGER DEFAULT 0,'
+                      'bytes INTEGER DEFAULT 0,'
+                      'polled REAL)')
+            columns = [row[1] for row in c.execute('PRAGMA table_info(feeds)')]
+            for column, kind in Database.feed_columns:
+                if column not in columns:
+                    c.execute(f'ALTER TABLE feeds ADD COLUMN {column} {kind}')
+            c.execute('CREATE TABLE IF NOT EXISTS subscribers '
+                      '(id INTEGER PRIMARY KEY,'
+                      'user text,'
+                      'email text UNIQUE)')
+            c.execute('CREATE TABLE IF NOT EXISTS subscriptions '
+                      '(url text,'
+                      'subscriber INTEGER,'
+                      'name text,'
+                      'search text)')
+            # The inverted index: canonical feed URL to the subscribers waiting on it
+            c.execute('CREATE UNIQUE INDEX IF NOT EXISTS subscriptions_url '
+                      'ON subscriptions (url, subscriber, name)')
+            c.execute('CREATE INDEX IF NOT EXISTS subscriptions_subscriber '
+                      'ON subscriptions (subscriber)')
+            # What each recipient was sent, by listing id, fingerprint and
+            # id#content_hash, so overlapping searches polled in different
+            # cycles deliver a car once to each of their subscribers
+            c.execute('CREATE TABLE IF NOT EXISTS deliveries '
+                      '(email text,'
+                      'key text,'
+                      'delivered REAL,'
+                      'PRIMARY KEY (email, key))')
+
+    @staticmethod
+    def init_fts(c):
+        """
+        Full-text index over listing titles and summaries. It reads its text
+        from the listings table (external content) and triggers keep it in
+        step, so ingest updates it in the same transaction. Its rowids follow
+        listings', so it has to be rebuilt after a VACUUM.
+        """
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'listings_fts'")
+        exists = c.fetchone() is not None
+        c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5'
+                  "(title, summary, content='listings', tokenize='porter unicode61')")
+        c.execute('CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings '
+                  'BEGIN INSERT INTO listings_fts (rowid, title, summary) '
+                  'VALUES (new.rowid, new.title, new.summary); END')
+        c.execute('CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings '
+                  'BEGIN INSERT INTO listings_fts (listings_fts, rowid, title, summary) '
+                  "VALUES ('delete', old.rowid, old.title, old.summary); END")
+        c.execute('CREATE TRIGGER IF NOT EXISTS listings_fts_update '
+                  'AFTER UPDATE OF title, summary ON listings '
+                  'BEGIN INSERT INTO listings_fts (listings_fts, rowid, title, summary) '
+                  "VALUES ('delete', old.rowid, old.title, old.summary); "
+                  'INSERT INTO listings_fts (rowid, title, summary) '
+                  'VALUES (new.rowid, new.title, new.summary); END')
+        if not exists:
+            c.execute("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')")
+
+    def insert_entry(self, id_num, url, search=None):
+        self.c.execute('INSERT OR IGNORE INTO posts '
+                       '(id, notification_status, url, search) VALUES (?,?,?,?)',
+                       (id_num, False, url, search),)
+
+    def insert_entries(self, search, listings):
+        """
+        Records every listing as seen for search, in the current transaction.
+        :param search: string, RSS feed URL the listings came from
+        :param listings: iterable of Listing
+        """
+        self.c.executemany('INSERT OR IGNORE INTO posts '
+                           '(id, notification_status, url, search) VALUES (?,?,?,?)',
+                           [(listing.id, False, listing.link, search)
+                            for listing in listings])
+
+    def resolve(self, listing):
+        """
+        Looks a listing up in the index shared by every search, by id or, for
+        reposts, by fingerprint.
+        :param listing: Listing
+        :return: 2-tuple, (id, first_seen) of the earliest match, or None
+        """
+        self.c.execute('SELECT id, first_seen FROM listings WHERE id = ? OR fingerprint = ? '
+                       'ORDER BY first_seen LIMIT 1', (listing.id, listing.fingerprint))
+        return self.c.fetchone()
+
+    def index_listings(self, listings, since=None):
+        """
+        Adds listings to the shared index and drops those already indexed
+        before since, i.e. delivered through another search or as an earlier post.
+        A repost gets a row of its own, so its later edits are seen, but keeps
+        the first_seen of the post it repeats.
+        :param listings: list of Listing, new for one search
+        :param since: float, unix time the current poll cycle started; None keeps all
+        :return: list of Listing still to be delivered
+        """
+        now = time()
+        rows = []
+        kept = []
+        for listing in listings:
+            found = self.resolve(listing)
+            if found is None or since is None or found[1] >= since:
+                kept.append(listing)
+            rows.append((listing.id, listing.fingerprint, listing.title, listing.summary,
+                         listing.link, listing.image, listing.price, listing.posted,
+                         now if found is None else found[1], listing.year, listing.miles,
+                         listing.content_hash))
+        # Ids already indexed, by another search, are ignored
+        self.c.executemany('INSERT OR IGNORE INTO listings (id, fingerprint, title, summary, '
+                           'link, image, price, posted, first_seen, year, miles, content_hash) '
+                           'VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+        return kept
+
+    def update_listings(self, listings, now=None):
+        """
+        Stores the current content of edited listings in the shared index;
+        the price each replaces is kept as its previous_price.
+        :param listings: list of Listing, already indexed
+        :param now: float, unix time recorded as their update; None only
+                    refreshes content_hash, for rows indexed before it existed
+        """
+        if now is None:
+            self.c.executemany('UPDATE listings SET content_hash = ? WHERE id = ?',
+                               [(listing.content_hash, listing.id) for listing in listings])
+            return
+        self.c.executemany('UPDATE listings SET fingerprint = ?, title = ?, summary = ?, '
+                           'link = ?, image = ?, previous_price = price, price = ?, '
+                           'posted = ?, year = ?, miles = ?, content_hash = ?, updated = ? '
+                           'WHERE id = ?',
+                           [(listing.fingerprint, listing.title, listing.summary, listing.link,
+                             listing.image, listing.price, listing.posted, listing.year,
+                             listing.miles, listing.content_hash, now, listing.id)
+                            for listing in listings])
+
+    def query_listings(self, search=None, limit=100, **filters):
+        """
+        Range query over every stored listing, newest first. Listings whose
+        title or summary did not give a value never match a filter on it.
+        :param search: string, RSS feed URL to restrict the results to
+        :param limit: int, maximum number of listings returned
+        :param filters: min_price, max_price, min_auto_year, max_auto_year,
+                        min_miles and/or max_miles
+        :return: list of Listing
+        """
+        clauses = []
+        params = []
+        for option, value in filters.items():
+            if value is None:
+                continue
+            if option not in self.listing_filters:
+                raise ValueError(f'Unknown filter "{option}"')
+            clauses.append(self.listing_filters[option])
+            params.append(int(value))
+        if search is not None:
+            clauses.append('id IN (SELECT id FROM posts WHERE search = ?)')
+            params.append(search)
+        clauses.append('title IS NOT NULL')
+        self.c.execute('SELECT id, title, summary, link, image, price, posted FROM listings '
+                       f'WHERE {" AND ".join(clauses)} '
+                       'ORDER BY first_seen DESC, rowid DESC LIMIT ?', [*params, limit])
+        return [Listing(*row) for row in self.c.fetchall()]
+
+    @staticmethod
+    def fts_query(terms):
+        """
+        :param terms: list of strings; each is matched as a phrase, all must match
+        :return: string, FTS5 query
+        """
+        phrases = [' '.join(term.split()) for term in terms]
+        return ' '.join('"{}"'.format(phrase.replace('"', '""')) for phrase in phrases if phrase)
+
+    def search_listings(self, terms, days=None, limit=50):
+        """
+        Full-text search over stored titles and summaries, best matches first.
+        :param terms: list of strings, words or phrases that must all appear
+        :param days: float, only listings first seen in the last this many days
+        :param limit: int, maximum number of listings returned
+        :return: list of Listing
+        """
+        query = self.fts_query(terms)
+        if not query:
+            return []
+        since = time() - days * 86400 if days is not None else 0
+        self.c.execute('SELECT l.id, l.title, l.summary, l.link, l.image, l.price, l.posted '
+                       'FROM listings_fts JOIN listings l ON l.rowid = listings_fts.rowid '
+                       'WHERE listings_fts MATCH ? AND l.first_seen >= ? '
+                       'ORDER BY listings_fts.rank LIMIT ?', (query, since, limit))
+        return [Listing(*row) for row in self.c.fetchall()]
+
+    def seen_ids(self, search, ids):
+        """
+        :param search: string, RSS feed URL
+        :param ids: iterable of listing ids
+        :return: set, the subset of ids already recorded for search
+        """
+        ids = list(ids)
+        seen = set()
+        for start in range(0, len(ids), self.max_params):
+            chunk = ids[start:start + self.max_params]
+            marks = ','.join('?' * len(chunk))
+            self.c.execute(f'SELECT id FROM posts WHERE search = ? AND id IN ({marks})',
+                           [search, *chunk])
+            seen.update(row[0] for row in self.c.fetchall())
+        return seen
+
+    def seen_listings(self, search, ids):
+        """
+        Like seen_ids, along with what the shared index holds for each id.
+        :param search: string, RSS feed URL
+        :param ids: iterable of listing ids
+        :return: dict, id already recorded for search to a 4-tuple of its
+                 (content_hash, price, previous_price, updated), Nones if
+                 it is not indexed
+        """
+        ids = list(ids)
+        seen = {}
+        for start in range(0, len(ids), self.max_params):
+            chunk = ids[start:start + self.max_params]
+            marks = ','.join('?' * len(chunk))
+            self.c.execute('SELECT p.id, l.content_hash, l.price, l.previous_price, l.updated '
+                           'FROM posts p LEFT JOIN listings l ON l.id = p.id '
+                           f'WHERE p.search = ? AND p.id IN ({marks})', [search, *chunk])
+            seen.update((row[0], row[1:]) for row in self.c.fetchall())
+        return seen
+
+    def validators(self, search):
+        """
+        :param search: string, RSS feed URL
+        :return: 2-tuple, (etag, modified) from the last full fetch, or Nones
+        """
+        self.c.execute('SELECT etag, modified FROM feeds WHERE search = ?', (search,))
+        row = self.c.fetchone()
+        return row if row is not None else (None, None)
+
+    def record_poll(self, search, etag=None, modified=None, unchanged=False, size=0,
+                    now=None):
+        """
+        :param search: string, RSS feed URL
+        :param etag: string, ETag of the fetched body; ignored when unchanged
+        :param modified: string, Last-Modified of the fetched body; ignored when unchanged
+        :param unchanged: boolean, True if the server answered 304 Not Modified
+        :param size: int, bytes downloaded, when known
+        :param now: float, unix time of the poll; defaults to the current time
+        """
+        now = time() if now is None else now
+        if unchanged:
+            self.c.execute('INSERT INTO feeds (search, polls, unchanged, polled) '
+                           'VALUES (?,1,1,?) ON CONFLICT(search) DO UPDATE SET '
+                           'polls = polls + 1, unchanged = unchanged + 1, '
+                           'polled = excluded.polled', (search, now))
+        else:
+            self.c.execute('INSERT INTO feeds (search, etag, modified, polls, bytes, polled) '
+                           'VALUES (?,?,?,1,?,?) ON CONFLICT(search) DO UPDATE SET '
+                           'etag = excluded.etag, modified = excluded.modified, '
+                           'polls = polls + 1, bytes = bytes + excluded.bytes, '
+                           'polled = excluded.polled',
+                           (search, etag, modified, size, now))
+
+    def last_polled(self, search):
+        """
+        :param search: string, RSS feed URL
+        :return: float, unix time of its last recorded poll, or None
+        """
+        self.c.execute('SELECT polled FROM feeds WHERE search = ?', (search,))
+        row = self.c.fetchone()
+        return row[0] if row is not None else None
+
+    def add_subscriptions(self, subscriptions):
+        """
+        Registers saved searches, creating or renaming their subscribers.
+        :param subscriptions: iterable of 5-tuples, (user, email, canonical
+                              feed URL, search name, search as JSON); a None
+                              user keeps the subscriber's current name
+        :return: int, subscriptions not registered before
+        """
+        subscriptions = list(subscriptions)
+        users = {}
+        for user, email, _, _, _ in subscriptions:
+            if user or email not in users:
+                users[email] = user
+        self.c.executemany('INSERT INTO subscribers (user, email) VALUES (?,?) '
+                           'ON CONFLICT(email) DO UPDATE SET '
+                           'user = COALESCE(excluded.user, user)',
+                           [(user, email) for email, user in users.items()])
+        ids = {}
+        emails = list(users)
+        for start in range(0, len(emails), self.max_params):
+            chunk = emails[start:start + self.max_params]
+            marks = ','.join('?' * len(chunk))
+            self.c.execute(f'SELECT email, id FROM subscribers WHERE email IN ({marks})', chunk)
+            ids.update(self.c.fetchall())
+        before = self.conn.total_changes
+        self.c.executemany('INSERT OR IGNORE INTO subscriptions (url, subscriber, name, search) '
+                           'VALUES (?,?,?,?)',
+                           [(url, ids[email], name, search)
+                            for _, email, url, name, search in subscriptions])
+        return self.conn.total_changes - before
+
+    def remove_subscriber(self, email):
+        """
+        :param email: string
+        :return: int, subscriptions removed along with the subscriber
+        """
+        self.c.execute('DELETE FROM subscriptions WHERE subscriber IN '
+                       '(SELECT id FROM subscribers WHERE email = ?)', (email,))
+        removed = self.c.rowcount
+        self.c.execute('DELETE FROM subscribers WHERE email = ?', (email,))
+        return removed
+
+    @staticmethod
+    def delivery_keys(listing):
+        """
+        :return: 3-tuple of strings a delivery of listing is recorded under;
+                 the fingerprint is None for a listing without a price
+        """
+        return listing.id, listing.fingerprint, f'{listing.id}#{listing.content_hash}'
+
+    def undelivered(self, email, listings):
+        """
+        :param email: string, recipient
+        :param listings: list of Listing
+        :return: list of Listing not sent to email before: new listings whose
+                 id and fingerprint were never sent, edits whose content was not
+        """
+        keys = [self.delivery_keys(listing) for listing in listings]
+        wanted = [key for found in keys for key in found if key is not None]
+        delivered = set()
+        for start in range(0, len(wanted), self.max_params - 1):
+            chunk = wanted[start:start + self.max_params - 1]
+            marks = ','.join('?' * len(chunk))
+            self.c.execute(f'SELECT key FROM deliveries WHERE email = ? AND key IN ({marks})',
+                           [email, *chunk])
+            delivered.update(row[0] for row in self.c.fetchall())
+        kept = []
+        for listing, (id_key, fingerprint, content) in zip(listings, keys):
+            if listing.status == 'new':
+                if id_key not in delivered and fingerprint not in delivered:
+                    kept.append(listing)
+            elif content not in delivered:
+                kept.append(listing)
+        return kept
+
+    def record_deliveries(self, email, listings, now=None):
+        """
+        :param email: string, recipient
+        :param listings: list of Listing sent to email
+        """
+        now = time() if now is None else now
+        self.c.executemany('INSERT OR REPLACE INTO deliveries (email, key, delivered) '
+                           'VALUES (?,?,?)',
+                           [(email, key, now) for listing in listings
+                            for key in self.delivery_keys(listing) if key is not None])
+
+    def subscriptions(self, urls=None):
+        """
+        :param urls: iterable of canonical feed URLs; None reads every subscription
+        :return: dict, feed URL to a list of (search name, user, email); the
+                 user defaults to the email address
+        """
+        query = 'SELECT s.url, s.name, COALESCE(u.user, u.email), u.email ' \
+                'FROM subscriptions s JOIN subscribers u ON u.id = s.subscriber'
+        if urls is None:
+            rows = self.c.execute(query).fetchall()
+        else:
+            urls = list(urls)
+            rows = []
+            for start in range(0, len(urls), self.max_params):
+                chunk = urls[start:start + self.max_params]
+                marks = ','.join('?' * len(chunk))
+                rows += self.c.execute(f'{query} WHERE s.url IN ({marks})', chunk).fetchall()
+        found = {}
+        for url, name, user, email in rows:
+            found.setdefault(url, []).append((name, user, email))
+        return found
 
-    def insert_entry(self, id_num, url):
-        self.c.execute('INSERT INTO posts VALUES (?,?,?)',
-                       (id_num, False, url),)
+    def poll_stats(self, search=None):
+        """
+        :param search: string, RSS feed URL; None totals every feed
+        :return: dict, poll counts, conditional hit rate and estimated bytes saved
+        """
+        query = 'SELECT COALESCE(SUM(polls), 0), COALESCE(SUM(unchanged), 0), ' \
+                'COALESCE(SUM(bytes), 0) FROM feeds'
+        if search is None:
+            self.c.execute(query)
+        else:
+            self.c.execute(f'{query} WHERE search = ?', (search,))
+        polls, unchanged, size = self.c.fetchone()
+        fetched = polls - unchanged
+        return {
+            'polls': polls,
+            'unchanged': unchanged,
+            'hit_rate': unchanged / polls if polls else 0.0,
+            'bytes': size,
+            'bytes_saved': unchanged * size // fetched if fetched else 0,
+        }
+
+    # Clears everything but id, fingerprint, content_hash and first_seen, which
+    # are all resolve and seen_listings need to keep a listing from being
+    # delivered again
+    tombstone = 'UPDATE listings SET title = NULL, summary = NULL, link = NULL, image = NULL, ' \
+                'price = NULL, posted = NULL, year = NULL, miles = NULL, previous_price = NULL '
+
+    def expire_listings(self, max_age, limit=500, ages=None, now=None):
+        """
+        Turns listings older than their retention into tombstones, oldest
+        first. A listing is kept as long as any search it was delivered
+        through wants it.
+        :param max_age: float, seconds a listing is kept by default
+        :param limit: int, most listings handled in this call
+        :param ages: dict, RSS feed URL to seconds, for searches kept longer or shorter
+        :param now: float, unix time; defaults to the current time
+        :return: int, number of listings tombstoned
+        """
+        now = time() if now is None else now
+        ages = ages or {}
+        self.c.execute('CREATE TEMP TABLE IF NOT EXISTS retention '
+                       '(search text PRIMARY KEY, age REAL)')
+        self.c.execute('DELETE FROM temp.retention')
+        self.c.executemany('INSERT INTO temp.retention (search, age) VALUES (?,?)', ages.items())
+        self.c.execute(self.tombstone + 'WHERE rowid IN ('
+                       'SELECT l.rowid FROM listings l '
+                       'WHERE l.title IS NOT NULL AND l.first_seen < :earliest '
+                       'AND l.first_seen < :now - COALESCE((SELECT MAX(COALESCE(r.age, :age)) '
+                       'FROM posts p LEFT JOIN temp.retention r ON r.search = p.search '
+                       'WHERE p.id = l.id), :age) '
+                       'ORDER BY l.first_seen LIMIT :limit)',
+                       {'earliest': now - min([max_age, *ages.values()]), 'now': now,
+                        'age': max_age, 'limit': limit})
+        return self.c.rowcount
+
+    def cap_listings(self, max_entries, limit=500):
+        """
+        Tombstones the oldest listings beyond the newest max_entries.
+        :return: int, number of listings tombstoned
+        """
+        self.c.execute(self.tombstone + 'WHERE rowid IN ('
+                       'SELECT rowid FROM listings WHERE title IS NOT NULL '
+                       'ORDER BY first_seen DESC, rowid DESC LIMIT ? OFFSET ?)',
+                       (limit, max_entries))
+        return self.c.rowcount
+
+    def drop_tombstones(self, before, limit=500):
+        """
+        Deletes tombstones, and the posts rows for them, once a listing that
+        old can no longer show up in a feed.
+        :param before: float, unix time; tombstones first seen earlier are deleted
+        :param limit: int, most tombstones deleted in this call
+        :return: int, number of tombstones deleted
+        """
+        self.c.execute('SELECT rowid, id FROM listings WHERE title IS NULL AND first_seen < ? '
+                       'ORDER BY first_seen LIMIT ?', (before, limit))
+        rows = self.c.fetchall()
+        for start in range(0, len(rows), self.max_params):
+            chunk = rows[start:start + self.max_params]
+            marks = ','.join('?' * len(chunk))
+            self.c.execute(f'DELETE FROM posts WHERE id IN ({marks})', [row[1] for row in chunk])
+            self.c.execute(f'DELETE FROM listings WHERE rowid IN ({marks})',
+                           [row[0] for row in chunk])
+        return len(rows)
+
+    def drop_deliveries(self, before, limit=500):
+        """
+        Forgets what recipients were sent once it is as old as a tombstone.
+        :param before: float, unix time; deliveries made earlier are deleted
+        :param limit: int, most rows deleted in this call
+        :return: int, number of rows deleted
+        """
+        self.c.execute('DELETE FROM deliveries WHERE rowid IN (SELECT rowid FROM deliveries '
+                       'WHERE delivered < ? LIMIT ?)', (before, limit))
+        return self.c.rowcount
+
+    def file_stats(self):
+        """
+        :return: dict, size of the file and its WAL in bytes, and how much of
+                 the file a VACUUM would give back: free pages plus, where
+                 sqlite has the dbstat table, unused space in used pages
+        """
+        page_size = self.c.execute('PRAGMA page_size').fetchone()[0]
+        page_count = self.c.execute('PRAGMA page_count').fetchone()[0]
+        free = self.c.execute('PRAGMA freelist_count').fetchone()[0] * page_size
+        try:
+            # Tombstones leave pages partly empty rather than free
+            free += self.c.execute('SELECT COALESCE(SUM(unused), 0) FROM dbstat').fetchone()[0]
+        except sqlite3.OperationalError:
+            pass
+        size = 0
+        for file in (self.database, f'{self.database}-wal'):
+            if path.isfile(file):
+                size += stat(file).st_size
+        total = page_count * page_size
+        return {
+            'bytes': size,
+            'reclaimable': free,
+            'fragmentation': free / total if total else 0.0,
+        }
+
+    def vacuum(self):
+        """
+        Rewrites the file without its free pages. Raises sqlite3.OperationalError
+        if another connection is still writing after the busy timeout; VACUUM
+        may renumber listings, so the full-text index is rebuilt.
+        :return: int, bytes reclaimed
+        """
+        self.conn.commit()
+        self.c.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        before = self.file_stats()['bytes']
+        self.c.execute('VACUUM')
+        self.lock()
+        self.c.execute("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')")
+        self.conn.commit()
+        self.c.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return before - self.file_stats()['bytes']
+
+    def migrate_dict(self, dict_file, search):
+        """
+        One-shot import of a legacy pickled feed_dict; the file is renamed
+        afterwards so it is never read again.
+        :param dict_file: string, path to a pickled dict file
+        :param search: string, RSS feed URL the dict was built from
+        :return: int, number of listings imported
+        """
+        if not path.isfile(dict_file):
+            return 0
+        with open(dict_file, 'rb') as file:
+            feed_dict = pickle.load(file)
+        listings = [Listing.from_entry(dict(listing, id=id_num))
+                    for id_num, listing in feed_dict.items()]
+        self.insert_entries(search, listings)
+        self.index_listings(listings)
+        self.conn.commit()
+        rename(dict_file, f'{dict_file}.migrated')
+        return len(feed_dict)
 
 
 class Feed:
-    def __init__(self, url, dict_file):
+    rdf_about = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about'
+    chunk_size = 16384
+
+    def __init__(self, url, database, streaming=False, stop_after=3, db=None):
         """
         :param url: string, RSS feed URL
-        :param dict_file: string, path to a pickled dict file.
+        :param database: string, path to sqlite db file holding seen listings
+        :param streaming: boolean, parse incrementally and stop at known listings
+                          instead of building the full feedparser result
+        :param stop_after: int, consecutive known listings that end a streaming parse
+        :param db: Database, connection shared by a whole poll cycle; its owner
+                   commits, so the cycle's writes land in one transaction
         """
         self.url = url
-        self.dict_file = dict_file
-        self.feed_dict = self.load_dict()
+        self.database = database
+        self.streaming = streaming
+        self.stop_after = stop_after
+        self.db = db
+        # Why the last refresh_feed returned None without polling, if it failed
+        self.error = None
 
     def __repr__(self):
         return f'Feed({self.url})'
@@ -75,51 +835,373 @@ class Feed:
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
-    def load_dict(self):
-        files = [path.join(path.dirname(__file__), item) for item in
-                 listdir(path.dirname(__file__))]
-        if self.dict_file not in files:
-            return {}
-        else:
-            with open(self.dict_file, 'rb') as file:
-                return pickle.load(file)
+    @staticmethod
+    def parse(document):
+        """
+        :param document: string or bytes, RSS feed URL or an already fetched body
+        :return: list of dicts of CL postings
+        :raises ParseError: if the document is not a feed, e.g. a block page;
+                            feedparser only flags it as bozo
+        """
+        import feedparser
+        result = feedparser.parse(document)
+        if result.get('bozo') and not result['entries']:
+            raise ParseError(f'Not an RSS feed: {result.get("bozo_exception")}')
+        return result['entries']
+
+    @classmethod
+    def stream(cls, document, known=None, stop_after=3):
+        """
+        Incrementally parses a newest-first RSS body, keeping only the fields
+        the templates use. Stops once stop_after consecutive items are known.
+        :param document: bytes, RSS feed body
+        :param known: callable, takes a listing id and returns True if seen
+        :param stop_after: int, length of the run of known ids that ends the parse
+        :return: generator of dicts of CL postings
+        """
+        parser = XMLPullParser(events=('end',))
+        run = 0
+        for start in range(0, len(document), cls.chunk_size):
+            parser.feed(document[start:start + cls.chunk_size])
+            for _, element in parser.read_events():
+                if element.tag.rpartition('}')[2] != 'item':
+                    continue
+                listing = cls.element_listing(element)
+                element.clear()
+                if known is not None and known(listing['id']):
+                    run += 1
+                    if run >= stop_after:
+                        return
+                else:
+                    run = 0
+                yield listing
+
+    @classmethod
+    def element_listing(cls, element):
+        listing = {}
+        for child in element:
+            tag = child.tag.rpartition('}')[2]
+            if tag in ('title', 'link'):
+                listing[tag] = child.text or ''
+            elif tag == 'description':
+                listing['summary'] = child.text or ''
+            elif tag == 'date':
+                listing['published'] = child.text
+            elif tag == 'enclosure':
+                listing['enc_enclosure'] = {'resource': child.get('resource', child.get('url')),
+                                            'type': child.get('type')}
+        listing.setdefault('title', '')
+        listing.setdefault('summary', '')
+        listing['id'] = element.get(cls.rdf_about) or listing.get('link')
+        return listing
+
+    def stream_new(self, document):
+        """
+        :param document: bytes, RSS feed body
+        :return: list of listings up to the first run of already seen ones
+        """
+        with Database(self.database) as db:
+            return list(self.stream(document,
+                                    lambda id_num: bool(db.seen_ids(self.url, [id_num])),
+                                    self.stop_after))
 
-    def save_dict(self):
-        with open(self.dict_file, 'wb') as file:
-            pickle.dump(self.feed_dict, file)
+    def fetch(self, etag=None, modified=None):
+        """
+        :return: 4-tuple, (status, body, etag, modified); body is None on a 304
+        """
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if modified is not None:
+            headers['If-Modified-Since'] = modified
+        try:
+            with urlopen(Request(self.url, headers=headers), timeout=30) as response:
+                return (response.status, response.read(), response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'))
+        except HTTPError as exc:
+            if exc.code == 304:
+                return 304, None, etag, modified
+            raise
 
     def refresh_feed(self):
-        new_items = []
-        listings = fp.parse(self.url)['entries']
-        for listing in listings:
-            if listing['id'] not in self.feed_dict:
-                if '&#x0024;' in listing['title']:
-                    listing['title'] = listing['title'].replace('&#x0024;', '$')
-                if '&#x0024;' in listing['summary']:
-                    listing['summary'] = listing['summary'].replace('&#x0024;', '$')
-                self.feed_dict[listing['id']] = listing
-                new_items.append(listing)
-        self.save_dict()
+        """
+        Fetches the feed conditionally; a 304 Not Modified skips parsing.
+        :return: list of new listings, or None; error is set if the fetch or
+                 parse failed, and the poll is not recorded
+        """
+        self.error = None
+        etag, modified = self.validators()
+        try:
+            with METRICS.stage('fetch', self.url):
+                status, body, etag, modified = self.fetch(etag, modified)
+            if status == 304:
+                self.unchanged()
+                return None
+            METRICS.count('fetch_bytes', len(body), self.url)
+            with METRICS.stage('parse', self.url):
+                listings = self.stream_new(body) if self.streaming else self.parse(body)
+        except (OSError, ParseError) as exc:
+            # URLError and timeouts are OSErrors; a 200 that is not XML is a
+            # ParseError. Either way the stored validators stay as they were
+            self.error = exc
+            print(f'Failed to refresh {self.url}: {exc}')
+            return None
+        new_items = self.diff(listings, etag, modified, len(body))
         if len(new_items) > 0:
             return new_items
         else:
             return None
 
+    def store(self):
+        """
+        :return: context manager giving the shared Database, or a connection
+                 of its own that commits on exit
+        """
+        return nullcontext(self.db) if self.db is not None else Database(self.database)
+
+    def validators(self):
+        with self.store() as db:
+            return db.validators(self.url)
+
+    def unchanged(self):
+        with self.store() as db:
+            db.record_poll(self.url, unchanged=True)
+
+    def diff(self, listings, etag=None, modified=None, size=0, since=None):
+        """
+        Records unseen listings and edits to seen ones, along with the
+        validators of the fetch that produced them, and returns them
+        normalized. Edits are told apart by content_hash in the same pass.
+        :param listings: list of dicts of CL postings, from parse or stream
+        :param etag: string, ETag header of the fetched feed
+        :param modified: string, Last-Modified header of the fetched feed
+        :param size: int, bytes downloaded, when known
+        :param since: float, start of the poll cycle; listings another search or
+                      an earlier post delivered before then are dropped, and
+                      edits another search stored since then are kept. None
+                      keeps every listing new to this feed, and the edits
+                      stored since its last poll, for a Dispatcher that
+                      tracks deliveries per recipient
+        :return: list of Listing, new for this feed or with a status of
+                 changed or price_drop
+        """
+        new_items = []
+        changed = []
+        edited = []
+        unhashed = []
+        now = time()
+        with METRICS.stage('store', self.url), self.store() as db:
+            seen = db.seen_listings(self.url, [entry['id'] for entry in listings])
+            last = db.last_polled(self.url) if since is None else None
+            handled = set()
+            for entry in listings:
+                if entry['id'] in handled:
+                    continue
+                handled.add(entry['id'])
+                listing = Listing.from_entry(entry)
+                if entry['id'] not in seen:
+                    new_items.append(listing)
+                    continue
+                content_hash, price, previous_price, updated = seen[entry['id']]
+                if content_hash is None:
+                    # Indexed before content hashes were stored, or a repost
+                    # from before reposts were indexed; stored as a baseline
+                    unhashed.append(listing)
+                    continue
+                if content_hash != listing.content_hash:
+                    listing.previous_price = price
+                    edited.append(listing)
+                elif updated is not None and (updated >= since if since is not None else
+                                              last is not None and updated > last):
+                    # Edited this cycle, or since this feed's last poll, and
+                    # stored by another search first
+                    listing.previous_price = previous_price
+                else:
+                    continue
+                dropped = None not in (listing.price, listing.previous_price) and \
+                    listing.price < listing.previous_price
+                listing.status = 'price_drop' if dropped else 'changed'
+                changed.append(listing)
+            db.insert_entries(self.url, new_items)
+            new_items = db.index_listings(new_items, since)
+            db.update_listings(edited, now)
+            db.index_listings(unhashed)
+            db.update_listings(unhashed)
+            db.record_poll(self.url, etag, modified, size=size, now=now)
+        METRICS.count('new_items', len(new_items), self.url)
+        if changed:
+            METRICS.count('changed_items', len(changed), self.url)
+        return new_items + changed
+
+
+class Renderer:
+    _shared = None
+    headings = {
+        'new': 'New listings',
+        'price_drop': 'Price drops',
+        'changed': 'Updated listings',
+    }
+    # Stands in for the matched searches line, which differs per recipient
+    slot = '\x00matched\x00'
+
+    def __init__(self, bytecode_dir=None, max_fragments=4096):
+        """
+        Loads and compiles the email templates once; rendering afterwards is
+        a pure function of (user, listings) and safe to call from any thread.
+        Each listing is rendered once per format into a bounded LRU cache of
+        fragments, which digests are assembled from, so a listing sent to
+        many recipients costs one render rather than one per digest.
+        :param bytecode_dir: string, directory for Jinja's on-disk bytecode cache
+        :param max_fragments: int, most rendered listings kept
+        """
+        from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader, select_autoescape
+        self.bytecode_dir = bytecode_dir
+        self.max_fragments = max_fragments
+        cache = FileSystemBytecodeCache(bytecode_dir) if bytecode_dir else None
+        html_env = Environment(
+            loader=PackageLoader('classes', 'templates'),
+            autoescape=select_autoescape(['html', 'xml']),
+            bytecode_cache=cache
+        )
+        text_env = Environment(
+            loader=PackageLoader('classes', 'templates'),
+            autoescape=select_autoescape(['.txt']),
+            bytecode_cache=cache
+        )
+        self.html_template = html_env.get_template('base.html')
+        self.text_template = text_env.get_template('base.txt')
+        self.listing_templates = {'html': html_env.get_template('_listing.html'),
+                                  'text': text_env.get_template('_listing.txt')}
+        self.matched_templates = {'html': html_env.get_template('_matched.html'),
+                                  'text': text_env.get_template('_matched.txt')}
+        self.fragments = OrderedDict()
+        self.lock = Lock()
+
+    def __repr__(self):
+        return f'Renderer({self.bytecode_dir})'
+
+    @classmethod
+    def shared(cls):
+        """
+        :return: Renderer, built on first use and reused for the whole process
+        """
+        if cls._shared is None:
+            cls._shared = cls(getattr(config(), 'template_cache', None))
+        return cls._shared
+
+    @staticmethod
+    def sections(listings):
+        """
+        Groups listings into digest sections by status. A digest of new
+        listings only has a single untitled section.
+        :param listings: list of Listing
+        :return: list of 2-tuples, (heading or None, list of Listing)
+        """
+        groups = {status: [] for status in Listing.statuses}
+        for listing in listings:
+            groups[listing.status].append(listing)
+        if len(groups['new']) == len(listings):
+            return [(None, listings)]
+        return [(Renderer.headings[status], groups[status])
+                for status in Listing.statuses if groups[status]]
+
+    def cached(self, key, render):
+        """
+        :param key: tuple, identifies the fragment
+        :param render: callable returning the fragment on a miss
+        """
+        with self.lock:
+            found = self.fragments.get(key)
+            if found is not None:
+                self.fragments.move_to_end(key)
+        if found is not None:
+            METRICS.count('fragment_cache_hits', 1)
+            return found
+        METRICS.count('fragment_cache_misses', 1)
+        found = render()
+        with self.lock:
+            self.fragments[key] = found
+            while len(self.fragments) > self.max_fragments:
+                self.fragments.popitem(last=False)
+                METRICS.count('fragment_cache_evictions', 1)
+        return found
+
+    def fragment(self, kind, listing, src=None):
+        """
+        :param kind: string, html or text
+        :param listing: Listing
+        :param src: string, image src for the html fragment
+        :return: 2-tuple of strings, the listing before and after its matched line
+        """
+        # The fields content_hash is computed from, which hash faster than it
+        from markupsafe import Markup
+        key = (kind, listing.id, listing.title, listing.summary, listing.price,
+               listing.link, listing.status, listing.previous_price, src)
+        return self.cached(key, lambda: tuple(self.listing_templates[kind].render(
+            listing=listing, src=src, slot=Markup(self.slot)).split(self.slot)))
+
+    def assemble(self, kind, listings, matched=None, images=None):
+        """
+        :return: list of 2-tuples, (heading or None, Markup of its listings)
+        """
+        from markupsafe import Markup
+        sections = []
+        for heading, items in self.sections(listings):
+            parts = []
+            for listing in items:
+                src = None
+                if kind == 'html' and listing.image:
+                    src = images.get(listing.image, listing.image) if images else listing.image
+                head, tail = self.fragment(kind, listing, src)
+                searches = tuple(matched.get(listing.id) or ()) if matched else ()
+                line = self.cached((kind, searches), lambda: self.matched_templates[kind].render(
+                    searches=searches)) if searches else ''
+                parts += (head, line, tail)
+            sections.append((heading, Markup(''.join(parts))))
+        return sections
+
+    def render_html(self, user, listings, matched=None, images=None):
+        """
+        :param images: dict, image URL to the src to use instead, e.g. a cid: URL
+        """
+        return self.html_template.render(
+            user=user, sections=self.assemble('html', listings, matched, images))
+
+    def render_text(self, user, listings, matched=None):
+        return self.text_template.render(
+            user=user, sections=self.assemble('text', listings, matched))
+
 
 class Message:
 
-    def __init__(self, user, email_address, listings):
+    def __init__(self, user, email_address, listings, send=True, matched=None,
+                 thumbnails=None):
         """
         :param user: user's name
         :param email_address: string
-        :param listings: list of dicts of CL postings
+        :param listings: list of Listing
+        :param send: boolean, send the email straight away over its own connection
+        :param matched: dict, listing id to the names of the searches it matched
+        :param thumbnails: thumbnails.Thumbnails; images it has cached are
+                           attached and referenced by Content-ID
         """
         self.user = user
         self.email_address = email_address
         self.listings = listings
+        self.matched = matched
+        self.thumbnails = thumbnails
+        self.images = {}
+        if thumbnails is not None:
+            for listing in listings:
+                found = thumbnails.get(listing.image) if listing.image else None
+                if found is not None:
+                    self.images[listing.image] = found
         self.text_message = self.render_text()
         self.html_message = self.render_html()
-        self.send_email()
+        if send:
+            self.send_email()
 
     def __repr__(self):
         return f'Message({self.email_address})'
@@ -134,28 +1216,19 @@ class Message:
         pass
 
     def render_html(self):
-        env = Environment(
-            loader=PackageLoader('classes', 'templates'),
-            autoescape=select_autoescape(['html', 'xml'])
-        )
-        template = env.get_template('base.html')
-        render = template.render(user=self.user, listings=self.listings)
-        return render
+        with METRICS.stage('render'):
+            cids = {url: f'cid:{digest}@carsearch' for url, (digest, _) in self.images.items()}
+            return Renderer.shared().render_html(self.user, self.listings, self.matched, cids)
 
     def render_text(self):
-        env = Environment(
-            loader=PackageLoader('classes', 'templates'),
-            autoescape=select_autoescape(['.txt'])
-        )
-        template = env.get_template('base.txt')
-        render = template.render(user=self.user, listings=self.listings)
-        return render
+        with METRICS.stage('render'):
+            return Renderer.shared().render_text(self.user, self.listings, self.matched)
 
-    def send_email(self):
+    def as_mime(self, sender):
+        from email.mime.image import MIMEImage
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
         msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Craigslist Post Matches'
-        msg['From'] = Config.sender
-        msg['To'] = self.email_address
 
         text = MIMEText(self.text_message, 'plain')
         msg.attach(text)
@@ -163,226 +1236,191 @@ class Message:
         html = MIMEText(self.html_message, 'html')
         msg.attach(html)
 
-        server = smtplib.SMTP(host='smtp.gmail.com', port=587)
-        server.starttls()
-        server.login(user=Config.sender, password=Config.pwd)
-        server.sendmail(Config.sender, self.email_address, msg.as_string())
-        server.quit()
+        if self.images:
+            body, msg = msg, MIMEMultipart('related')
+            msg.attach(body)
+            for digest, subtype in dict(self.images.values()).items():
+                image = MIMEImage(self.thumbnails.read(digest), subtype)
+                image['Content-ID'] = f'<{digest}@carsearch>'
+                image.add_header('Content-Disposition', 'inline', filename=f'{digest}.{subtype}')
+                msg.attach(image)
 
+        msg['Subject'] = 'Craigslist Post Matches'
+        msg['From'] = sender
+        msg['To'] = self.email_address
+        return msg
 
-class Url:
-
-    def __init__(self, city, category, search_term=None):
+    def send_email(self, mailer=None):
         """
-        :param city: string, city / geographical area for craigslist.
-        # TODO add in validation for cities (Dict of all NA CL cities?)
-        :param category: string, for sale category abbreviation
-        # TODO validate categories as well
+        :param mailer: Mailer, open session to reuse; a one-off one is used if None
         """
-        # assert(city is not None and city.strip() != '')
-        # assert(category is not None and category.strip() != '')
-        # assert(search_term is not None)
-
-        self.city = city.replace(' ', '')
-        self.category = category.strip()
-        if search_term is not None:
-            self.search_term = '+'.join(search_term.split())
+        if mailer is not None:
+            mailer.send(self.email_address, self.as_mime(mailer.sender))
         else:
-            self.search_term = None
-
-        self.url = f'https://{city}.craigslist.org/search/{category}?' \
-                   f'format=rss&searchNearby=1'
-
-    def __repr__(self):
-        return f'Url({self.city}, {self.category}, {self.search_term})'
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+            with Mailer() as mailer:
+                mailer.send(self.email_address, self.as_mime(mailer.sender))
 
 
-class Vehicle:
+class Mailer:
 
-    def __init__(self, city, category, options, term=None):
+    def __init__(self, host=None, port=None, sender=None, password=None,
+                 starttls=None, max_messages=100):
         """
-        :param city: string, city / geographical area for craigslist.
-        :param category: string, for sale category abbreviation
-        :param term: string, item for which user is searching
-        :param options: list, search parameters
+        Keeps one authenticated SMTP session open across messages. Unset
+        arguments fall back to Config, then to gmail's submission server.
+        :param host: string, SMTP server
+        :param port: int, SMTP port
+        :param sender: string, From address and login user
+        :param password: string, login password; no login if empty
+        :param starttls: boolean, upgrade the connection with STARTTLS
+        :param max_messages: int, messages sent before the session is recycled
         """
-        self.city = city.replace(' ', '')
-        self.category = category
-        self.options = options
-        self.term = self.search_parser(term)
-        self.base_url = f'https://{self.city}.craigslist.org/search/' \
-                        f'{self.category}?format=rss&searchNearby=1'
-        self.url = self.url_parser()
+        settings = config()
+        self.host = host or getattr(settings, 'smtp_host', 'smtp.gmail.com')
+        self.port = port or getattr(settings, 'smtp_port', 587)
+        self.sender = sender or settings.sender
+        self.password = password if password is not None else settings.pwd
+        self.starttls = starttls if starttls is not None else \
+            getattr(settings, 'smtp_starttls', True)
+        self.max_messages = max_messages
+        self.server = None
+        self.sent = 0
+        self.connections = 0
 
     def __repr__(self):
-        return f'Vehicle({self.city}, {self.category}, {self.options}, {self.term})'
+        return f'Mailer({self.host}, {self.port})'
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self.close()
 
-    @property
-    def get_url(self):
-        return self.url
+    def connect(self):
+        import smtplib
+        server = smtplib.SMTP(host=self.host, port=self.port)
+        if self.starttls:
+            server.starttls()
+        if self.password:
+            server.login(user=self.sender, password=self.password)
+        self.server = server
+        self.sent = 0
+        self.connections += 1
 
-    @staticmethod
-    def search_parser(term):
-        if term is None:
-            return
-        else:
-            return '+'.join(term.split())
-
-    def url_parser(self):
-        if len(self.options) > 0:
-            url = '&'.join([self.base_url, '&'.join(self.options)])
-        else:
-            url = self.base_url
-
-        if self.term is not None:
-            return f'{url}&auto_make_model={self.term}'
-        else:
-            return url
+    def close(self):
+        import smtplib
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self.server = None
 
+    def send(self, email_address, msg):
+        """
+        :param email_address: string, recipient
+        :param msg: email.message.Message
+        """
+        import smtplib
+        with METRICS.stage('send'):
+            if self.server is None or self.sent >= self.max_messages:
+                self.close()
+                self.connect()
+            try:
+                self.server.sendmail(self.sender, email_address, msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                self.server = None
+                self.connect()
+                self.server.sendmail(self.sender, email_address, msg.as_string())
+        self.sent += 1
 
-class VehicleOptions:
-    flat_static = {
-        'crypto': 'crypto_currency_ok=1',
-        'posted_today': 'postToday=1',
-        'bundled_duplicates': 'bundleDuplicates=1',
-        'has_images': 'hasPic=1',
-        'titles_only': 'srchType=T',
-    }
-    nested_static = {
-        'condition': {
-            'new': 'condition=10',
-            'like new': 'condition=20',
-            'excellent': 'condition=30',
-            'good': 'condition=40',
-            'fair': 'condition=50',
-            'salvage': 'condition=60'},
-        'cylinders': {
-            '3': 'auto_cylinders=1',
-            '4': 'auto_cylinders=2',
-            '5': 'auto_cylinders=3',
-            '6': 'auto_cylinders=4',
-            '8': 'auto_cylinders=5',
-            '10': 'auto_cylinders=6',
-            '12': 'auto_cylinders=7',
-            'other': 'auto_cylinders=8'},
-        'drive': {
-            'fwd': 'auto_drivetrain=1',
-            'rwd': 'auto_drivetrain=2',
-            '4wd': 'auto_drivetrain=3'},
-        'fuel': {
-            'gas': 'auto_fuel_type=1',
-            'diesel': 'auto_fuel_type=2',
-            'hybrid': 'auto_fuel_type=3',
-            'electric': 'auto_fuel_type=4',
-            'other': 'auto_fuel_type=6'},
-        'color': {
-            'black': 'auto_paint=1',
-            'blue': 'auto_paint=2',
-            'brown': 'auto_paint=20',
-            'green': 'auto_paint=3',
-            'grey': 'auto_paint=4',
-            'orange': 'auto_paint=5',
-            'purple': 'auto_paint=6',
-            'red': 'auto_paint=7',
-            'silver': 'auto_paint=8',
-            'white': 'auto_paint=9',
-            'yellow': 'auto_paint=10',
-            'custom': 'auto_paint=11'},
-        'size': {
-            'compact': 'auto_size=1',
-            'full-size': 'auto_size=2',
-            'mid-size': 'auto_size=3',
-            'sub-compact': 'auto_size=4'},
-        'title-status': {
-            'clean': 'auto_title_status=1',
-            'salvage': 'auto_title_status=2',
-            'rebuilt': 'auto_title_status=3',
-            'parts-only': 'auto_title_status=4',
-            'lien': 'auto_title_status=5',
-            'missing': 'auto_title_status=6'},
-        'transmission': {
-            'manual': 'auto_transmission=1',
-            'automatic': 'auto_transmission=2',
-            'other': 'auto_transmission=3'},
-        'type': {
-            'bus': 'auto_bodytype=1',
-            'convertible': 'auto_bodytype=2',
-            'coupe': 'auto_bodytype=3',
-            'hatchback': 'auto_bodytype=4',
-            'mini-van': 'auto_bodytype=5',
-            'offroad': 'auto_bodytype=6',
-            'pickup': 'auto_bodytype=7',
-            'sedan': 'auto_bodytype=8',
-            'truck': 'auto_bodytype=9',
-            'SUV': 'auto_bodytype=10',
-            'wagon': 'auto_bodytype=11',
-            'van': 'auto_bodytype=12',
-            'other': 'auto_bodytype=13'},
 
-    }
-    var_opt = {
-        'search_distance': 'search_distance',
-        'postal_code': 'postal',
-        'min_price': 'min_price',
-        'max_price': 'max_price',
-        'min_auto_year': 'min_auto_year',
-        'max_auto_year': 'max_auto_year',
-        'min_miles': 'min_auto_miles',
-        'max_miles': 'max_auto_miles'
-    }
+class Dispatcher:
 
-    def __init__(self, static, var):
+    def __init__(self, mailer, thumbnails=None, database=None):
         """
-        :param static: list of strings and 2-tuples, options whose value is static
-        :param var: list of 2-tuples, each list element is made of option
-                    and the variable option amount
+        Collects matches over a poll cycle and sends one digest per recipient,
+        each car listed once with every search it matched.
+        :param mailer: Mailer
+        :param thumbnails: thumbnails.Thumbnails, to inline listing images
+        :param database: string, path to sqlite db file keeping what each
+                         recipient was sent, so a car reaches every subscriber
+                         once, whichever of their searches finds it and when;
+                         pairs with a Poller with per_recipient set
         """
-        self.static = static
-        self.var = var
-        self.options = self.list_builder()
+        self.mailer = mailer
+        self.thumbnails = thumbnails
+        self.database = database
+        self.digests = {}
+        # Recipient to the exception their last digest failed with
+        self.failures = {}
 
-    @staticmethod
-    def opt_builder(option, amount):
-        return f'{option}={amount}'
+    def __repr__(self):
+        return f'Dispatcher({self.mailer})'
 
-    @property
-    def options_list(self):
-        return self.options
+    def __enter__(self):
+        return self
 
-    def list_builder(self):
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, user, email_address, listings, search=None):
         """
-        :return: list of search options
+        :param user: user's name
+        :param email_address: string
+        :param listings: list of Listing
+        :param search: string, name of the search the listings matched
         """
-        options = []
-        for option in self.static:
-            if option in self.flat_static:
-                options.append(self.flat_static[option])
+        user, matches, keys = self.digests.setdefault(email_address, (user, [], {}))
+        for listing in listings:
+            fingerprint = listing.fingerprint
+            match = keys.get(listing.id) or (fingerprint and keys.get(fingerprint))
+            if match is None:
+                match = (listing, [])
+                matches.append(match)
+                keys[listing.id] = match
+                if fingerprint is not None:
+                    keys[fingerprint] = match
+            if search is not None and search not in match[1]:
+                match[1].append(search)
 
-            else:
+    def flush(self):
+        """
+        Sends every digest; one the server refuses is logged and kept in
+        failures, and the rest are still sent.
+        :return: int, number of digests sent
+        """
+        import smtplib
+        digests, self.digests = self.digests, {}
+        self.failures = {}
+        if self.database is not None:
+            with Database(self.database) as db:
+                for email_address, (_, matches, _) in digests.items():
+                    kept = {id(listing) for listing in
+                            db.undelivered(email_address, [listing for listing, _ in matches])}
+                    matches[:] = [match for match in matches if id(match[0]) in kept]
+        if self.thumbnails is not None:
+            # Every image once, however many digests carry it
+            self.thumbnails.prefetch(listing.image for _, matches, _ in digests.values()
+                                     for listing, _ in matches)
+        sent = 0
+        delivered = {}
+        for email_address, (user, matches, _) in digests.items():
+            if len(matches) > 0:
+                listings = [listing for listing, _ in matches]
+                matched = {listing.id: searches for listing, searches in matches}
                 try:
-                    opt, value = option
-                    if opt in self.nested_static:
-                        options.append(self.nested_static[opt][value])
-                except ValueError:
-                    pass
-
-        for option in self.var:
-            try:
-                opt, amount = option
-                if opt in self.var_opt:
-                    options.append(self.opt_builder(opt, amount))
-            except ValueError:
-                pass
-        return options
+                    Message(user, email_address, listings, send=False, matched=matched,
+                            thumbnails=self.thumbnails).send_email(self.mailer)
+                except (smtplib.SMTPException, OSError) as exc:
+                    print(f'Failed to send {len(listings)} listings to {email_address}: {exc!r}')
+                    self.failures[email_address] = exc
+                    continue
+                delivered[email_address] = listings
+                sent += 1
+        if self.database is not None and delivered:
+            with Database(self.database) as db:
+                for email_address, listings in delivered.items():
+                    db.record_deliveries(email_address, listings)
+        return sent
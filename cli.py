@@ -1,22 +1,25 @@
 from argparse import ArgumentParser as Ag
+import json
+from os import path
+import sys
 
-from classes import Vehicle, VehicleOptions
+from catalog import Catalog, read_catalog
+from vehicles import Vehicle, VehicleOptions
 
+# Commands import what only they need, classes and atomic among them, so
+# building a URL loads neither sqlite3, feedparser, jinja2 nor config.py
 
-def main():
+
+DATABASE = path.join(path.dirname(path.abspath(__file__)), 'data.db')
+
+
+def build_url(argv=None):
     static = []
     var = []
     d1 = VehicleOptions.flat_static
     d2 = VehicleOptions.nested_static
     d3 = VehicleOptions.var_opt
-    d4 = {'motorcycle': {
-            'all': 'mca',
-            'dealer': 'mcd',
-            'owner': 'mco'},
-          'cage': {
-            'all': 'cta',
-            'dealer': 'ctd',
-            'owner': 'cto'}}
+    d4 = VehicleOptions.categories
     parser = Ag()
     parser.add_argument('city')
     parser.add_argument('vehicle_type')
@@ -30,7 +33,7 @@ def main():
     for option in d3:
         parser.add_argument(f'--{option}')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     city = args.city
     vehicle_type = args.vehicle_type
     seller_type = args.seller_type
@@ -57,5 +60,123 @@ def main():
     print(url)
 
 
+def query(argv=None):
+    from classes import Database
+    parser = Ag(prog='cli.py query', description='Filter listings already stored locally')
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--search', help='RSS feed URL to restrict results to')
+    parser.add_argument('--limit', type=int, default=50)
+    for option in Database.listing_filters:
+        parser.add_argument(f'--{option}', type=int)
+    args = parser.parse_args(argv)
+    filters = {option: getattr(args, option) for option in Database.listing_filters}
+    with Database(args.database) as db:
+        listings = db.query_listings(args.search, args.limit, **filters)
+    for listing in listings:
+        print(f'{listing.price or "":>8} {listing.year or "":>5} {listing.miles or "":>8} '
+              f'{listing.title}  {listing.link}')
+
+
+def search(argv=None):
+    from classes import Database
+    parser = Ag(prog='cli.py search', description='Full-text search over stored listings')
+    parser.add_argument('terms', nargs='+', help='words or quoted phrases that must all appear')
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--days', type=float)
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args(argv)
+    with Database(args.database) as db:
+        listings = db.search_listings(args.terms, args.days, args.limit)
+    for listing in listings:
+        print(f'{listing.price or "":>8} {listing.title}  {listing.link}')
+
+
+def import_catalog(argv=None):
+    parser = Ag(prog='cli.py import',
+                description='Validate a catalog of searches and print their feed URLs')
+    parser.add_argument('catalog', help='.csv with one column per option, or .jsonl of '
+                                        'saved searches')
+    parser.add_argument('--searches', help='also write the canonical searches, deduplicated, '
+                                           'as a JSON list for poller.py --searches')
+    args = parser.parse_args(argv)
+    catalog = Catalog().load(args.catalog)
+    for line, message in catalog.errors:
+        print(f'{args.catalog}:{line}: {message}', file=sys.stderr)
+    print('\n'.join(catalog.urls))
+    if args.searches:
+        from atomic import atomic_write
+        atomic_write(args.searches, json.dumps(list(catalog.searches.values()), indent=2))
+    print(catalog.report(), file=sys.stderr)
+    if catalog.errors:
+        sys.exit(1)
+
+
+def subscribe(argv=None):
+    parser = Ag(prog='cli.py subscribe',
+                description='Register a catalog of saved searches for their subscribers')
+    parser.add_argument('catalog', help='.csv or .jsonl as for import, with an email and '
+                                        'optionally a user column naming the subscriber')
+    parser.add_argument('--database', default=DATABASE)
+    args = parser.parse_args(argv)
+    catalog = Catalog()
+    subscriptions = []
+    for line, row in read_catalog(args.catalog):
+        url = catalog.add(row, line)
+        if url is None:
+            continue
+        email = str(row.get('email') or '').strip()
+        if not email:
+            catalog.errors.append((line, 'Missing email'))
+            continue
+        canonical = catalog.searches[url]
+        subscriptions.append((row.get('user') or None, email, url,
+                              row.get('name') or Catalog.label(canonical),
+                              json.dumps(canonical)))
+    for line, message in catalog.errors:
+        print(f'{args.catalog}:{line}: {message}', file=sys.stderr)
+    from classes import Database
+    Database.init_database(args.database)
+    with Database(args.database) as db:
+        added = db.add_subscriptions(subscriptions)
+    print({**catalog.report(), 'subscribed': added}, file=sys.stderr)
+    if catalog.errors:
+        sys.exit(1)
+
+
+def unsubscribe(argv=None):
+    from classes import Database
+    parser = Ag(prog='cli.py unsubscribe', description='Remove subscribers and their searches')
+    parser.add_argument('emails', nargs='+')
+    parser.add_argument('--database', default=DATABASE)
+    args = parser.parse_args(argv)
+    with Database(args.database) as db:
+        for email in args.emails:
+            print(email, db.remove_subscriber(email))
+
+
+COMMANDS = {
+    'query': query,
+    'search': search,
+    'import': import_catalog,
+    'subscribe': subscribe,
+    'unsubscribe': unsubscribe,
+}
+
+
+def main():
+    """
+    cli.py CITY VEHICLE_TYPE SELLER_TYPE [options] prints a feed URL;
+    cli.py import CATALOG validates a catalog of searches and prints their URLs;
+    cli.py subscribe CATALOG registers them for the subscribers it names;
+    cli.py unsubscribe EMAIL... removes subscribers;
+    cli.py query [filters] filters stored listings;
+    cli.py search TERMS... runs a full-text search over them.
+    """
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        build_url()
+
+
 if __name__ == '__main__':
     main()
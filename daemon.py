@@ -0,0 +1,187 @@
+import asyncio
+import signal
+import sqlite3
+from threading import Event, Thread
+
+from classes import Database, Dispatcher, Mailer, Renderer
+from metrics import METRICS
+from options import (arguments, build_poller, build_retention, build_thumbnails, feed_cache,
+                     parse_arguments)
+from poller import DATABASE, SEARCHES, Poller, dispatch, load_searches, load_subscriptions
+from scheduler import Scheduler
+
+
+class Daemon:
+
+    def __init__(self, searches_file=SEARCHES, database=DATABASE, plan=False,
+                 poller=None, scheduler=None, mailer=None, retention=None,
+                 compact_interval=0, thumbnails=None, metrics_prom=None,
+                 metrics_jsonl=None, subscribers=False):
+        """
+        Long-lived poll loop. The store, compiled templates, HTTP connection
+        pool and SMTP session are set up once and kept across cycles, so a
+        cycle only pays for fetching, diffing and sending.
+        SIGHUP reloads the searches; SIGTERM and SIGINT stop after the
+        current cycle. A cycle that raises is logged and the loop goes on.
+        :param searches_file: string, path to a JSON list of saved searches
+        :param database: string, path to sqlite db file
+        :param plan: boolean, merge overlapping searches with SearchPlanner
+        :param poller: Poller or ShardedPoller, defaults to a Poller on database
+        :param scheduler: Scheduler, defaults to the Scheduler defaults
+        :param mailer: Mailer, defaults to one from Config
+        :param retention: Retention, applied every compact_interval seconds
+        :param compact_interval: float, seconds between retention runs; 0 disables
+        :param thumbnails: Thumbnails, inlines listing images into the digests
+        :param metrics_prom: string, Prometheus textfile rewritten after each cycle
+        :param metrics_jsonl: string, JSON lines file appended to after each cycle
+        :param subscribers: boolean, poll the searches registered in database
+                            with cli.py subscribe instead of searches_file, and
+                            keep what each subscriber was sent; a poller passed
+                            in should then have per_recipient set
+        """
+        self.searches_file = searches_file
+        self.database = database
+        self.plan = plan
+        self.poller = poller or Poller(database, per_recipient=subscribers)
+        self.scheduler = scheduler or Scheduler()
+        self.mailer = mailer
+        self.retention = retention
+        self.compact_interval = compact_interval
+        self.thumbnails = thumbnails
+        self.metrics_prom = metrics_prom
+        self.metrics_jsonl = metrics_jsonl
+        self.subscribers = subscribers
+        self.routes = {}
+        self.cycles = 0
+        self.stopping = False
+        self.reloading = False
+        self.wakeup = None
+        self.finished = Event()
+
+    def __repr__(self):
+        return f'Daemon({self.searches_file}, {self.database})'
+
+    def load(self):
+        """
+        :return: dict, RSS feed URL to routes, as returned by load_searches
+        """
+        if self.subscribers:
+            return load_subscriptions(self.database)
+        return load_searches(self.searches_file, self.plan)
+
+    def reload(self):
+        """
+        Reads the searches again; polling state is kept for those still listed.
+        A file that fails to load leaves the current searches in place.
+        """
+        try:
+            routes = self.load()
+        except (OSError, ValueError, KeyError, sqlite3.Error) as exc:
+            print(f'Keeping {len(self.routes)} searches, failed to load '
+                  f'{self.database if self.subscribers else self.searches_file}: {exc!r}')
+            return
+        for url in self.routes.keys() - routes.keys():
+            self.scheduler.remove(url)
+        for url in routes:
+            self.scheduler.add(url)
+        self.routes = routes
+
+    def request_reload(self):
+        self.reloading = True
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    async def sleep(self, seconds):
+        """
+        Waits until a poll is due, or a signal asks for a reload or stop.
+        """
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+
+    async def cycle(self, session, executor):
+        """
+        :return: dict, URL to list of new listings for the searches that were due
+        """
+        urls = self.scheduler.due()
+        if not urls:
+            return {}
+        try:
+            results = await self.poller.poll_all(urls, session, executor)
+        except Exception:
+            # due took them off the queue; put them back, backed off like failed fetches
+            for url in urls:
+                self.scheduler.record(url, None)
+            raise
+        for url, items in results.items():
+            self.scheduler.record(url, None if items is None else len(items))
+        registry = self.database if self.subscribers else None
+        with Dispatcher(self.mailer, self.thumbnails, registry) as dispatcher:
+            dispatch(dispatcher, self.routes, results)
+        if self.metrics_prom:
+            METRICS.write_prometheus(self.metrics_prom)
+        if self.metrics_jsonl:
+            METRICS.write_jsonl(self.metrics_jsonl)
+        self.cycles += 1
+        return results
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        handlers = {signal.SIGHUP: self.request_reload,
+                    signal.SIGTERM: self.stop,
+                    signal.SIGINT: self.stop}
+        for signum, handler in handlers.items():
+            loop.add_signal_handler(signum, handler)
+        Database.init_database(self.database)
+        Renderer.shared()
+        if self.mailer is None:
+            self.mailer = Mailer()
+        if self.retention is not None and self.compact_interval > 0:
+            Thread(target=self.retention.every,
+                   args=(self.poller.databases, self.compact_interval, self.finished),
+                   daemon=True).start()
+        self.reload()
+        try:
+            with self.poller, self.poller.executor() as executor:
+                async with self.poller.session() as session:
+                    while not self.stopping:
+                        await self.sleep(self.scheduler.next_wakeup())
+                        if self.reloading:
+                            self.reloading = False
+                            self.reload()
+                        if self.stopping:
+                            break
+                        try:
+                            await self.cycle(session, executor)
+                        except Exception as exc:
+                            # Only a signal ends the loop; the failed searches
+                            # are polled again once due
+                            print(f'Cycle failed: {exc!r}')
+        finally:
+            for signum in handlers:
+                loop.remove_signal_handler(signum)
+            self.finished.set()
+            self.mailer.close()
+
+
+def main():
+    args = parse_arguments(arguments(daemon=True))
+    daemon = Daemon(args.searches, args.database, args.plan,
+                    build_poller(args, feed_cache(args)),
+                    Scheduler(args.min_interval, args.max_interval, args.budget),
+                    retention=build_retention(args),
+                    compact_interval=args.compact_hours * 3600,
+                    thumbnails=build_thumbnails(args),
+                    metrics_prom=args.metrics_prom, metrics_jsonl=args.metrics_jsonl,
+                    subscribers=args.subscribers)
+    asyncio.run(daemon.run())
+
+
+if __name__ == '__main__':
+    main()
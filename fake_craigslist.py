@@ -0,0 +1,174 @@
+from argparse import ArgumentParser as Ag
+import asyncio
+from threading import Thread
+import struct
+from time import monotonic
+from urllib.parse import urlsplit
+from zlib import compress, crc32
+
+from aiohttp import web
+
+
+ITEM = '<item rdf:about="{link}"><title><![CDATA[{title}]]></title>' \
+       '<link>{link}</link><description><![CDATA[{summary}]]></description>' \
+       '<dc:date>2018-02-26T11:24:55-07:00</dc:date>' \
+       '<enc:enclosure resource="https://images.craigslist.org/{num}.jpg" type="image/jpeg"/>' \
+       '</item>'
+
+
+def rss_document(count, prefix='post', newest=None):
+    """
+    :param count: int, number of items
+    :param prefix: string, makes ids and titles distinct between feeds
+    :param newest: int, number of the newest item; items are listed newest
+                   first from it, or as 0..count-1 if None
+    :return: string, an RSS 1.0 document shaped like Craigslist's
+    """
+    numbers = range(count) if newest is None else range(newest, newest - count, -1)
+    items = ''.join(ITEM.format(link=f'https://denver.craigslist.org/cto/d/{prefix}/{num}.html',
+                                title=f'2015 GTI {prefix} &#x0024;{18000 + num}',
+                                summary=f'{prefix} summary {num}', num=num)
+                    for num in numbers if num >= 0)
+    return '<?xml version="1.0" encoding="utf-8"?>' \
+           '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" ' \
+           'xmlns="http://purl.org/rss/1.0/" xmlns:enc="http://purl.oclc.org/net/rss_2.0/enc#" ' \
+           'xmlns:dc="http://purl.org/dc/elements/1.1/">' \
+           f'<channel rdf:about="feed"><title>craigslist</title></channel>{items}</rdf:RDF>'
+
+
+def png(width=8, height=8):
+    """
+    :return: bytes, a plain grey PNG image
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+               struct.pack('>I', crc32(kind + data))
+    rows = b''.join(b'\x00' + b'\x80' * width for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + \
+        chunk(b'IDAT', compress(rows)) + chunk(b'IEND', b'')
+
+
+class FakeCraigslist:
+
+    def __init__(self, size=25, churn=0.0, latency=0.0, conditional=True,
+                 host='127.0.0.1', port=0):
+        """
+        Serves a synthetic feed for any path. Every query string on a path
+        (i.e. every filter on one city/category) sees the same listings.
+        :param size: int, items per feed
+        :param churn: float, new items per second on each feed
+        :param latency: float, seconds to wait before answering
+        :param conditional: boolean, answer 304 to a matching If-None-Match
+        :param host: string, interface to listen on
+        :param port: int, port to listen on; 0 picks a free one
+        """
+        self.size = size
+        self.churn = churn
+        self.latency = latency
+        self.conditional = conditional
+        self.host = host
+        self.port = port
+        self.started = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.image_requests = 0
+        self.loop = None
+        self.runner = None
+
+    def __repr__(self):
+        return f'FakeCraigslist({self.size}, {self.churn}, {self.latency})'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def base(self):
+        return f'http://{self.host}:{self.port}'
+
+    def url_for(self, url):
+        """
+        :param url: string, Craigslist URL as built by Vehicle
+        :return: string, the same search on this server
+        """
+        parts = urlsplit(url)
+        city = parts.hostname.split('.')[0]
+        return f'{self.base}/{city}{parts.path}?{parts.query}'
+
+    def newest(self, path):
+        started = self.started.setdefault(path, monotonic())
+        return self.size - 1 + int((monotonic() - started) * self.churn)
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        newest = self.newest(request.path)
+        etag = f'"{request.path}:{newest}"'
+        if self.conditional and request.headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        prefix = request.path.strip('/').replace('/', '-')
+        body = rss_document(self.size, prefix, newest)
+        return web.Response(body=body.encode(), content_type='application/rss+xml',
+                            headers={'ETag': etag})
+
+    async def blocked(self, request):
+        """Craigslist's answer to a client it has blocked: a 200 that is not RSS"""
+        self.requests += 1
+        return web.Response(text='<html><body>This IP has been automatically blocked.<br>'
+                                 '</body></html>', content_type='text/html')
+
+    async def image(self, request):
+        self.image_requests += 1
+        return web.Response(body=png(), content_type='image/png')
+
+    def application(self):
+        app = web.Application()
+        app.router.add_get('/images/{name}', self.image)
+        app.router.add_get('/blocked/{tail:.*}', self.blocked)
+        app.router.add_get('/{tail:.*}', self.handle)
+        return app
+
+    async def serve(self):
+        self.runner = web.AppRunner(self.application(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    def start(self):
+        """
+        Runs the server on its own event loop in a background thread.
+        :return: FakeCraigslist
+        """
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def main():
+    parser = Ag()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--size', type=int, default=25)
+    parser.add_argument('--churn', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--no_conditional', action='store_true')
+    args = parser.parse_args()
+    server = FakeCraigslist(args.size, args.churn, args.latency, not args.no_conditional,
+                            args.host, args.port)
+    web.run_app(server.application(), host=args.host, port=args.port,
+                access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 from os import path
 
-from classes import Feed, Message
+from classes import Database, Dispatcher, Feed, Mailer
 from config import Config
 
 
@@ -12,10 +12,14 @@ URL = 'https://denver.craigslist.org/search/cta?format=rss&bundleDuplicates=1&'
 
 
 def main():
-    with Feed(URL, DICT_FILE) as feed:
+    Database.init_database(DATABASE)
+    with Database(DATABASE) as db:
+        db.migrate_dict(DICT_FILE, URL)
+    with Feed(URL, DATABASE) as feed:
         new_items = feed.refresh_feed()
     if new_items is not None:
-        Message(Config.user, Config.email_address, new_items)
+        with Mailer() as mailer, Dispatcher(mailer) as dispatcher:
+            dispatcher.add(Config.user, Config.email_address, new_items)
 
 
 if __name__ == '__main__':
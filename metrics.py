@@ -0,0 +1,173 @@
+from contextlib import nullcontext
+import json
+from threading import Lock
+from time import perf_counter, time
+
+from atomic import atomic_write
+
+
+class Timer:
+    __slots__ = ('metrics', 'stage', 'search', 'start')
+
+    def __init__(self, metrics, stage, search):
+        self.metrics = metrics
+        self.stage = stage
+        self.search = search
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.stage, perf_counter() - self.start, self.search)
+
+
+class Metrics:
+    # Reused for every stage while disabled, so hooks cost one attribute check
+    null_timer = nullcontext()
+
+    def __init__(self, prefix='carsearch'):
+        """
+        Per-stage timings and per-search counters for the poll pipeline.
+        Disabled until enable() is called.
+        :param prefix: string, prepended to every Prometheus metric name
+        """
+        self.prefix = prefix
+        self.enabled = False
+        # Only a write_jsonl sink ever empties events, so without one none are kept
+        self.buffered = False
+        self.lock = Lock()
+        self.timings = {}
+        self.counters = {}
+        self.events = []
+
+    def __repr__(self):
+        return f'Metrics({self.prefix}, {self.enabled})'
+
+    def enable(self, events=False):
+        """
+        :param events: boolean, also keep each observation for write_jsonl
+        """
+        self.enabled = True
+        self.buffered = events
+
+    def disable(self):
+        self.enabled = False
+        self.buffered = False
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+            self.events = []
+
+    def drain(self):
+        """
+        :return: dict, the timings, counters and events recorded since the
+                 last reset, which are cleared; for a worker process to hand
+                 to merge in its parent
+        """
+        with self.lock:
+            recorded = {'timings': self.timings, 'counters': self.counters,
+                        'events': self.events}
+            self.timings = {}
+            self.counters = {}
+            self.events = []
+        return recorded
+
+    def merge(self, recorded):
+        """
+        :param recorded: dict, as returned by drain
+        """
+        with self.lock:
+            for key, (count, seconds) in recorded['timings'].items():
+                total = self.timings.setdefault(key, [0, 0.0])
+                total[0] += count
+                total[1] += seconds
+            for key, value in recorded['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.events.extend(recorded['events'])
+
+    def stage(self, stage, search=None):
+        """
+        :param stage: string, e.g. fetch, parse, store, render or send
+        :param search: string, RSS feed URL the work was done for
+        :return: context manager timing its body
+        """
+        if not self.enabled:
+            return self.null_timer
+        return Timer(self, stage, search)
+
+    def observe(self, stage, seconds, search=None):
+        with self.lock:
+            total = self.timings.setdefault((stage, search), [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+            if self.buffered:
+                    self.events.append({'ts': time(), 'stage': stage, 'search': search,
+                                    'seconds': seconds})
+
+    def count(self, name, value, search=None):
+        """
+        :param name: string, e.g. fetch_bytes or new_items
+        :param value: int, amount to add
+        :param search: string, RSS feed URL
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, search)] = self.counters.get((name, search), 0) + value
+            if self.buffered:
+                self.events.append({'ts': time(), 'metric': name, 'search': search,
+                                    'value': value})
+
+    @staticmethod
+    def labels(**labels):
+        pairs = []
+        for key, value in labels.items():
+            if value is None:
+                continue
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def prometheus(self):
+        """
+        :return: string, totals in the Prometheus text exposition format
+        """
+        with self.lock:
+            timings = sorted(self.timings.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+        lines = [f'# TYPE {self.prefix}_stage_seconds summary']
+        for (stage, search), (count, seconds) in timings:
+            labels = self.labels(stage=stage, search=search)
+            lines.append(f'{self.prefix}_stage_seconds_sum{labels} {seconds:.6f}')
+            lines.append(f'{self.prefix}_stage_seconds_count{labels} {count}')
+        declared = set()
+        for (name, search), value in counters:
+            if name not in declared:
+                lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+                declared.add(name)
+            lines.append(f'{self.prefix}_{name}_total{self.labels(search=search)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, prometheus_file):
+        """
+        Replaces the file atomically, e.g. for node_exporter's textfile
+        collector, which must never read half a file.
+        """
+        atomic_write(prometheus_file, self.prometheus())
+
+    def write_jsonl(self, jsonl_file):
+        """
+        Appends the events recorded since the last call, one JSON object per line.
+        """
+        with self.lock:
+            events, self.events = self.events, []
+        with open(jsonl_file, 'a') as file:
+            for event in events:
+                file.write(json.dumps(event) + '\n')
+
+
+METRICS = Metrics()
@@ -0,0 +1,111 @@
+"""
+Command line options shared by poller.py, which polls every search once,
+and daemon.py, which keeps polling them, along with what is built from them.
+"""
+from argparse import ArgumentParser as Ag
+import json
+
+from classes import Database
+from metrics import METRICS
+from poller import DATABASE, SEARCHES, FeedCache, Poller, ShardedPoller
+from retention import DAY, Retention, search_ages
+from thumbnails import Thumbnails
+
+
+def arguments(daemon=False):
+    """
+    :param daemon: boolean, add the scheduling and retention options of a long-running loop
+    :return: ArgumentParser
+    """
+    parser = Ag()
+    parser.add_argument('--searches', default=SEARCHES)
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--host_interval', type=float, default=0.0)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--plan', action='store_true')
+    parser.add_argument('--subscribers', action='store_true',
+                        help='poll the searches registered in the database with '
+                             'cli.py subscribe instead of --searches'
+                             + ('; SIGHUP rereads them' if daemon else ''))
+    parser.add_argument('--shards', type=int, default=1,
+                        help='worker processes, each polling into a file of its own')
+    parser.add_argument('--feed_cache_mb', type=float, default=0,
+                        help='share fetched feeds between searches with the same '
+                             'canonical URL; 0 disables. Not with --shards, as '
+                             'worker processes cannot share it')
+    parser.add_argument('--feed_cache_ttl', type=float, default=60)
+    parser.add_argument('--thumbnails', help='cache directory; inlines listing images '
+                                             'as thumbnails instead of hot-linking them')
+    parser.add_argument('--thumbnail_cache_mb', type=float, default=64)
+    parser.add_argument('--metrics_prom')
+    parser.add_argument('--metrics_jsonl')
+    if daemon:
+        parser.add_argument('--budget', type=int, default=60)
+        parser.add_argument('--min_interval', type=float, default=60)
+        parser.add_argument('--max_interval', type=float, default=3600)
+        parser.add_argument('--compact_hours', type=float, default=0,
+                            help='apply the retention policy this often; 0 disables')
+        parser.add_argument('--max_age_days', type=float, default=30)
+        parser.add_argument('--max_entries', type=int)
+    else:
+        parser.add_argument('--stats', action='store_true')
+    return parser
+
+
+def parse_arguments(parser, argv=None):
+    """
+    Parses and checks the options, and turns on METRICS if they are written anywhere.
+    :return: argparse.Namespace
+    """
+    args = parser.parse_args(argv)
+    if args.shards > 1 and args.feed_cache_mb > 0:
+        parser.error('--feed_cache_mb cannot be used with --shards')
+    if args.metrics_prom or args.metrics_jsonl:
+        METRICS.enable(events=bool(args.metrics_jsonl))
+    return args
+
+
+def feed_cache(args):
+    """
+    :return: FeedCache, or None if --feed_cache_mb is 0
+    """
+    if args.feed_cache_mb > 0:
+        return FeedCache(int(args.feed_cache_mb * 2 ** 20), args.feed_cache_ttl)
+    return None
+
+
+def build_poller(args, cache=None):
+    """
+    :param cache: FeedCache, as returned by feed_cache
+    :return: Poller, or ShardedPoller with --shards
+    """
+    options = {'concurrency': args.concurrency, 'host_interval': args.host_interval,
+               'streaming': args.streaming, 'cache': cache,
+               'per_recipient': args.subscribers}
+    if args.shards > 1:
+        return ShardedPoller(args.database, args.shards, **options)
+    Database.init_database(args.database)
+    return Poller(args.database, **options)
+
+
+def build_thumbnails(args):
+    """
+    :return: Thumbnails, or None without --thumbnails
+    """
+    if not args.thumbnails:
+        return None
+    return Thumbnails(args.thumbnails, int(args.thumbnail_cache_mb * 2 ** 20))
+
+
+def build_retention(args):
+    """
+    :return: Retention, or None if --compact_hours is 0
+    """
+    if args.compact_hours <= 0:
+        return None
+    ages = None
+    if not args.subscribers:
+        with open(args.searches) as file:
+            ages = search_ages(json.load(file), args.plan, args.max_age_days * DAY)
+    return Retention(args.max_age_days * DAY, args.max_entries, ages=ages)
@@ -0,0 +1,165 @@
+from argparse import ArgumentParser as Ag
+import json
+
+from vehicles import Vehicle
+
+
+# Options that can be checked against a fetched Listing, so searches that
+# differ only in these can share one upstream query. Anything else (miles,
+# transmission, ...) is not in the RSS items and has to stay upstream.
+LOCAL_OPTIONS = {
+    'min_price': ('price', min),
+    'max_price': ('price', max),
+    'min_auto_year': ('year', min),
+    'max_auto_year': ('year', max),
+}
+
+
+class LocalFilter:
+
+    def __init__(self, bounds):
+        """
+        :param bounds: dict, local option name (see LOCAL_OPTIONS) to its value
+        """
+        self.bounds = {option: int(value) for option, value in bounds.items()}
+
+    def __repr__(self):
+        return f'LocalFilter({self.bounds})'
+
+    def __call__(self, listing):
+        """
+        Listings without a price or year in the title are let through, as
+        Craigslist filters on fields the feed does not carry.
+        :param listing: Listing
+        :return: boolean
+        """
+        for option, bound in self.bounds.items():
+            field = LOCAL_OPTIONS[option][0]
+            value = getattr(listing, field)
+            if value is None:
+                continue
+            if option.startswith('min_') and value < bound:
+                return False
+            if option.startswith('max_') and value > bound:
+                return False
+        return True
+
+    def apply(self, listings):
+        return [listing for listing in listings if self(listing)]
+
+
+class Query:
+
+    def __init__(self, url, search):
+        """
+        :param url: string, RSS feed URL fetched upstream
+        :param search: dict, widened saved search the URL was built from
+        """
+        self.url = url
+        self.search = search
+        self.members = []
+
+    def __repr__(self):
+        return f'Query({self.url}, {len(self.members)})'
+
+
+class SearchPlanner:
+
+    def __init__(self, searches):
+        """
+        :param searches: list of saved search dicts, as read by poller.load_searches
+        """
+        self.searches = searches
+
+    def __repr__(self):
+        return f'SearchPlanner({len(self.searches)})'
+
+    @staticmethod
+    def canonical(search):
+        """
+        :return: dict, the search with normalized city, term and sorted options
+        """
+        term = search.get('search')
+        options = {option: value for option, value in search.get('options', {}).items()
+                   if value not in (None, False, '')}
+        return {
+            'city': search['city'].replace(' ', '').lower(),
+            'vehicle_type': search['vehicle_type'],
+            'seller_type': search['seller_type'],
+            'search': ' '.join(term.lower().split()) if term else None,
+            'options': dict(sorted(options.items())),
+        }
+
+    @staticmethod
+    def group_key(search):
+        upstream = tuple((option, str(value)) for option, value in search['options'].items()
+                         if option not in LOCAL_OPTIONS)
+        return (search['city'], search['vehicle_type'], search['seller_type'],
+                search['search'], upstream)
+
+    @staticmethod
+    def widen(searches):
+        """
+        :param searches: list of canonical searches sharing a group key
+        :return: dict, the narrowest search that still covers all of them
+        """
+        wide = dict(searches[0], options={})
+        for option, value in searches[0]['options'].items():
+            if option not in LOCAL_OPTIONS:
+                wide['options'][option] = value
+        for option, (_, widest) in LOCAL_OPTIONS.items():
+            values = [search['options'].get(option) for search in searches]
+            if all(value is not None for value in values):
+                wide['options'][option] = widest(int(value) for value in values)
+        wide['options'] = dict(sorted(wide['options'].items()))
+        return wide
+
+    def compile(self):
+        """
+        :return: list of Query, each with members as (search, name, LocalFilter)
+        """
+        groups = {}
+        for search in self.searches:
+            canonical = self.canonical(search)
+            groups.setdefault(self.group_key(canonical), []).append((search, canonical))
+        queries = []
+        for members in groups.values():
+            wide = self.widen([canonical for _, canonical in members])
+            query = Query(Vehicle.from_search(wide).get_url, wide)
+            for search, canonical in members:
+                bounds = {option: value for option, value in canonical['options'].items()
+                          if option in LOCAL_OPTIONS and value != wide['options'].get(option)}
+                name = search.get('name', Vehicle.from_search(search).label)
+                query.members.append((search, name, LocalFilter(bounds)))
+            queries.append(query)
+        return queries
+
+    def report(self, queries=None):
+        """
+        :return: dict, upstream request counts before and after planning
+        """
+        queries = queries if queries is not None else self.compile()
+        naive = len({Vehicle.from_search(search).get_url for search in self.searches})
+        return {
+            'searches': len(self.searches),
+            'naive_requests': naive,
+            'planned_requests': len(queries),
+            'saved': naive - len(queries),
+            'reduction': 1 - len(queries) / naive if naive else 0.0,
+        }
+
+
+def main():
+    parser = Ag()
+    parser.add_argument('searches')
+    args = parser.parse_args()
+    with open(args.searches) as file:
+        planner = SearchPlanner(json.load(file))
+    queries = planner.compile()
+    for query in queries:
+        print(f'{len(query.members):>4} {query.url}')
+    print(planner.report(queries))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import AsyncExitStack, nullcontext
+import json
+from os import cpu_count, path
+from time import monotonic, time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from xml.etree.ElementTree import ParseError
+from zlib import crc32
+
+import aiohttp
+
+from classes import Database, Dispatcher, Feed, Mailer, Vehicle
+from config import Config
+from metrics import METRICS
+from planner import SearchPlanner
+
+
+DATABASE = path.join(path.dirname(path.abspath(__file__)), 'data.db')
+SEARCHES = path.join(path.dirname(path.abspath(__file__)), 'searches.json')
+
+
+class HostLimiter:
+
+    def __init__(self, interval):
+        """
+        :param interval: float, minimum seconds between requests to one host
+        """
+        self.interval = interval
+        self.locks = {}
+        self.last = {}
+
+    def __repr__(self):
+        return f'HostLimiter({self.interval})'
+
+    async def wait(self, host):
+        if self.interval <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            delay = self.last.get(host, 0) + self.interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.last[host] = loop.time()
+
+
+class FeedCache:
+
+    def __init__(self, max_bytes=32 * 2 ** 20, ttl=60, clock=monotonic):
+        """
+        Parsed feeds by canonical URL, so searches that resolve to the same
+        feed share one fetch. Least recently used feeds are evicted first.
+        :param max_bytes: int, bound on the fetched body bytes behind the
+                          cached feeds, a proxy for their parsed size
+        :param ttl: float, seconds a parsed feed is served for
+        :param clock: callable, returns the current time in seconds
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f'FeedCache({len(self.entries)}, {self.size}/{self.max_bytes})'
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(url):
+        """
+        :param url: string, RSS feed URL
+        :return: string, the URL with a lowercase host and sorted query; the
+                 search term is lowercased too, as Craigslist ignores its case
+        """
+        parts = urlsplit(url)
+        query = sorted((name, value.lower() if name == 'auto_make_model' else value)
+                       for name, value in parse_qsl(parts.query, keep_blank_values=True))
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path,
+                           urlencode(query), ''))
+
+    def get(self, url):
+        """
+        :return: 4-tuple, (listings, etag, modified, size) as passed to put, or None
+        """
+        key = self.key(url)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= self.clock():
+            self.discard(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            METRICS.count('feed_cache_misses', 1)
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        METRICS.count('feed_cache_hits', 1)
+        return entry[1:]
+
+    def put(self, url, listings, etag=None, modified=None, size=0):
+        """
+        :param url: string, RSS feed URL
+        :param listings: list of dicts of CL postings, the whole parsed feed
+        :param etag: string, ETag header of the fetch
+        :param modified: string, Last-Modified header of the fetch
+        :param size: int, bytes fetched
+        """
+        key = self.key(url)
+        if key in self.entries:
+            self.discard(key)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (self.clock() + self.ttl, listings, etag, modified, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+            METRICS.count('feed_cache_evictions', 1)
+
+    def discard(self, key):
+        self.size -= self.entries.pop(key)[4]
+
+    def stats(self):
+        """
+        :return: dict, hit/miss/eviction counts and current occupancy
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
+
+
+class Poller:
+
+    def __init__(self, database, concurrency=20, host_interval=0.0,
+                 parse_workers=4, timeout=30, streaming=False, cache=None,
+                 per_recipient=False):
+        """
+        :param database: string, path to sqlite db file holding seen listings
+        :param concurrency: int, maximum number of fetches in flight
+        :param host_interval: float, minimum seconds between requests to one host
+        :param parse_workers: int, threads used to parse fetched feeds
+        :param timeout: float, seconds before a single fetch is abandoned
+        :param streaming: boolean, use Feed's streaming parser
+        :param cache: FeedCache, shares each fetched feed between searches
+                      with the same canonical URL; feeds are then parsed whole
+        :param per_recipient: boolean, return every listing new to a feed,
+                              even if another search found it first, for a
+                              Dispatcher that tracks deliveries per recipient
+        """
+        self.database = database
+        self.concurrency = concurrency
+        self.limiter = HostLimiter(host_interval)
+        self.parse_workers = parse_workers
+        self.timeout = timeout
+        self.streaming = streaming
+        self.cache = cache
+        self.per_recipient = per_recipient
+        self.pending = {}
+        self.errors = {}
+
+    def __repr__(self):
+        return f'Poller({self.database}, {self.concurrency})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def fetch(self, session, url, etag=None, modified=None):
+        """
+        :return: 4-tuple, (status, body, etag, modified); body is None on a 304
+        """
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if modified is not None:
+            headers['If-Modified-Since'] = modified
+        await self.limiter.wait(urlsplit(url).hostname)
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                return 304, None, etag, modified
+            response.raise_for_status()
+            body = await response.read()
+            return (response.status, body, response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'))
+
+    async def poll(self, session, semaphore, executor, db, url, since):
+        """
+        :return: list of new listings, or None when the fetch failed
+        """
+        feed = Feed(url, self.database, self.streaming, db=db)
+        if self.cache is None:
+            return await self.fetch_and_parse(session, semaphore, executor, feed, since)
+        key = self.cache.key(url)
+        while key in self.pending:
+            # Another search is fetching the same feed; wait for it to land in the cache
+            await self.pending[key].wait()
+        cached = self.cache.get(url)
+        if cached is not None:
+            listings, etag, modified, _ = cached
+            return feed.diff(listings, etag, modified, 0, since)
+        self.pending[key] = asyncio.Event()
+        try:
+            return await self.fetch_and_parse(session, semaphore, executor, feed, since)
+        finally:
+            self.pending.pop(key).set()
+
+    async def fetch_and_parse(self, session, semaphore, executor, feed, since):
+        url = feed.url
+        async with semaphore:
+            try:
+                with METRICS.stage('fetch', url):
+                    status, body, etag, modified = await self.fetch(
+                        session, url, *feed.validators())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                self.errors[url] = exc
+                return None
+        if status == 304:
+            feed.unchanged()
+            return []
+        METRICS.count('fetch_bytes', len(body), url)
+        try:
+            listings = await asyncio.get_running_loop().run_in_executor(
+                executor, self.parse, feed, body)
+        except ParseError as exc:
+            # A 200 that is not RSS, e.g. a captcha page; failed like a fetch
+            self.errors[url] = exc
+            return None
+        if self.cache is not None:
+            self.cache.put(url, listings, etag, modified, len(body))
+        return feed.diff(listings, etag, modified, len(body), since)
+
+    def parse(self, feed, body):
+        with METRICS.stage('parse', feed.url):
+            if not self.streaming:
+                return Feed.parse(body)
+            if self.cache is not None:
+                # Other searches' seen listings differ, so no early stop
+                return list(Feed.stream(body))
+            return feed.stream_new(body)
+
+    def session(self):
+        """
+        :return: aiohttp.ClientSession, pooling up to concurrency connections
+        """
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                     timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def executor(self):
+        return ThreadPoolExecutor(self.parse_workers)
+
+    @property
+    def databases(self):
+        return [self.database]
+
+    async def poll_all(self, urls, session=None, executor=None):
+        """
+        Everything the cycle stores is committed in one transaction at the end,
+        so a crash part way through leaves the store as it was before the cycle.
+        :param urls: iterable of RSS feed URLs
+        :param session: aiohttp.ClientSession kept open across cycles; one is
+                        opened for this cycle if None
+        :param executor: ThreadPoolExecutor parsing feeds, likewise
+        :return: dict, URL to list of new listings (None for failed fetches or unparsable bodies)
+        """
+        urls = list(dict.fromkeys(urls))
+        since = None if self.per_recipient else time()
+        self.errors = {}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with AsyncExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(self.executor())
+            if session is None:
+                session = await stack.enter_async_context(self.session())
+            db = stack.enter_context(Database(self.database))
+            results = await asyncio.gather(
+                *[self.poll(session, semaphore, executor, db, url, since) for url in urls])
+        return dict(zip(urls, results))
+
+    def run(self, urls):
+        return asyncio.run(self.poll_all(urls))
+
+
+def shard_of(url, shards):
+    """
+    Searches on the same city and category land in the same shard, so the
+    listings they share are deduplicated within one store.
+    :param url: string, RSS feed URL
+    :param shards: int, number of shards
+    :return: int
+    """
+    parts = urlsplit(url)
+    return crc32(f'{parts.hostname}{parts.path}'.encode()) % shards
+
+
+def shard_database(database, shard):
+    """
+    :return: string, path of the shard's own sqlite file, e.g. data.shard0.db
+    """
+    root, ext = path.splitext(database)
+    return f'{root}.shard{shard}{ext}'
+
+
+def poll_shard(database, urls, poller_class, options, metrics=False, events=False):
+    """
+    Runs in a worker process.
+    :param metrics: boolean, record METRICS, as the parent does
+    :param events: boolean, keep METRICS events too, as the parent does
+    :return: 4-tuple, (results, errors as reprs, poll latencies if recorded,
+             METRICS recorded for this call as returned by drain)
+    """
+    # Workers are reused, and forked ones start with the parent's totals
+    METRICS.reset()
+    if metrics:
+        METRICS.enable(events)
+    else:
+        METRICS.disable()
+    Database.init_database(database)
+    poller = poller_class(database, **options)
+    results = poller.run(urls)
+    errors = {url: repr(exc) for url, exc in poller.errors.items()}
+    return results, errors, getattr(poller, 'latencies', []), METRICS.drain()
+
+
+class ShardedPoller:
+
+    def __init__(self, database, shards=None, poller_class=Poller, **options):
+        """
+        Spreads searches over worker processes, each polling with its own
+        Poller into its own slice of the store.
+        :param database: string, path the shard files are named after
+        :param shards: int, number of worker processes; defaults to the CPU count
+        :param poller_class: Poller or a subclass, run in each worker
+        :param options: keyword arguments for each worker's Poller; no cache,
+                        as a FeedCache would be copied to the worker afresh
+                        on every run and never hit
+        """
+        if options.get('cache') is not None:
+            raise ValueError('A FeedCache cannot be shared between shards')
+        self.database = database
+        self.shards = shards or cpu_count() or 1
+        self.poller_class = poller_class
+        self.options = options
+        self.pool = None
+        self.errors = {}
+        self.latencies = []
+
+    def __repr__(self):
+        return f'ShardedPoller({self.database}, {self.shards})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def databases(self):
+        return [shard_database(self.database, shard) for shard in range(self.shards)]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def session(self):
+        """
+        Each worker opens its own; for Daemon, which keeps a Poller's across cycles
+        """
+        return nullcontext()
+
+    def executor(self):
+        return nullcontext()
+
+    async def poll_all(self, urls, session=None, executor=None):
+        """
+        Poller.poll_all for Daemon: runs the cycle off the event loop, so
+        signals are still handled while the workers poll.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.run, urls)
+
+    def run(self, urls):
+        """
+        :param urls: iterable of RSS feed URLs
+        :return: dict, URL to list of new listings (None for failed fetches or unparsable bodies)
+        """
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.shards)
+        urls = list(dict.fromkeys(urls))
+        groups = {}
+        for url in urls:
+            groups.setdefault(shard_of(url, self.shards), []).append(url)
+        futures = [self.pool.submit(poll_shard, shard_database(self.database, shard),
+                                    group, self.poller_class, self.options, METRICS.enabled,
+                                    METRICS.buffered)
+                   for shard, group in groups.items()]
+        merged = {}
+        self.errors = {}
+        for future in futures:
+            results, errors, latencies, recorded = future.result()
+            merged.update(results)
+            self.errors.update(errors)
+            self.latencies.extend(latencies)
+            METRICS.merge(recorded)
+        return {url: merged[url] for url in urls}
+
+
+def load_searches(searches_file, plan=False):
+    """
+    :param searches_file: string, path to a JSON list of saved searches
+    :param plan: boolean, merge overlapping searches with SearchPlanner
+    :return: dict, RSS feed URL to a list of (search name, local filter or
+             None, recipient); the recipient is None for Config's user
+    """
+    with open(searches_file) as file:
+        searches = json.load(file)
+    routes = {}
+    if plan:
+        for query in SearchPlanner(searches).compile():
+            routes[query.url] = [(name, local, None) for _, name, local in query.members]
+    else:
+        for search in searches:
+            vehicle = Vehicle.from_search(search)
+            # Searches building the same URL share one fetch and are all named
+            routes.setdefault(vehicle.get_url, []).append(
+                (search.get('name', vehicle.label), None, None))
+    return routes
+
+
+def load_subscriptions(database):
+    """
+    Routes for the searches registered with cli.py subscribe: the inverted
+    index from canonical feed URL to the subscribers waiting on it.
+    :param database: string, path to sqlite db file holding the registry
+    :return: dict, as returned by load_searches, each recipient a 2-tuple
+             of (user, email)
+    """
+    with Database(database) as db:
+        subscriptions = db.subscriptions()
+    return {url: [(name, None, (user, email)) for name, user, email in subscribers]
+            for url, subscribers in subscriptions.items()}
+
+
+def dispatch(dispatcher, routes, results):
+    """
+    Hands each search's share of the new listings to the dispatcher, one
+    routes lookup per refreshed feed.
+    :param dispatcher: Dispatcher
+    :param routes: dict, as returned by load_searches or load_subscriptions
+    :param results: dict, as returned by Poller.run
+    """
+    owner = (Config.user, Config.email_address)
+    for url, items in results.items():
+        if items:
+            for name, local, recipient in routes[url]:
+                matches = local.apply(items) if local is not None else items
+                dispatcher.add(*(recipient or owner), matches, name)
+
+
+def main():
+    # Imported here, as options builds on this module
+    from options import arguments, build_poller, build_thumbnails, feed_cache, parse_arguments
+    args = parse_arguments(arguments())
+    cache = feed_cache(args)
+    poller = build_poller(args, cache)
+    with poller:
+        if args.subscribers:
+            routes = load_subscriptions(args.database)
+        else:
+            routes = load_searches(args.searches, args.plan)
+        results = poller.run(routes)
+    for url, exc in poller.errors.items():
+        print(f'Failed to fetch {url}: {exc}')
+    if args.stats:
+        for database in poller.databases:
+            with Database(database) as db:
+                print(database, db.poll_stats())
+        if cache is not None:
+            print('feed cache', cache.stats())
+    registry = args.database if args.subscribers else None
+    with Mailer() as mailer, Dispatcher(mailer, build_thumbnails(args), registry) as dispatcher:
+        dispatch(dispatcher, routes, results)
+    if args.metrics_prom:
+        METRICS.write_prometheus(args.metrics_prom)
+    if args.metrics_jsonl:
+        METRICS.write_jsonl(args.metrics_jsonl)
+
+
+if __name__ == '__main__':
+    main()
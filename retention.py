@@ -0,0 +1,179 @@
+from argparse import ArgumentParser as Ag
+import json
+import sqlite3
+from threading import Event
+from time import sleep, time
+
+from classes import Database, Vehicle
+from planner import SearchPlanner
+
+
+DAY = 86400
+
+
+class Retention:
+
+    def __init__(self, max_age=30 * DAY, max_entries=None, tombstone_age=90 * DAY,
+                 ages=None, batch=500, pause=0.05, fragmentation=0.25, min_bytes=2 ** 20,
+                 timeout=5.0, retries=5, backoff=1.0):
+        """
+        Retention policy for the listing history, applied by run in short
+        transactions so pollers writing to the same file wait at most a batch.
+        :param max_age: float, seconds a listing's content is kept by default
+        :param max_entries: int, most listings kept with their content; None is unbounded
+        :param tombstone_age: float, seconds the id of a listing is remembered,
+                              so it is not delivered again; Craigslist posts
+                              expire well before the default
+        :param ages: dict, RSS feed URL to max_age for searches with their own
+        :param batch: int, listings handled per transaction
+        :param pause: float, seconds slept between transactions
+        :param fragmentation: float, share of the file a VACUUM would reclaim
+                              above which it is run
+        :param min_bytes: int, least bytes worth a VACUUM, so small files are left alone
+        :param timeout: float, seconds a batch waits for a poll cycle's write lock
+        :param retries: int, times a locked batch is retried before run gives up
+        :param backoff: float, seconds slept before the first retry, doubled after each
+        """
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.tombstone_age = max(tombstone_age, max_age, *(ages or {}).values())
+        self.ages = ages or {}
+        self.batch = batch
+        self.pause = pause
+        self.fragmentation = fragmentation
+        self.min_bytes = min_bytes
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def __repr__(self):
+        return f'Retention({self.max_age / DAY:g}d, {self.max_entries}, ' \
+               f'{self.tombstone_age / DAY:g}d)'
+
+    def batches(self, database, prune):
+        """
+        :param prune: callable, takes a Database and returns the rows it handled
+        :return: int, rows handled across all batches
+        """
+        total = 0
+        attempt = 0
+        while True:
+            try:
+                with Database(database, self.timeout) as db:
+                    db.lock()
+                    count = prune(db)
+            except sqlite3.OperationalError as exc:
+                # A poll cycle holds the write lock for its whole transaction
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                print(f'{database}: {exc}, retrying in {delay:g}s')
+                sleep(delay)
+                continue
+            attempt = 0
+            total += count
+            if count < self.batch:
+                return total
+            sleep(self.pause)
+
+    def run(self, database, now=None):
+        """
+        :param database: string, path to sqlite db file
+        :param now: float, unix time; defaults to the current time
+        :return: dict, rows tombstoned and deleted, and bytes reclaimed
+        """
+        now = time() if now is None else now
+        report = {'capped': 0}
+        report['expired'] = self.batches(database, lambda db: db.expire_listings(
+            self.max_age, self.batch, self.ages, now))
+        if self.max_entries is not None:
+            report['capped'] = self.batches(database, lambda db: db.cap_listings(
+                self.max_entries, self.batch))
+        report['dropped'] = self.batches(database, lambda db: db.drop_tombstones(
+            now - self.tombstone_age, self.batch))
+        report['forgotten'] = self.batches(database, lambda db: db.drop_deliveries(
+            now - self.tombstone_age, self.batch))
+        report.update(self.compact(database))
+        return report
+
+    def compact(self, database):
+        """
+        VACUUMs the file when enough of it is free. Left for the next run while
+        a poll cycle is writing, as VACUUM cannot wait out a whole cycle.
+        :param database: string, path to sqlite db file
+        :return: dict, fragmentation before, whether it was vacuumed and bytes reclaimed
+        """
+        report = {'vacuumed': False, 'bytes_reclaimed': 0}
+        with Database(database, self.timeout) as db:
+            stats = db.file_stats()
+            report['fragmentation'] = stats['fragmentation']
+            if stats['fragmentation'] >= self.fragmentation and \
+                    stats['reclaimable'] >= self.min_bytes:
+                try:
+                    report['bytes_reclaimed'] = db.vacuum()
+                    report['vacuumed'] = True
+                except sqlite3.OperationalError as exc:
+                    print(f'{database}: VACUUM skipped, {exc}')
+        return report
+
+    def every(self, databases, interval, stop=None):
+        """
+        Runs the policy over each database every interval seconds, e.g. in a
+        daemon thread next to a poll loop, until stop is set.
+        :param databases: list of paths to sqlite db files
+        :param interval: float, seconds between runs
+        :param stop: threading.Event
+        """
+        stop = stop or Event()
+        while not stop.wait(interval):
+            for database in databases:
+                try:
+                    print(database, self.run(database))
+                except sqlite3.Error as exc:
+                    # Tried again at the next interval
+                    print(f'{database}: retention failed, {exc}')
+
+
+def search_ages(searches, plan=False, max_age=30 * DAY):
+    """
+    :param searches: list of saved search dicts; those with a max_age_days
+                     key keep their listings for that many days
+    :param plan: boolean, key the ages by SearchPlanner's merged URLs, each
+                 kept as long as its longest lived member
+    :param max_age: float, seconds kept for searches without max_age_days
+    :return: dict, RSS feed URL to seconds, for the searches that set one
+    """
+    if not plan:
+        return {Vehicle.from_search(search).get_url: search['max_age_days'] * DAY
+                for search in searches if search.get('max_age_days') is not None}
+    ages = {}
+    for query in SearchPlanner(searches).compile():
+        days = [search.get('max_age_days') for search, _, _ in query.members]
+        if any(day is not None for day in days):
+            ages[query.url] = max(max_age if day is None else day * DAY for day in days)
+    return ages
+
+
+def main():
+    parser = Ag()
+    parser.add_argument('databases', nargs='+')
+    parser.add_argument('--searches', help='saved searches, for their max_age_days')
+    parser.add_argument('--plan', action='store_true')
+    parser.add_argument('--max_age_days', type=float, default=30)
+    parser.add_argument('--max_entries', type=int)
+    parser.add_argument('--tombstone_days', type=float, default=90)
+    parser.add_argument('--fragmentation', type=float, default=0.25)
+    args = parser.parse_args()
+    ages = None
+    if args.searches:
+        with open(args.searches) as file:
+            ages = search_ages(json.load(file), args.plan, args.max_age_days * DAY)
+    retention = Retention(args.max_age_days * DAY, args.max_entries, args.tombstone_days * DAY,
+                          ages, fragmentation=args.fragmentation)
+    for database in args.databases:
+        print(database, retention.run(database))
+
+
+if __name__ == '__main__':
+    main()
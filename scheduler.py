@@ -0,0 +1,148 @@
+import heapq
+import random
+from time import monotonic
+
+
+class SearchState:
+    __slots__ = ('url', 'interval', 'rate', 'last_poll', 'due', 'polls', 'items')
+
+    def __init__(self, url, interval, due):
+        """
+        :param url: string, RSS feed URL
+        :param interval: float, current seconds between polls
+        :param due: float, monotonic time of the next poll
+        """
+        self.url = url
+        self.interval = interval
+        self.rate = 0.0
+        self.last_poll = None
+        self.due = due
+        self.polls = 0
+        self.items = 0
+
+    def __repr__(self):
+        return f'SearchState({self.url}, {self.interval:.0f}s, {self.rate * 3600:.2f}/h)'
+
+
+class Scheduler:
+
+    def __init__(self, min_interval=60, max_interval=3600, budget=60, jitter=0.1,
+                 target=1.0, smoothing=0.3, clock=monotonic, seed=None):
+        """
+        Polls each search about as often as it is expected to have target new
+        listings, backing off exponentially while it has none.
+        :param min_interval: float, shortest seconds between polls of one search
+        :param max_interval: float, longest seconds between polls of one search
+        :param budget: int, requests allowed per minute across all searches
+        :param jitter: float, fraction by which each interval is randomly spread
+        :param target: float, new listings wanted per poll
+        :param smoothing: float, weight of the latest poll in the arrival rate
+        :param clock: callable, returns the current time in seconds
+        :param seed: int, seed for the jitter
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.jitter = jitter
+        self.target = target
+        self.smoothing = smoothing
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.states = {}
+        self.queue = []
+        self.tokens = float(budget)
+        self.refilled = clock()
+
+    def __repr__(self):
+        return f'Scheduler({len(self.states)}, {self.budget}/min)'
+
+    def add(self, url):
+        if url in self.states:
+            return
+        now = self.clock()
+        state = SearchState(url, self.min_interval,
+                            now + self.random.uniform(0, self.min_interval))
+        self.states[url] = state
+        heapq.heappush(self.queue, (state.due, url))
+
+    def remove(self, url):
+        """
+        The queue entry is dropped lazily when it comes up.
+        """
+        self.states.pop(url, None)
+
+    def refill(self, now):
+        self.tokens = min(float(self.budget),
+                          self.tokens + (now - self.refilled) * self.budget / 60)
+        self.refilled = now
+
+    def due(self):
+        """
+        :return: list of URLs to poll now, within the request budget
+        """
+        now = self.clock()
+        self.refill(now)
+        urls = []
+        while self.queue and self.queue[0][0] <= now and self.tokens >= 1:
+            due, url = heapq.heappop(self.queue)
+            state = self.states.get(url)
+            if state is None or state.due != due:
+                continue
+            self.tokens -= 1
+            urls.append(url)
+        return urls
+
+    def next_wakeup(self):
+        """
+        :return: float, seconds until a poll is due and the budget allows it
+        """
+        now = self.clock()
+        self.refill(now)
+        while self.queue and self.states.get(self.queue[0][1]) is None:
+            heapq.heappop(self.queue)
+        if not self.queue:
+            return self.max_interval
+        wait = max(0.0, self.queue[0][0] - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) * 60 / self.budget)
+        return wait
+
+    def record(self, url, new_items):
+        """
+        Updates the arrival rate of a polled search and schedules its next poll.
+        :param url: string, RSS feed URL
+        :param new_items: int, new listings found, or None if the fetch failed
+        """
+        state = self.states.get(url)
+        if state is None:
+            return
+        now = self.clock()
+        if new_items and state.last_poll is not None:
+            observed = new_items / max(now - state.last_poll, 1.0)
+            state.rate += self.smoothing * (observed - state.rate)
+            interval = self.target / state.rate if state.rate > 0 else state.interval
+        elif new_items:
+            interval = state.interval
+        else:
+            interval = state.interval * 2
+            state.rate *= 1 - self.smoothing
+        state.interval = min(self.max_interval, max(self.min_interval, interval))
+        state.last_poll = now
+        state.polls += 1
+        state.items += new_items or 0
+        spread = self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        state.due = now + state.interval * spread
+        heapq.heappush(self.queue, (state.due, url))
+
+
+def main():
+    """
+    The long-running poll loop now lives in daemon.py; this takes the same options.
+    """
+    # Imported here, as daemon builds on this module
+    from daemon import main as daemon_main
+    daemon_main()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,83 @@
-from os import listdir, remove, path
+import asyncio
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+import json
+from os import getpid, kill, listdir, remove, path
+import pickle
+import signal
+import shutil
+import smtplib
+import socket
+import sqlite3
+import subprocess
+import sys
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Event, Thread
+from time import sleep, time
 import unittest
+from urllib.error import URLError
+from xml.etree.ElementTree import ParseError
 
+import catalog
 import classes
+import cli
+import daemon
+from fake_craigslist import FakeCraigslist, png, rss_document
+from metrics import METRICS
+import options
+import planner
+import poller
+import retention
+import scheduler
+import thumbnails
 
 DATABASE = path.join(path.dirname(__file__), 'test.db')
 DICT_FILE = path.join(path.dirname(__file__), 'test_dict.p')
+METRICS_FILE = path.join(path.dirname(__file__), 'test_metrics.jsonl')
 URL = 'https://denver.craigslist.org/search/cta?format=rss&bundleDuplicates=1&' \
       'searchNearby=1&min_auto_year=2015&max_auto_miles=30000&auto_make_model=' \
       'GTI&max_price=20000&auto_transmission=1&search_distance=150&postal=80013'
 
 
+class SMTPHandler(StreamRequestHandler):
+    """Just enough of SMTP to accept mail from smtplib, without TLS or auth"""
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command == 'DATA':
+                self.reply('354 go ahead')
+                lines = []
+                while True:
+                    data = self.rfile.readline().decode()
+                    if data.rstrip('\r\n') == '.':
+                        break
+                    lines.append(data)
+                self.server.messages.append(''.join(lines))
+            if command == 'RCPT' and 'bad@' in line:
+                self.reply('550 no such user')
+                continue
+            self.reply('250 ok')
+
+
+class SMTPServer(ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.messages = []
+
+
 class Base(unittest.TestCase):
 
     def assert_type_equal(self, obj1, obj2):
@@ -26,6 +94,8 @@ class TestStorage(Base):
             remove('test.db')
         if 'test_dict.p' in listdir(path.dirname(__file__)):
             remove('test_dict.p')
+        if 'test_dict.p.migrated' in listdir(path.dirname(__file__)):
+            remove('test_dict.p.migrated')
 
     def test_magic_methods(self):
         db = classes.Database(DATABASE)
@@ -35,10 +105,11 @@ class TestStorage(Base):
     def test_database_creation(self):
         self.assertIn('test.db', listdir(path.dirname(DATABASE)))
         with classes.Database(DATABASE) as db:
-            id, status, url = [item[0] for item in db.cursor.execute('SELECT * FROM posts').description]
+            id, status, url, search = [item[0] for item in db.cursor.execute('SELECT * FROM posts').description]
         self.assertEqual(id, 'id')
         self.assertEqual(status, 'notification_status')
         self.assertEqual(url, 'url')
+        self.assertEqual(search, 'search')
 
     def test_entry_insertion(self):
         id_num = 100
@@ -52,25 +123,980 @@ class TestStorage(Base):
         self.assertEqual(id_num, res[0])
         self.assertEqual(url, res[2])
 
-    def test_load_dict(self):
-        feed = classes.Feed(URL, DICT_FILE).load_dict()
-        self.assertEqual(len(feed), 0)
-        self.assert_type_equal({}, feed)
+    def test_crash_safety(self):
+        with classes.Database(DATABASE) as db:
+            self.assertEqual(db.cursor.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        with self.assertRaises(RuntimeError):
+            with classes.Database(DATABASE) as db:
+                db.insert_entry(100, 'www.google.com', URL)
+                self.assertEqual(db.seen_ids(URL, [100]), {100})
+                raise RuntimeError
+        with classes.Database(DATABASE) as db:
+            self.assertEqual(db.seen_ids(URL, [100]), set())
+
+    def test_seen_ids(self):
+        listings = [classes.Listing(f'post{num}', link=f'www.google.com/{num}') for num in range(5)]
+        with classes.Database(DATABASE) as db:
+            db.insert_entries(URL, listings)
+            db.insert_entries(URL, listings[:2])
+        with classes.Database(DATABASE) as db:
+            self.assertEqual(db.seen_ids(URL, ['post1', 'post4', 'post9']), {'post1', 'post4'})
+            self.assertEqual(db.seen_ids('other', ['post1']), set())
+            db.cursor.execute('SELECT COUNT(*) FROM posts')
+            self.assertEqual(db.cursor.fetchone()[0], 5)
+
+    def test_query_listings(self):
+        listings = [classes.Listing('a', '2015 GTI 30k miles $18,000', price=18000),
+                    classes.Listing('b', '2012 GTI $11,000', 'odometer: 95,000', price=11000),
+                    classes.Listing('c', '2008 GTI project $3,500', 'runs, 180000 mi', price=3500),
+                    classes.Listing('d', 'GTI wheels', price=400)]
+        with classes.Database(DATABASE) as db:
+            db.insert_entries(URL, listings[:2])
+            db.index_listings(listings)
+            self.assertEqual([listing.id for listing in db.query_listings(max_price=12000)],
+                             ['d', 'c', 'b'])
+            self.assertEqual([listing.id for listing in db.query_listings(
+                min_auto_year=2010, max_miles=100000)], ['b', 'a'])
+            self.assertEqual([listing.id for listing in db.query_listings(URL, min_price=5000)],
+                             ['b', 'a'])
+            self.assertEqual(len(db.query_listings(limit=1)), 1)
+            with self.assertRaises(ValueError):
+                db.query_listings(max_horsepower=300)
+        output = StringIO()
+        with redirect_stdout(output):
+            cli.query(['--database', DATABASE, '--max_miles', '50000'])
+        self.assertIn('2015 GTI 30k miles', output.getvalue())
+        self.assertNotIn('2012', output.getvalue())
+
+    def test_search_listings(self):
+        listings = [classes.Listing('a', '2015 GTI manual $18,000', 'clean title, one owner'),
+                    classes.Listing('b', '2012 GTI automatic $11,000', 'clean title'),
+                    classes.Listing('c', '2014 Golf', 'manuals and clean title GTI GTI GTI')]
+        with classes.Database(DATABASE) as db:
+            db.index_listings(listings)
+            found = db.search_listings(['manual', 'GTI', 'clean title'])
+            self.assertEqual(sorted(listing.id for listing in found), ['a', 'c'])
+            self.assertEqual(db.search_listings(['title clean']), [])
+            self.assertEqual(len(db.search_listings(['gti'], days=1)), 3)
+            self.assertEqual(db.search_listings(['"quoted']), [])
+            db.cursor.execute("UPDATE listings SET summary = 'salvage' WHERE id = 'a'")
+            db.cursor.execute("DELETE FROM listings WHERE id = 'b'")
+            self.assertEqual([listing.id for listing in db.search_listings(['salvage'])], ['a'])
+            self.assertEqual([listing.id for listing in db.search_listings(['clean'])], ['c'])
+        output = StringIO()
+        with redirect_stdout(output):
+            cli.search(['--database', DATABASE, 'golf'])
+        self.assertIn('2014 Golf', output.getvalue())
+
+    def test_migrate_dict(self):
+        with open(DICT_FILE, 'wb') as file:
+            pickle.dump({'post1': {'link': 'a', 'title': 'GTI &#x0024;9,500'},
+                         'post2': {'link': 'b'}}, file)
+        with classes.Database(DATABASE) as db:
+            self.assertEqual(db.migrate_dict(DICT_FILE, URL), 2)
+            self.assertEqual(db.migrate_dict(DICT_FILE, URL), 0)
+            self.assertEqual(db.seen_ids(URL, ['post1', 'post2']), {'post1', 'post2'})
+            db.cursor.execute('SELECT title, price FROM listings WHERE id = ?', ('post1',))
+            self.assertEqual(db.cursor.fetchone(), ('GTI $9,500', 9500))
+        self.assertNotIn('test_dict.p', listdir(path.dirname(__file__)))
+
+    def test_diff_changes(self):
+        entries = [{'id': name, 'title': f'2015 GTI {name} $18,000', 'summary': 'clean',
+                    'link': f'http://{name}'} for name in ('a', 'b', 'c')]
+        feed = classes.Feed(URL, DATABASE)
+        self.assertEqual([listing.status for listing in feed.diff(entries)], ['new'] * 3)
+        self.assertEqual(feed.diff(entries), [])
+        entries[0] = {**entries[0], 'title': '2015 GTI a $16,500'}
+        entries[1] = {**entries[1], 'summary': 'Clean!'}
+        entries[2] = {**entries[2], 'summary': 'salvage title'}
+        since = time()
+        changed = {listing.id: listing for listing in feed.diff(entries, since=since)}
+        self.assertEqual(sorted(changed), ['a', 'c'])
+        self.assertEqual((changed['a'].status, changed['a'].previous_price), ('price_drop', 18000))
+        self.assertEqual(changed['c'].status, 'changed')
+        self.assertEqual(feed.diff(entries), [])
+        # Another search polled later in the same cycle sees the same edits,
+        # and none of the listings the first search delivered earlier
+        other = classes.Feed('other', DATABASE)
+        with classes.Database(DATABASE) as db:
+            db.insert_entries('other', [classes.Listing('a')])
+        self.assertEqual([(listing.id, listing.status) for listing in other.diff(entries, since=since)],
+                         [('a', 'price_drop')])
+        with classes.Database(DATABASE) as db:
+            self.assertEqual([listing.title for listing in db.query_listings(max_price=17000)],
+                             ['2015 GTI a $16,500'])
+
+    def test_repost_changes(self):
+        entry = {'id': 'a', 'title': '2015 GTI $18,000', 'summary': 'clean', 'link': 'http://a'}
+        feed = classes.Feed(URL, DATABASE)
+        self.assertEqual(len(feed.diff([entry])), 1)
+        repost = {**entry, 'id': 'b', 'link': 'http://b'}
+        self.assertEqual(feed.diff([entry, repost], since=time()), [])
+        repost['title'] = '2015 GTI $15,000'
+        changed = feed.diff([entry, repost], since=time())
+        self.assertEqual([(listing.id, listing.status, listing.previous_price)
+                          for listing in changed], [('b', 'price_drop', 18000)])
+        with classes.Database(DATABASE) as db:
+            self.assertEqual([listing.id for listing in db.query_listings(max_price=16000)],
+                             ['b'])
+            first_seen = db.cursor.execute('SELECT DISTINCT first_seen FROM listings').fetchall()
+            self.assertEqual(len(first_seen), 1)
+
+    def test_unpriced_listings(self):
+        civics = [classes.Listing(name, '2012 Honda Civic', link=f'http://{name}')
+                  for name in 'ab']
+        self.assertIsNone(civics[0].fingerprint)
+        dispatcher = classes.Dispatcher(None)
+        dispatcher.add('Ann', 'ann@example.com', civics)
+        self.assertEqual(len(dispatcher.digests['ann@example.com'][1]), 2)
+        with classes.Database(DATABASE) as db:
+            db.index_listings(civics[:1])
+            self.assertEqual(db.index_listings(civics[1:], since=time() + 1), civics[1:])
+            db.record_deliveries('ann@example.com', civics[:1])
+            self.assertEqual(db.undelivered('ann@example.com', civics), civics[1:])
+
+    def test_refresh_feed(self):
+        with FakeCraigslist() as server:
+            url = server.url_for(URL)
+            feed = classes.Feed(url, DATABASE).refresh_feed()
+            self.assertGreater(len(feed), 0)
+            feed = classes.Feed(url, DATABASE).refresh_feed()
+            self.assertIsNone(feed)
+
+
+class TestListing(Base):
+
+    def test_from_entry(self):
+        entry = classes.Feed.parse(rss_document(1))[0]
+        listing = classes.Listing.from_entry(entry)
+        self.assertEqual(listing.title, '2015 GTI post $18000')
+        self.assertEqual(listing.price, 18000)
+        self.assertEqual(listing.image, 'https://images.craigslist.org/0.jpg')
+        self.assertEqual(listing.id, entry['id'])
+        self.assertEqual(pickle.loads(pickle.dumps(listing)), listing)
+        repost = classes.Listing('other', '2015  GTI post - $18,000', price=18000)
+        self.assertEqual(repost.fingerprint, listing.fingerprint)
+        self.assertIsNone(classes.Listing.parse_price('free to a good home'))
+
+    def test_year_and_miles(self):
+        listing = classes.Listing('a', '2015 Golf GTI - 31,500 miles $18,000', 'clean')
+        self.assertEqual((listing.year, listing.miles), (2015, 31500))
+        listing = classes.Listing('a', 'VW GTI $9,000', 'Odometer: 120k, manual')
+        self.assertEqual((listing.year, listing.miles), (None, 120000))
+        self.assertIsNone(classes.Listing('a', 'GTI', 'low miles').miles)
+
+    def test_posted(self):
+        self.assertEqual(classes.Listing.parse_posted({'published': '2018-02-26T11:24:55-07:00'}),
+                         1519669495)
+        self.assertIsNone(classes.Listing.parse_posted({'published': 'yesterday'}))
+
+
+class TestFakeCraigslist(Base):
+
+    def test_churn_and_conditional(self):
+        with FakeCraigslist(size=5, churn=1000) as server:
+            url = server.url_for('https://boulder.craigslist.org/search/cto?format=rss')
+            self.assertTrue(url.startswith(f'{server.base}/boulder/search/cto?'))
+            first = classes.Feed(url, DATABASE).fetch()
+            sleep(0.01)
+            second = classes.Feed(url, DATABASE).fetch(etag=first[2])
+        self.assertEqual(first[0], 200)
+        self.assertEqual(len(classes.Feed.parse(first[1])), 5)
+        self.assertEqual(second[0], 200)
+        self.assertNotEqual(first[2], second[2])
+        with FakeCraigslist(size=5) as server:
+            url = server.url_for('https://boulder.craigslist.org/search/cto?format=rss')
+            etag = classes.Feed(url, DATABASE).fetch()[2]
+            self.assertEqual(classes.Feed(url, DATABASE).fetch(etag=etag)[0], 304)
+            self.assertEqual(server.not_modified, 1)
+
+
+class TestMetrics(Base):
+
+    def setUp(self):
+        classes.Database.init_database(DATABASE)
+        METRICS.reset()
+        METRICS.enable(events=True)
+
+    def tearDown(self):
+        METRICS.disable()
+        METRICS.reset()
+        for name in ('test.db', 'test_metrics.jsonl', 'test_metrics.prom'):
+            if name in listdir(path.dirname(__file__)):
+                remove(name)
+
+    def test_poll_stages(self):
+        with FakeCraigslist(size=4) as server:
+            url = server.url_for(URL)
+            with poller.Poller(DATABASE) as p:
+                p.run([url])
+        classes.Message('Ann', 'ann@example.com', [], send=False)
+        text = METRICS.prometheus()
+        for stage in ('fetch', 'parse', 'store'):
+            self.assertIn(f'carsearch_stage_seconds_count{{stage="{stage}",search="{url}"}} 1', text)
+        self.assertIn('carsearch_stage_seconds_count{stage="render"} 2', text)
+        self.assertIn(f'carsearch_new_items_total{{search="{url}"}} 4', text)
+        METRICS.write_jsonl(METRICS_FILE)
+        with open(METRICS_FILE) as file:
+            events = [json.loads(line) for line in file]
+        self.assertEqual(len(events), 7)
+        self.assertEqual(METRICS.events, [])
+
+    def test_unbuffered(self):
+        METRICS.enable(events=False)
+        for _ in range(3):
+            with METRICS.stage('fetch', URL):
+                METRICS.count('fetch_bytes', 100, URL)
+        self.assertIn('carsearch_fetch_bytes_total', METRICS.prometheus())
+        self.assertEqual(METRICS.events, [])
+
+    def test_sharded(self):
+        with FakeCraigslist(size=4) as server:
+            urls = [f'{server.base}/{name}?format=rss' for name in 'ab']
+            with poller.ShardedPoller(DATABASE, shards=2) as p:
+                p.run(urls)
+            with self.assertRaises(ValueError):
+                poller.ShardedPoller(DATABASE, shards=2, cache=poller.FeedCache())
+        text = METRICS.prometheus()
+        for url in urls:
+            self.assertIn(f'carsearch_stage_seconds_count{{stage="fetch",search="{url}"}} 1', text)
+            self.assertIn(f'carsearch_new_items_total{{search="{url}"}} 4', text)
+        for database in p.databases:
+            if path.exists(database):
+                remove(database)
+
+    def test_write_prometheus(self):
+        prometheus_file = path.join(path.dirname(__file__), 'test_metrics.prom')
+        METRICS.count('new_items', 3)
+        METRICS.write_prometheus(prometheus_file)
+        METRICS.write_prometheus(prometheus_file)
+        with open(prometheus_file) as file:
+            self.assertEqual(file.read(), METRICS.prometheus())
+        self.assertFalse([name for name in listdir(path.dirname(prometheus_file))
+                          if name.startswith('.tmp-')])
+
+    def test_disabled(self):
+        METRICS.disable()
+        self.assertIs(METRICS.stage('fetch'), METRICS.null_timer)
+        METRICS.count('new_items', 1)
+        self.assertEqual(METRICS.counters, {})
+
+
+class TestStreamingParser(Base):
+
+    def test_fields_match_feedparser(self):
+        document = rss_document(2).encode()
+        streamed = list(classes.Feed.stream(document))
+        parsed = classes.Feed.parse(document)
+        self.assertEqual(len(streamed), 2)
+        for listing, entry in zip(streamed, parsed):
+            for key in ('id', 'title', 'summary', 'link', 'enc_enclosure'):
+                self.assertEqual(listing[key], entry[key])
+
+    def test_stops_at_known_run(self):
+        document = rss_document(20).encode()
+        known = {f'https://denver.craigslist.org/cto/d/post/{num}.html' for num in range(5, 20)}
+        known.add('https://denver.craigslist.org/cto/d/post/2.html')
+        streamed = list(classes.Feed.stream(document, known.__contains__, stop_after=3))
+        self.assertEqual(len(streamed), 7)
+        self.assertEqual(streamed[4]['link'], 'https://denver.craigslist.org/cto/d/post/4.html')
+
+
+class TestPoller(Base):
+
+    def setUp(self):
+        classes.Database.init_database(DATABASE)
+        self.server = FakeCraigslist(size=3).start()
+        self.base = self.server.base
+
+    def tearDown(self):
+        self.server.stop()
+        for file in listdir(path.dirname(__file__)):
+            if file.startswith('test.') and file.endswith('.db'):
+                remove(file)
+
+    def test_poll_all(self):
+        urls = [f'{self.base}/{name}?format=rss' for name in ('a', 'b', 'c')]
+        with poller.Poller(DATABASE, concurrency=2) as p:
+            results = p.run(urls + urls[:1])
+            self.assertEqual(list(results), urls)
+            self.assertEqual([len(items) for items in results.values()], [3, 3, 3])
+            self.assertEqual(results[urls[0]][0].title, '2015 GTI a $18002')
+            self.assertEqual(results[urls[0]][0].price, 18002)
+            results = p.run(urls)
+            self.assertEqual([len(items) for items in results.values()], [0, 0, 0])
+        with classes.Database(DATABASE) as db:
+            stats = db.poll_stats()
+            self.assertEqual(db.validators(urls[0]), ('"/a:2"', None))
+        self.assertEqual(stats['polls'], 6)
+        self.assertEqual(stats['unchanged'], 3)
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertEqual(stats['bytes_saved'], stats['bytes'])
+
+    def test_sharded(self):
+        urls = [f'{self.base}/{name}?format=rss' for name in ('a', 'b', 'c', 'd')]
+        self.assertEqual(poller.shard_of(urls[0], 2),
+                         poller.shard_of(urls[0].replace('format=rss', 'max_price=1'), 2))
+        with poller.ShardedPoller(DATABASE, shards=2, concurrency=2) as p:
+            results = p.run(urls)
+            self.assertEqual(list(results), urls)
+            self.assertEqual([len(items) for items in results.values()], [3, 3, 3, 3])
+            self.assertEqual(results[urls[1]][0].title, '2015 GTI b $18002')
+            results = p.run(urls)
+            self.assertEqual([len(items) for items in results.values()], [0, 0, 0, 0])
+        polls = 0
+        for database in p.databases:
+            self.assertTrue(path.exists(database))
+            with classes.Database(database) as db:
+                polls += db.poll_stats()['polls']
+        self.assertEqual(polls, 8)
+
+    def test_cross_search_dedup(self):
+        urls = [f'{self.base}/shared?format=rss&max_price={price}' for price in (1, 2)]
+        with poller.Poller(DATABASE) as p:
+            results = p.run(urls)
+            late = p.run([f'{self.base}/shared?format=rss&max_price=3'])
+        self.assertEqual([len(items) for items in results.values()], [3, 3])
+        self.assertEqual([len(items) for items in late.values()], [0])
+        server = SMTPServer()
+        Thread(target=server.serve_forever, daemon=True).start()
+        mailer = classes.Mailer('127.0.0.1', server.server_address[1], 'sender@example.com',
+                                '', starttls=False)
+        with mailer, classes.Dispatcher(mailer) as dispatcher:
+            for url, label in zip(urls, ('cheap', 'cheaper')):
+                dispatcher.add('Ann', 'ann@example.com', results[url], label)
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(len(server.messages), 1)
+        # once per listing in each of the text and html parts
+        self.assertEqual(server.messages[0].count('Matched: cheap, cheaper'), 6)
+
+    def test_streaming(self):
+        url = f'{self.base}/e?format=rss'
+        with poller.Poller(DATABASE, streaming=True) as p:
+            self.assertEqual(len(p.run([url])[url]), 3)
+            self.assertEqual(classes.Feed(url, DATABASE, streaming=True).refresh_feed(), None)
+
+    def test_feed_cache(self):
+        urls = [f'{self.base}/f?format=rss&auto_make_model=GTI&max_price=1',
+                f'{self.base}/f?max_price=1&auto_make_model=gti&format=rss',
+                f'{self.base}/g?format=rss']
+        cache = poller.FeedCache()
+        for streaming in (False, True):
+            with poller.Poller(DATABASE, cache=cache, streaming=streaming) as p:
+                results = p.run(urls)
+            self.assertEqual([len(items) for items in results.values()],
+                             [3, 3, 3] if not streaming else [0, 0, 0])
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(cache.stats()['hits'], 4)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_feed_cache_eviction(self):
+        clock = Clock()
+        cache = poller.FeedCache(max_bytes=250, ttl=60, clock=clock)
+        for name in 'abc':
+            cache.put(f'http://example.com/{name}', [name], size=100)
+        self.assertEqual((len(cache), cache.size, cache.evictions), (2, 200, 1))
+        self.assertIsNone(cache.get('http://example.com/a'))
+        self.assertEqual(cache.get('http://EXAMPLE.com/b')[0], ['b'])
+        cache.put('http://example.com/d', ['d'], size=100)
+        self.assertIsNotNone(cache.get('http://example.com/b'))
+        self.assertIsNone(cache.get('http://example.com/c'))
+        clock.now = 61
+        self.assertIsNone(cache.get('http://example.com/b'))
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_refresh_feed_conditional(self):
+        url = f'{self.base}/d?format=rss'
+        self.assertEqual(len(classes.Feed(url, DATABASE).refresh_feed()), 3)
+        self.assertIsNone(classes.Feed(url, DATABASE).refresh_feed())
+        with classes.Database(DATABASE) as db:
+            self.assertEqual(db.poll_stats(url)['unchanged'], 1)
+            self.assertGreater(db.poll_stats(url)['bytes_saved'], 0)
+        with FakeCraigslist(size=3) as server:
+            url = f'{server.base}/d?format=rss'
+            classes.Feed(url, DATABASE).refresh_feed()
+        feed = classes.Feed(url, DATABASE)
+        with redirect_stdout(StringIO()):
+            self.assertIsNone(feed.refresh_feed())
+        self.assertIsInstance(feed.error, URLError)
+        with classes.Database(DATABASE) as db:
+            self.assertIsNotNone(db.validators(url)[0])
+            self.assertEqual(db.poll_stats(url)['polls'], 1)
+
+    def test_failed_fetch(self):
+        url = 'http://127.0.0.1:1/closed'
+        with poller.Poller(DATABASE) as p:
+            self.assertEqual(p.run([url]), {url: None})
+            self.assertIn(url, p.errors)
+
+    def test_unparsable_feed(self):
+        for streaming in (True, False):
+            urls = [f'{self.base}/blocked/cta?format=rss', f'{self.base}/h{streaming}?format=rss']
+            with poller.Poller(DATABASE, streaming=streaming) as p:
+                results = p.run(urls)
+                self.assertEqual((results[urls[0]], len(results[urls[1]])), (None, 3))
+                self.assertIsInstance(p.errors[urls[0]], ParseError)
+            for url, error in ((urls[0], ParseError), ('http://127.0.0.1:1/closed', URLError)):
+                feed = classes.Feed(url, DATABASE, streaming=streaming)
+                with redirect_stdout(StringIO()):
+                    self.assertIsNone(feed.refresh_feed())
+                self.assertIsInstance(feed.error, error)
+                with classes.Database(DATABASE) as db:
+                    self.assertEqual(db.validators(url), (None, None))
+                    self.assertEqual(db.poll_stats(url)['polls'], 0)
+
+
+class TestNotification(Base):
+
+    def setUp(self):
+        self.server = SMTPServer()
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.mailer = classes.Mailer('127.0.0.1', self.server.server_address[1],
+                                     'sender@example.com', '', starttls=False,
+                                     max_messages=2)
+
+    def tearDown(self):
+        self.mailer.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if 'test.db' in listdir(path.dirname(__file__)):
+            remove('test.db')
+
+    def test_digests_share_connection(self):
+        listing = classes.Listing('a', 'GTI', 'clean', 'http://a')
+        with classes.Dispatcher(self.mailer) as dispatcher:
+            dispatcher.add('Ann', 'ann@example.com', [listing])
+            dispatcher.add('Ann', 'ann@example.com', [classes.Listing('b', 'GTI', 'clean', 'http://b')])
+            dispatcher.add('Bob', 'bob@example.com', [listing])
+            dispatcher.add('Cat', 'cat@example.com', [])
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.mailer.connections, 1)
+        self.assertIn('To: ann@example.com', self.server.messages[0])
+
+    def test_per_recipient_delivery(self):
+        classes.Database.init_database(DATABASE)
+        with FakeCraigslist(size=3) as server:
+            # Overlapping feeds: the same path, so the same listings
+            gti = server.url_for('https://denver.craigslist.org/search/cta?auto_make_model=gti')
+            cars = server.url_for('https://denver.craigslist.org/search/cta?max_price=20000')
+            with classes.Database(DATABASE) as db:
+                db.add_subscriptions([('Ann', 'ann@example.com', gti, 'gti', '{}'),
+                                      ('Bob', 'bob@example.com', cars, 'cars', '{}')])
+            routes = poller.load_subscriptions(DATABASE)
+
+            def cycle(results):
+                before = len(self.server.messages)
+                with classes.Dispatcher(self.mailer, database=DATABASE) as dispatcher:
+                    poller.dispatch(dispatcher, routes, results)
+                return {message.split('To: ')[1].split()[0]: message
+                        for message in self.server.messages[before:]}
+
+            # Due in different cycles, as the scheduler has them
+            polling = poller.Poller(DATABASE, per_recipient=True)
+            self.assertEqual(list(cycle(polling.run([gti]))), ['ann@example.com'])
+            sent = cycle(polling.run([cars]))
+        self.assertEqual(list(sent), ['bob@example.com'])
+        self.assertEqual(sent['bob@example.com'].count('Link: '), 3)
+
+        def diff(polls):
+            return {url: classes.Feed(url, DATABASE).diff(items) for url, items in polls.items()}
+
+        entry = classes.Feed.parse(rss_document(3, 'denver-search-cta'))[1]
+        # The same car under a new post reaches neither of them again
+        repost = {**entry, 'id': 'repost'}
+        self.assertEqual(cycle(diff({gti: [repost], cars: [repost]})), {})
+        # An edit reaches each of them once, whichever feed stores it first
+        drop = {**entry, 'title': '2015 GTI $16,000'}
+        self.assertIn('Price drops', cycle(diff({cars: [drop]}))['bob@example.com'])
+        self.assertIn('Price drops', cycle(diff({gti: [drop]}))['ann@example.com'])
+        self.assertEqual(cycle(diff({gti: [drop], cars: [drop]})), {})
+
+    def test_refused_recipient(self):
+        listing = classes.Listing('a', 'GTI', 'clean', 'http://a')
+        with redirect_stdout(StringIO()) as out:
+            with classes.Dispatcher(self.mailer) as dispatcher:
+                for name in ('ann', 'bad', 'bob', 'cat'):
+                    dispatcher.add(name, f'{name}@example.com', [listing])
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(list(dispatcher.failures), ['bad@example.com'])
+        self.assertIsInstance(dispatcher.failures['bad@example.com'],
+                              smtplib.SMTPRecipientsRefused)
+        self.assertIn('bad@example.com', out.getvalue())
+
+    def test_reconnects(self):
+        listing = classes.Listing('a', 'GTI', 'clean', 'http://a')
+        for num in range(3):
+            classes.Message('Ann', f'{num}@example.com', [listing], send=False).send_email(self.mailer)
+        self.assertEqual(self.mailer.connections, 2)
+        self.mailer.server.sock.shutdown(socket.SHUT_RDWR)
+        classes.Message('Ann', 'ann@example.com', [listing], send=False).send_email(self.mailer)
+        self.assertEqual(self.mailer.connections, 3)
+        self.assertEqual(len(self.server.messages), 4)
+
+    def test_digest_sections(self):
+        listings = [classes.Listing('a', 'GTI a', 'clean', 'http://a', price=9000),
+                    classes.Listing('b', 'GTI b', 'clean', 'http://b', price=8000,
+                                    status='price_drop', previous_price=10500),
+                    classes.Listing('c', 'GTI c', 'salvage', 'http://c', status='changed')]
+        message = classes.Message('Ann', 'ann@example.com', listings, send=False)
+        for text in (message.html_message, message.text_message):
+            self.assertLess(text.index('New listings'), text.index('GTI a'))
+            self.assertLess(text.index('GTI a'), text.index('Price drops'))
+            self.assertLess(text.index('Price drops'), text.index('GTI b'))
+            self.assertLess(text.index('GTI b'), text.index('Updated listings'))
+            self.assertIn('Price dropped from $10,500 to $8,000', text)
+        message = classes.Message('Ann', 'ann@example.com', listings[:1], send=False)
+        self.assertNotIn('New listings', message.text_message)
+
+    def test_fragment_cache(self):
+        renderer = classes.Renderer(max_fragments=8)
+        uncached = classes.Renderer(max_fragments=0)
+        listings = [classes.Listing(name, f'GTI {name}', 'clean', f'http://{name}',
+                                    f'http://{name}.jpg') for name in 'abc']
+        for num in range(3):
+            matched = {'a': [f'search {num}']}
+            for render in ('render_html', 'render_text'):
+                self.assertEqual(getattr(renderer, render)('Ann', listings, matched),
+                                 getattr(uncached, render)('Ann', listings, matched))
+        # One per listing and format, and one per distinct matched line
+        self.assertEqual(len(renderer.fragments), 8)
+        self.assertEqual(len(uncached.fragments), 0)
+        edited = classes.Listing('a', 'GTI a', 'salvage', 'http://a', 'http://a.jpg')
+        self.assertIn('salvage', renderer.render_text('Ann', [edited]))
+
+    def test_shared_renderer(self):
+        listing = classes.Listing('a', 'GTI & co', 'clean', 'http://a', 'http://a.jpg')
+        self.assertIs(classes.Renderer.shared(), classes.Renderer.shared())
+        message = classes.Message('Ann', 'ann@example.com', [listing], send=False)
+        self.assertIn('GTI &amp; co', message.html_message)
+        self.assertIn('<img src="http://a.jpg">', message.html_message)
+        self.assertIn('Hello, Ann', message.text_message)
+        self.assertEqual(message.html_message,
+                         classes.Renderer().render_html('Ann', [listing]))
+
+    def test_inline_thumbnails(self):
+        cache_dir = path.join(path.dirname(__file__), 'test_thumbnails')
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        with FakeCraigslist() as server:
+            listings = [classes.Listing(name, f'GTI {name}', 'clean', f'http://{name}',
+                                        f'{server.base}/images/{name}.jpg') for name in 'ab']
+            listings.append(classes.Listing('c', 'GTI c', 'clean', 'http://c',
+                                            'http://127.0.0.1:1/gone.jpg'))
+            cache = thumbnails.Thumbnails(cache_dir)
+            with classes.Dispatcher(self.mailer, cache) as dispatcher:
+                dispatcher.add('Ann', 'ann@example.com', listings)
+                dispatcher.add('Bob', 'bob@example.com', listings[:1])
+            # A new instance finds the thumbnails through the saved index
+            thumbnails.Thumbnails(cache_dir).prefetch(listing.image for listing in listings)
+            self.assertEqual(server.image_requests, 2)
+        digest, _ = cache.get(listings[0].image)
+        ann, bob = self.server.messages
+        # Both images have the same bytes, so they share one attachment
+        self.assertEqual(ann.count('Content-ID:'), 1)
+        self.assertEqual(ann.count(f'src="cid:{digest}@carsearch"'), 2)
+        self.assertIn(f'Content-ID: <{digest}@carsearch>', bob)
+        self.assertIn(f'src="cid:{digest}@carsearch"', bob)
+        self.assertIn('src="http://127.0.0.1:1/gone.jpg"', ann)
+
+    def test_thumbnail_eviction(self):
+        cache_dir = path.join(path.dirname(__file__), 'test_thumbnails')
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        cache = thumbnails.Thumbnails(cache_dir, max_bytes=250)
+        for num in range(3):
+            cache.put(f'http://{num}.jpg', bytes([num]) * 100, 'jpeg')
+            sleep(0.01)
+        self.assertEqual(cache.evict(keep=['http://0.jpg']), 100)
+        self.assertIsNotNone(cache.get('http://0.jpg'))
+        self.assertIsNone(cache.get('http://1.jpg'))
+        self.assertEqual(thumbnails.image_type(b'\x89PNG\r\n\x1a\n'), 'png')
+        self.assertIsNone(thumbnails.image_type(b'<html>'))
+        if thumbnails.Image is None:
+            image = png()
+            with redirect_stdout(StringIO()) as out:
+                raw = thumbnails.Thumbnails(cache_dir, max_raw_bytes=len(image))
+            self.assertIn('not scaled', out.getvalue())
+            self.assertEqual(raw.thumbnail(image), (image, 'png'))
+            raw.max_raw_bytes -= 1
+            self.assertIsNone(raw.thumbnail(image))
+
+
+class TestPlanner(Base):
+
+    def search(self, city='denver', name=None, **options):
+        search = {'city': city, 'vehicle_type': 'cage', 'seller_type': 'all',
+                  'search': 'GTI', 'options': options}
+        if name is not None:
+            search['name'] = name
+        return search
+
+    def test_compile(self):
+        searches = [
+            self.search(name='a', max_price=20000, transmission='manual'),
+            self.search(name='b', max_price=15000, min_auto_year=2012, transmission='manual'),
+            self.search(name='c', max_price=25000, transmission='manual', has_images=False),
+            self.search(name='d', max_price=25000, transmission='automatic'),
+            self.search(city='boulder', name='e', max_price=20000),
+        ]
+        planned = planner.SearchPlanner(searches)
+        queries = planned.compile()
+        self.assertEqual(len(queries), 3)
+        manual = queries[0]
+        self.assertEqual(manual.search['options'], {'max_price': 25000, 'transmission': 'manual'})
+        self.assertEqual([name for _, name, _ in manual.members], ['a', 'b', 'c'])
+        self.assertEqual(manual.members[1][2].bounds, {'max_price': 15000, 'min_auto_year': 2012})
+        self.assertEqual(manual.members[2][2].bounds, {})
+        self.assertEqual(planned.report(queries)['saved'], 2)
+
+    def test_load_searches(self):
+        searches_file = path.join(path.dirname(__file__), 'test_searches.json')
+        self.addCleanup(remove, searches_file)
+        with open(searches_file, 'w') as file:
+            json.dump([self.search(name=name, max_price=price)
+                       for name, price in (('a', 20000), ('b', 20000), ('c', 10000))], file)
+        routes = poller.load_searches(searches_file)
+        self.assertEqual([[name for name, _, _ in members] for members in routes.values()],
+                         [['a', 'b'], ['c']])
+
+    def test_local_filter(self):
+        local = planner.LocalFilter({'max_price': 15000, 'min_auto_year': 2012})
+        listings = [classes.Listing('a', '2015 GTI $14,000', price=14000),
+                    classes.Listing('b', '2015 GTI $16,000', price=16000),
+                    classes.Listing('c', '2010 GTI $9,000', price=9000),
+                    classes.Listing('d', 'GTI, call for price')]
+        self.assertEqual([listing.id for listing in local.apply(listings)], ['a', 'd'])
+
+
+class TestCatalog(Base):
+
+    def tearDown(self):
+        for name in ('test_catalog.csv', 'test_catalog.jsonl', 'test.db'):
+            if name in listdir(path.dirname(__file__)):
+                remove(name)
+
+    def test_matches_vehicle(self):
+        searches = [
+            {'city': 'Fort Collins', 'vehicle_type': 'cage', 'seller_type': 'owner',
+             'search': ' Civic  SI', 'options': {'max_price': 9000, 'has_images': True,
+                                                 'transmission': 'manual', 'cylinders': 4,
+                                                 'postal_code': '02134', 'crypto': False}},
+            {'city': 'denver', 'vehicle_type': 'motorcycle', 'seller_type': 'all',
+             'options': {'titles_only': 'yes', 'min_miles': '100', 'condition': 'like new'}},
+        ]
+        bulk = catalog.Catalog()
+        for search in searches:
+            url, canonical = bulk.canonical(search)
+            self.assertEqual(canonical, planner.SearchPlanner.canonical(canonical))
+            self.assertEqual(url, classes.Vehicle.from_search(canonical).get_url)
+        self.assertEqual(canonical['options'], {'condition': 'like new', 'min_miles': 100,
+                                                'titles_only': True})
+
+    def test_bulk_errors(self):
+        csv_file = path.join(path.dirname(__file__), 'test_catalog.csv')
+        with open(csv_file, 'w') as file:
+            file.write('name,city,vehicle_type,seller_type,search,has_images,transmission,'
+                       'max_price\n'
+                       'a,Denver,cage,all,GTI,yes,manual,20000\n'
+                       'b,denver ,cage,all,gti ,1,manual,20000\n'
+                       'c,denver,cage,nobody,,,,\n'
+                       'd,boulder,cage,all,,maybe,stick,20k\n'
+                       'e,boulder,cage,owner,,,,\n')
+        bulk = catalog.Catalog().load(csv_file)
+        self.assertEqual(bulk.report(), {'rows': 5, 'urls': 2, 'duplicates': 1, 'invalid': 2})
+        self.assertEqual([line for line, _ in bulk.errors], [4, 5])
+        self.assertEqual(bulk.errors[1][1].count('Invalid value'), 3)
+        self.assertEqual(bulk.searches[bulk.urls[0]]['name'], 'a')
+
+        jsonl_file = path.join(path.dirname(__file__), 'test_catalog.jsonl')
+        with open(jsonl_file, 'w') as file:
+            file.write(json.dumps({'city': 'denver', 'vehicle_type': 'cage',
+                                   'seller_type': 'all', 'options': {'colour': 'red'}}))
+            file.write('\n{"city": \n')
+        with redirect_stdout(StringIO()) as out, self.assertRaises(SystemExit):
+            cli.import_catalog([jsonl_file])
+        self.assertEqual(out.getvalue().strip(), '')
+
+
+    def test_subscribe(self):
+        jsonl_file = path.join(path.dirname(__file__), 'test_catalog.jsonl')
+        gti = {'city': 'denver', 'vehicle_type': 'cage', 'seller_type': 'all', 'search': 'GTI'}
+        with open(jsonl_file, 'w') as file:
+            for row in ({**gti, 'user': 'Ann', 'email': 'ann@example.com'},
+                        {**gti, 'search': ' gti', 'email': 'bob@example.com', 'name': 'hot hatch'},
+                        {**gti, 'city': 'boulder', 'email': 'ann@example.com'},
+                        {**gti, 'city': 'boulder'}):
+                file.write(json.dumps(row) + '\n')
+        with redirect_stderr(StringIO()) as err, self.assertRaises(SystemExit):
+            cli.subscribe([jsonl_file, '--database', DATABASE])
+        self.assertIn(':4: Missing email', err.getvalue())
+        routes = poller.load_subscriptions(DATABASE)
+        url, canonical = catalog.Catalog().canonical(gti)
+        self.assertEqual(url, classes.Vehicle.from_search(canonical).get_url)
+        self.assertEqual(sorted(routes[url]), [
+            ('denver cta gti', None, ('Ann', 'ann@example.com')),
+            ('hot hatch', None, ('bob@example.com', 'bob@example.com'))])
+        self.assertEqual(len(routes), 2)
+
+        class Collect:
+            def __init__(self):
+                self.added = []
+
+            def add(self, user, email_address, listings, search=None):
+                self.added.append((email_address, search, len(listings)))
+
+        collect = Collect()
+        poller.dispatch(collect, routes, {url: [classes.Listing('a')]})
+        self.assertEqual(sorted(collect.added), [('ann@example.com', 'denver cta gti', 1),
+                                                 ('bob@example.com', 'hot hatch', 1)])
+        with redirect_stderr(StringIO()), self.assertRaises(SystemExit):
+            cli.subscribe([jsonl_file, '--database', DATABASE])
+        with redirect_stdout(StringIO()) as out:
+            cli.unsubscribe(['ann@example.com', '--database', DATABASE])
+        self.assertEqual(out.getvalue(), 'ann@example.com 2\n')
+        self.assertEqual(list(poller.load_subscriptions(DATABASE)), [url])
+
+
+class TestRetention(Base):
+
+    def setUp(self):
+        classes.Database.init_database(DATABASE)
+        self.now = 1000 * retention.DAY
+        ages = {'a': 5, 'b': 5, 'c': 40, 'd': 40, 'e': 100}
+        listings = {name: classes.Listing(name, f'2015 GTI {name} ${18000 + len(name)}',
+                                          'GTI summary', f'https://example.com/{name}')
+                    for name in ages}
+        with classes.Database(DATABASE) as db:
+            db.index_listings(listings.values())
+            db.insert_entries('kept', [listings['c']])
+            db.insert_entries('default', list(listings.values()))
+            db.cursor.executemany('UPDATE listings SET first_seen = ? WHERE id = ?',
+                                  [(self.now - age * retention.DAY, name)
+                                   for name, age in ages.items()])
+
+    def tearDown(self):
+        if 'test.db' in listdir(path.dirname(__file__)):
+            remove('test.db')
+
+    def test_run(self):
+        policy = retention.Retention(30 * retention.DAY, tombstone_age=90 * retention.DAY,
+                                     ages={'kept': 60 * retention.DAY}, batch=1, pause=0,
+                                     fragmentation=0.0, min_bytes=0)
+        report = policy.run(DATABASE, self.now)
+        self.assertEqual(report['expired'], 2)
+        self.assertEqual(report['dropped'], 1)
+        self.assertTrue(report['vacuumed'])
+        with classes.Database(DATABASE) as db:
+            self.assertEqual([listing.id for listing in db.query_listings()], ['b', 'a', 'c'])
+            self.assertEqual([listing.id for listing in db.search_listings(['GTI'])],
+                             ['a', 'b', 'c'])
+            self.assertEqual(db.seen_ids('default', 'abcde'), {'a', 'b', 'c', 'd'})
+            self.assertIsNotNone(db.resolve(classes.Listing('d')))
+            self.assertEqual(db.index_listings([classes.Listing('d')], since=self.now), [])
+
+    def test_max_entries(self):
+        policy = retention.Retention(365 * retention.DAY, max_entries=2, batch=2, pause=0)
+        report = policy.run(DATABASE, self.now)
+        self.assertEqual((report['capped'], report['vacuumed']), (3, False))
+        with classes.Database(DATABASE) as db:
+            self.assertEqual([listing.id for listing in db.query_listings()], ['b', 'a'])
+
+    def test_open_cycle(self):
+        policy = retention.Retention(30 * retention.DAY, batch=1, pause=0, fragmentation=0.0,
+                                     min_bytes=0, timeout=0.05, backoff=0.05)
+        started, finish = Event(), Event()
+
+        def cycle():
+            with classes.Database(DATABASE) as db:
+                db.insert_entries('default', [classes.Listing('f')])
+                started.set()
+                finish.wait()
+                sleep(0.2)
+
+        writer = Thread(target=cycle)
+        writer.start()
+        started.wait()
+        with redirect_stdout(StringIO()) as out:
+            self.assertFalse(policy.compact(DATABASE)['vacuumed'])
+            finish.set()
+            report = policy.run(DATABASE, self.now)
+        writer.join()
+        self.assertIn('VACUUM skipped', out.getvalue())
+        self.assertIn('retrying', out.getvalue())
+        self.assertEqual(report['expired'], 3)
+        self.assertTrue(report['vacuumed'])
+        with classes.Database(DATABASE) as db:
+            self.assertEqual(db.seen_ids('default', 'f'), {'f'})
+
+    def test_search_ages(self):
+        searches = [{'city': 'denver', 'vehicle_type': 'cage', 'seller_type': 'all',
+                     'options': {'max_price': price}, 'max_age_days': days}
+                    for price, days in ((10000, 10), (20000, None))]
+        ages = retention.search_ages(searches)
+        self.assertEqual(list(ages.values()), [10 * retention.DAY])
+        planned = retention.search_ages(searches, plan=True, max_age=30 * retention.DAY)
+        self.assertEqual(list(planned.values()), [30 * retention.DAY])
+
+
+class LocalDaemon(daemon.Daemon):
+    """Polls the saved searches on a FakeCraigslist"""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server = server
+
+    def load(self):
+        return {self.server.url_for(url): routes for url, routes in super().load().items()}
+
+
+class TestDaemon(Base):
+
+    def setUp(self):
+        self.searches_file = path.join(path.dirname(__file__), 'test_searches.json')
+        self.write_searches(['GTI'])
+        self.smtp = SMTPServer()
+        Thread(target=self.smtp.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.smtp.shutdown()
+        self.smtp.server_close()
+        for name in listdir(path.dirname(__file__)):
+            if name in ('test.db', 'test_searches.json') or name.startswith('test.shard'):
+                remove(name)
+
+    def write_searches(self, terms):
+        with open(self.searches_file, 'w') as file:
+            # A city each, as FakeCraigslist serves the same listings on one path
+            json.dump([{'city': city, 'vehicle_type': 'cage', 'seller_type': 'all',
+                        'search': term, 'name': term}
+                       for city, term in zip(('denver', 'boulder'), terms)], file)
+
+    def test_signals(self):
+        mailer = classes.Mailer('127.0.0.1', self.smtp.server_address[1], 'sender@example.com',
+                                '', starttls=False)
+        polling = scheduler.Scheduler(min_interval=0.05, max_interval=0.1, budget=6000)
+
+        async def run(service):
+            loop = asyncio.get_running_loop()
+            task = loop.create_task(service.run())
+            while service.cycles < 2:
+                await asyncio.sleep(0.01)
+            self.write_searches(['GTI', 'WRX'])
+            kill(getpid(), signal.SIGHUP)
+            while len(service.routes) < 2 or service.cycles < 4:
+                await asyncio.sleep(0.01)
+            kill(getpid(), signal.SIGTERM)
+            await task
+
+        with FakeCraigslist(size=3) as server:
+            service = LocalDaemon(server, self.searches_file, DATABASE,
+                                  poller=poller.Poller(DATABASE), scheduler=polling,
+                                  mailer=mailer)
+            asyncio.run(run(service))
+        self.assertTrue(service.stopping)
+        self.assertIsNone(mailer.server)
+        self.assertEqual(mailer.connections, 1)
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertIn('Matched: WRX', self.smtp.messages[1])
+        self.assertGreater(server.not_modified, 0)
+
+    def test_sharded(self):
+        mailer = classes.Mailer('127.0.0.1', self.smtp.server_address[1], 'sender@example.com',
+                                '', starttls=False)
+        polling = scheduler.Scheduler(min_interval=0.05, max_interval=0.1, budget=6000)
+
+        async def run(service):
+            task = asyncio.get_running_loop().create_task(service.run())
+            while service.cycles < 2:
+                await asyncio.sleep(0.01)
+            kill(getpid(), signal.SIGTERM)
+            await task
+
+        self.write_searches(['GTI', 'WRX'])
+        with FakeCraigslist(size=3) as server:
+            sharded = poller.ShardedPoller(DATABASE, shards=2, concurrency=2)
+            service = LocalDaemon(server, self.searches_file, DATABASE, poller=sharded,
+                                  scheduler=polling, mailer=mailer)
+            asyncio.run(asyncio.wait_for(run(service), 30))
+        self.assertIsNone(sharded.pool)
+        sent = ''.join(self.smtp.messages)
+        self.assertIn('Matched: GTI', sent)
+        self.assertIn('Matched: WRX', sent)
+        self.assertTrue(all(path.exists(database) for database in sharded.databases))
+        args = options.arguments(daemon=True).parse_args(['--shards', '2'])
+        self.assertIsInstance(options.build_poller(args), poller.ShardedPoller)
+        with redirect_stderr(StringIO()), self.assertRaises(SystemExit):
+            options.parse_arguments(options.arguments(daemon=True),
+                                    ['--shards', '2', '--feed_cache_mb', '1'])
+
+    def test_failed_cycle(self):
+        mailer = classes.Mailer('127.0.0.1', self.smtp.server_address[1], 'sender@example.com',
+                                '', starttls=False)
+        polling = scheduler.Scheduler(min_interval=0.05, max_interval=0.1, budget=6000)
+
+        class FlakyPoller(poller.Poller):
+            failures = 1
+
+            async def poll_all(self, urls, session=None, executor=None):
+                if self.failures:
+                    self.failures -= 1
+                    raise sqlite3.OperationalError('database is locked')
+                return await super().poll_all(urls, session, executor)
 
-    def test_save_dict(self):
-        test_dict = {1: 1, 2: 2, 3: 3}
-        feed = classes.Feed(URL, DICT_FILE)
-        feed.feed_dict = test_dict
-        feed.save_dict()
-        self.assertIn('test_dict.p', listdir(path.dirname(__file__)))
-        feed = classes.Feed(URL, DICT_FILE).load_dict()
-        self.assertEqual(feed, test_dict)
+        async def run(service):
+            task = asyncio.get_running_loop().create_task(service.run())
+            while service.cycles < 1:
+                await asyncio.sleep(0.01)
+            kill(getpid(), signal.SIGTERM)
+            await task
 
-    def stest_refresh_feed(self):
-        feed = classes.Feed(URL, DICT_FILE).refresh_feed()
-        self.assertGreater(len(feed), 0)
-        feed = classes.Feed(URL, DICT_FILE).refresh_feed()
-        self.assertEqual(len(feed), 0)
+        with FakeCraigslist(size=3) as server, redirect_stdout(StringIO()) as out:
+            service = LocalDaemon(server, self.searches_file, DATABASE,
+                                  poller=FlakyPoller(DATABASE), scheduler=polling,
+                                  mailer=mailer)
+            asyncio.run(asyncio.wait_for(run(service), 10))
+        self.assertIn('Cycle failed', out.getvalue())
+        self.assertEqual(len(self.smtp.messages), 1)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler(Base):
+
+    def test_adapts_to_posting_rate(self):
+        clock = Clock()
+        sched = scheduler.Scheduler(min_interval=60, max_interval=3600, budget=1000,
+                                    jitter=0, clock=clock, seed=1)
+        sched.add('hot')
+        sched.add('quiet')
+        while clock.now < 6 * 3600:
+            clock.now += sched.next_wakeup()
+            for url in sched.due():
+                sched.record(url, 5 if url == 'hot' else 0)
+        self.assertEqual(sched.states['hot'].interval, 60)
+        self.assertEqual(sched.states['quiet'].interval, 3600)
+        self.assertGreater(sched.states['hot'].polls, sched.states['quiet'].polls * 3)
+
+    def test_budget(self):
+        clock = Clock()
+        sched = scheduler.Scheduler(min_interval=1, budget=6, clock=clock, seed=1)
+        for num in range(20):
+            sched.add(str(num))
+        clock.now = 10
+        self.assertEqual(len(sched.due()), 6)
+        self.assertEqual(sched.due(), [])
+        self.assertAlmostEqual(sched.next_wakeup(), 10)
+        clock.now += 20
+        self.assertEqual(len(sched.due()), 2)
+        sched.remove('19')
+        clock.now += 1000
+        self.assertNotIn('19', sched.due())
 
 
 class TestVehicle(Base):
@@ -97,6 +1123,19 @@ class TestVehicle(Base):
         with classes.Vehicle('denver', 'cta', opt, 'GTI') as denver:
             self.assertEqual('denver', denver.city)
 
+    def test_cli_imports(self):
+        # Without config.py on the path, and without the fetch and notify stack
+        code = 'import sys, cli; cli.build_url(sys.argv[1:]); ' \
+               'print(sorted({"classes", "config", "feedparser", "jinja2", "sqlite3"} & ' \
+               'set(sys.modules)))'
+        result = subprocess.run([sys.executable, '-c', code, 'denver', 'cage', 'all',
+                                 '--search', 'GTI', '--max_price', '20000'],
+                                cwd=path.dirname(path.abspath(__file__)), env={},
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.split('\n')[:2], [
+            'https://denver.craigslist.org/search/cta?format=rss&searchNearby=1&'
+            'max_price=20000&auto_make_model=GTI', '[]'])
+
     def test_url_maker(self):
         opt = ['max_price=20000', 'auto_transmission=1']
         denver = classes.Vehicle('denver', 'cta', opt, 'GTI')
@@ -166,6 +1205,15 @@ class TestVehicle(Base):
         options = classes.VehicleOptions(static, var).options_list
         self.assertEqual(options, test_value)
 
+    def test_from_search(self):
+        search = {'city': 'denver', 'vehicle_type': 'cage', 'seller_type': 'all',
+                  'search': 'GTI', 'options': {'max_price': 20000, 'transmission': 'manual',
+                                               'has_images': True, 'crypto': False}}
+        self.assertEqual(classes.Vehicle.from_search(search).url,
+                         'https://denver.craigslist.org/search/cta?format=rss&searchNear'
+                         'by=1&auto_transmission=1&hasPic=1&max_price=20000&auto_make_mo'
+                         'del=GTI')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from io import BytesIO
+import json
+import os
+from urllib.request import urlopen
+
+from atomic import atomic_write
+from metrics import METRICS
+
+try:
+    from PIL import Image
+except ImportError:
+    # Listed in requirements.txt; without it images are cached as fetched,
+    # up to max_raw_bytes
+    Image = None
+
+
+def image_type(data):
+    """
+    :param data: bytes
+    :return: string, MIME subtype of a JPEG, PNG, GIF or WebP image, else None
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class Thumbnails:
+
+    def __init__(self, directory, max_bytes=64 * 2 ** 20, size=(320, 240), workers=8,
+                 timeout=10, max_image_bytes=512 * 2 ** 10, max_raw_bytes=32 * 2 ** 10):
+        """
+        Content-addressed on-disk cache of listing image thumbnails, to be
+        inlined into digests instead of hot-linking Craigslist. The least
+        recently used thumbnails are evicted once the cache passes max_bytes.
+        :param directory: string, cache directory, created if missing
+        :param max_bytes: int, bound on the thumbnails kept on disk
+        :param size: 2-tuple, box thumbnails are scaled down to fit; needs Pillow
+        :param workers: int, most images fetched at once
+        :param timeout: float, seconds before a single fetch is abandoned
+        :param max_image_bytes: int, larger images are not cached
+        :param max_raw_bytes: int, likewise for images inlined unscaled when
+                              Pillow is missing, as each is attached to every
+                              digest it appears in
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = size
+        self.workers = workers
+        self.timeout = timeout
+        self.max_image_bytes = max_image_bytes
+        self.max_raw_bytes = max_raw_bytes
+        if Image is None:
+            print(f'Pillow is not installed; images are not scaled, and those over '
+                  f'{max_raw_bytes} bytes are left out')
+        self.index_file = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_file) as file:
+                self.index = json.load(file)
+        except (OSError, ValueError):
+            self.index = {}
+        self.fetches = 0
+
+    def __repr__(self):
+        return f'Thumbnails({self.directory}, {self.max_bytes})'
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, url):
+        """
+        :param url: string, image URL from a listing
+        :return: 2-tuple, (digest, MIME subtype) of its cached thumbnail, or None
+        """
+        found = self.index.get(url)
+        if found is None or not os.path.isfile(self.path(found[0])):
+            return None
+        return tuple(found)
+
+    def read(self, digest):
+        file_path = self.path(digest)
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        # Access time is unreliable (noatime mounts), so eviction goes by mtime
+        os.utime(file_path)
+        return data
+
+    def thumbnail(self, data):
+        """
+        :param data: bytes, fetched image
+        :return: 2-tuple, (bytes, MIME subtype), or None if it is not a usable image
+        """
+        if Image is None:
+            subtype = image_type(data)
+            if subtype is None or len(data) > min(self.max_image_bytes, self.max_raw_bytes):
+                return None
+            return data, subtype
+        try:
+            with Image.open(BytesIO(data)) as image:
+                image.thumbnail(self.size)
+                out = BytesIO()
+                image.convert('RGB').save(out, 'JPEG', quality=80, optimize=True)
+        except (OSError, ValueError):
+            return None
+        return out.getvalue(), 'jpeg'
+
+    def fetch(self, url):
+        """
+        :return: 2-tuple, (url, thumbnail as returned by thumbnail), the latter None on failure
+        """
+        try:
+            with urlopen(url, timeout=self.timeout) as response:
+                data = response.read(self.max_image_bytes * 16 + 1)
+        except (OSError, ValueError):
+            return url, None
+        return url, self.thumbnail(data)
+
+    def put(self, url, data, subtype):
+        """
+        :return: string, hex digest the thumbnail is stored under
+        """
+        digest = sha1(data).hexdigest()
+        file_path = self.path(digest)
+        if os.path.isfile(file_path):
+            os.utime(file_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            atomic_write(file_path, data)
+        self.index[url] = [digest, subtype]
+        return digest
+
+    def prefetch(self, urls):
+        """
+        Fetches and thumbnails every image not cached yet, each URL once.
+        Images that fail to load are skipped and stay hot-linked.
+        :param urls: iterable of image URLs, None entries ignored
+        :return: dict, URL to (digest, MIME subtype) for every cached image
+        """
+        urls = [url for url in dict.fromkeys(urls) if url]
+        missing = [url for url in urls if self.get(url) is None]
+        if missing:
+            with METRICS.stage('images'), ThreadPoolExecutor(self.workers) as executor:
+                for url, thumbnail in executor.map(self.fetch, missing):
+                    self.fetches += 1
+                    if thumbnail is not None:
+                        self.put(url, *thumbnail)
+            self.evict(keep=urls)
+            atomic_write(self.index_file, json.dumps(self.index))
+        return {url: self.get(url) for url in urls if self.get(url) is not None}
+
+    def evict(self, keep=()):
+        """
+        Deletes the least recently used thumbnails until the cache fits
+        max_bytes, sparing those of the keep URLs.
+        :return: int, bytes freed
+        """
+        spare = {self.index[url][0] for url in keep if url in self.index}
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if root != self.directory:
+                    info = os.stat(os.path.join(root, name))
+                    files.append((info.st_mtime, info.st_size, name))
+        total = sum(size for _, size, _ in files)
+        freed = 0
+        evicted = set()
+        for _, size, digest in sorted(files):
+            if total - freed <= self.max_bytes:
+                break
+            if digest in spare:
+                continue
+            os.remove(self.path(digest))
+            evicted.add(digest)
+            freed += size
+        if evicted:
+            self.index = {url: found for url, found in self.index.items()
+                          if found[0] not in evicted}
+        return freed
@@ -0,0 +1,266 @@
+class Url:
+
+    def __init__(self, city, category, search_term=None):
+        """
+        :param city: string, city / geographical area for craigslist.
+        # TODO add in validation for cities (Dict of all NA CL cities?)
+        :param category: string, for sale category abbreviation
+        # TODO validate categories as well
+        """
+        # assert(city is not None and city.strip() != '')
+        # assert(category is not None and category.strip() != '')
+        # assert(search_term is not None)
+
+        self.city = city.replace(' ', '')
+        self.category = category.strip()
+        if search_term is not None:
+            self.search_term = '+'.join(search_term.split())
+        else:
+            self.search_term = None
+
+        self.url = f'https://{city}.craigslist.org/search/{category}?' \
+                   f'format=rss&searchNearby=1'
+
+    def __repr__(self):
+        return f'Url({self.city}, {self.category}, {self.search_term})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class Vehicle:
+
+    def __init__(self, city, category, options, term=None):
+        """
+        :param city: string, city / geographical area for craigslist.
+        :param category: string, for sale category abbreviation
+        :param term: string, item for which user is searching
+        :param options: list, search parameters
+        """
+        self.city = city.replace(' ', '')
+        self.category = category
+        self.options = options
+        self.term = self.search_parser(term)
+        self.base_url = f'https://{self.city}.craigslist.org/search/' \
+                        f'{self.category}?format=rss&searchNearby=1'
+        self.url = self.url_parser()
+
+    @classmethod
+    def from_search(cls, search):
+        """
+        :param search: dict, saved search using the cli.py vocabulary, e.g.
+                       {"city": "denver", "vehicle_type": "cage",
+                        "seller_type": "all", "search": "GTI",
+                        "options": {"has_images": true, "max_price": 20000}}
+        :return: Vehicle
+        """
+        category = VehicleOptions.categories[search['vehicle_type']][search['seller_type']]
+        options = VehicleOptions.from_dict(search.get('options', {})).options_list
+        return cls(search['city'], category, options, search.get('search'))
+
+    def __repr__(self):
+        return f'Vehicle({self.city}, {self.category}, {self.options}, {self.term})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    @property
+    def get_url(self):
+        return self.url
+
+    @staticmethod
+    def search_parser(term):
+        if term is None:
+            return
+        else:
+            return '+'.join(term.split())
+
+    @property
+    def label(self):
+        """
+        :return: string, short human readable name for the search
+        """
+        if self.term is None:
+            return f'{self.city} {self.category}'
+        return f'{self.city} {self.category} {self.term.replace("+", " ")}'
+
+    def url_parser(self):
+        if len(self.options) > 0:
+            url = '&'.join([self.base_url, '&'.join(self.options)])
+        else:
+            url = self.base_url
+
+        if self.term is not None:
+            return f'{url}&auto_make_model={self.term}'
+        else:
+            return url
+
+
+class VehicleOptions:
+    categories = {
+        'motorcycle': {
+            'all': 'mca',
+            'dealer': 'mcd',
+            'owner': 'mco'},
+        'cage': {
+            'all': 'cta',
+            'dealer': 'ctd',
+            'owner': 'cto'},
+    }
+    flat_static = {
+        'crypto': 'crypto_currency_ok=1',
+        'posted_today': 'postToday=1',
+        'bundled_duplicates': 'bundleDuplicates=1',
+        'has_images': 'hasPic=1',
+        'titles_only': 'srchType=T',
+    }
+    nested_static = {
+        'condition': {
+            'new': 'condition=10',
+            'like new': 'condition=20',
+            'excellent': 'condition=30',
+            'good': 'condition=40',
+            'fair': 'condition=50',
+            'salvage': 'condition=60'},
+        'cylinders': {
+            '3': 'auto_cylinders=1',
+            '4': 'auto_cylinders=2',
+            '5': 'auto_cylinders=3',
+            '6': 'auto_cylinders=4',
+            '8': 'auto_cylinders=5',
+            '10': 'auto_cylinders=6',
+            '12': 'auto_cylinders=7',
+            'other': 'auto_cylinders=8'},
+        'drive': {
+            'fwd': 'auto_drivetrain=1',
+            'rwd': 'auto_drivetrain=2',
+            '4wd': 'auto_drivetrain=3'},
+        'fuel': {
+            'gas': 'auto_fuel_type=1',
+            'diesel': 'auto_fuel_type=2',
+            'hybrid': 'auto_fuel_type=3',
+            'electric': 'auto_fuel_type=4',
+            'other': 'auto_fuel_type=6'},
+        'color': {
+            'black': 'auto_paint=1',
+            'blue': 'auto_paint=2',
+            'brown': 'auto_paint=20',
+            'green': 'auto_paint=3',
+            'grey': 'auto_paint=4',
+            'orange': 'auto_paint=5',
+            'purple': 'auto_paint=6',
+            'red': 'auto_paint=7',
+            'silver': 'auto_paint=8',
+            'white': 'auto_paint=9',
+            'yellow': 'auto_paint=10',
+            'custom': 'auto_paint=11'},
+        'size': {
+            'compact': 'auto_size=1',
+            'full-size': 'auto_size=2',
+            'mid-size': 'auto_size=3',
+            'sub-compact': 'auto_size=4'},
+        'title-status': {
+            'clean': 'auto_title_status=1',
+            'salvage': 'auto_title_status=2',
+            'rebuilt': 'auto_title_status=3',
+            'parts-only': 'auto_title_status=4',
+            'lien': 'auto_title_status=5',
+            'missing': 'auto_title_status=6'},
+        'transmission': {
+            'manual': 'auto_transmission=1',
+            'automatic': 'auto_transmission=2',
+            'other': 'auto_transmission=3'},
+        'type': {
+            'bus': 'auto_bodytype=1',
+            'convertible': 'auto_bodytype=2',
+            'coupe': 'auto_bodytype=3',
+            'hatchback': 'auto_bodytype=4',
+            'mini-van': 'auto_bodytype=5',
+            'offroad': 'auto_bodytype=6',
+            'pickup': 'auto_bodytype=7',
+            'sedan': 'auto_bodytype=8',
+            'truck': 'auto_bodytype=9',
+            'SUV': 'auto_bodytype=10',
+            'wagon': 'auto_bodytype=11',
+            'van': 'auto_bodytype=12',
+            'other': 'auto_bodytype=13'},
+
+    }
+    var_opt = {
+        'search_distance': 'search_distance',
+        'postal_code': 'postal',
+        'min_price': 'min_price',
+        'max_price': 'max_price',
+        'min_auto_year': 'min_auto_year',
+        'max_auto_year': 'max_auto_year',
+        'min_miles': 'min_auto_miles',
+        'max_miles': 'max_auto_miles'
+    }
+
+    def __init__(self, static, var):
+        """
+        :param static: list of strings and 2-tuples, options whose value is static
+        :param var: list of 2-tuples, each list element is made of option
+                    and the variable option amount
+        """
+        self.static = static
+        self.var = var
+        self.options = self.list_builder()
+
+    @classmethod
+    def from_dict(cls, options):
+        """
+        :param options: dict, option name to value, named as in cli.py;
+                        flat options take a boolean
+        :return: VehicleOptions
+        """
+        static = []
+        var = []
+        for option, value in options.items():
+            if option in cls.flat_static and value:
+                static.append(option)
+            elif option in cls.nested_static:
+                static.append((option, value))
+            elif option in cls.var_opt:
+                var.append((option, value))
+        return cls(static, var)
+
+    @staticmethod
+    def opt_builder(option, amount):
+        return f'{option}={amount}'
+
+    @property
+    def options_list(self):
+        return self.options
+
+    def list_builder(self):
+        """
+        :return: list of search options
+        """
+        options = []
+        for option in self.static:
+            if option in self.flat_static:
+                options.append(self.flat_static[option])
+
+            else:
+                try:
+                    opt, value = option
+                    if opt in self.nested_static:
+                        options.append(self.nested_static[opt][value])
+                except ValueError:
+                    pass
+
+        for option in self.var:
+            try:
+                opt, amount = option
+                if opt in self.var_opt:
+                    options.append(self.opt_builder(opt, amount))
+            except ValueError:
+                pass
+        return options